@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Caching HTTP proxy for the apt packages installed in the guest OS.
+
+The proxy runs in a thread on the host and the guest apt is configured to
+use it for the http:// mirrors listed in the image apt sources. Only those
+mirrors are proxied, so the proxy can't be used to reach other hosts from
+the network it listens on.
+
+Package files (.deb) never change for the same URL, so they are always
+served from the cache once downloaded. The indexes of a repository suite
+(`dists/<suite>/`) are served from the cache while its Release file is
+younger than APT_INDEX_MAX_AGE, so a warm build doesn't need to reach the
+network at all. When the Release file is fetched again, the other indexes
+of the suite are fetched again too, so they always match it. If the
+upstream repository can't be reached, stale cached indexes are served as
+well.
+"""
+import os
+import re
+import sys
+import glob
+import time
+import shutil
+import subprocess
+import threading
+from typing import Optional
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import ext4_edit
+import image_cache
+
+
+###############################################################################
+# Configuration data start
+
+APT_CACHE_DIR = os.environ.get(
+    "RPI_OS_APT_CACHE", os.path.join(image_cache.CACHE_DIR, "apt")
+)
+# Seconds before a cached repository index is fetched again
+APT_INDEX_MAX_AGE = 24 * 60 * 60
+
+# Configuration data end
+###############################################################################
+
+# File written in the guest to configure the apt proxy
+GUEST_APT_PROXY_CONF = "/etc/apt/apt.conf.d/90-rpi-os-custom-image-proxy"
+
+# Paths that never change content for the same URL
+IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".dsc", ".tar.gz", ".tar.xz")
+IMMUTABLE_PATH_PARTS = ("/by-hash/",)
+# Files that describe the other indexes of a suite
+RELEASE_FILES = ("InRelease", "Release")
+# File in the cached suite directory, its mtime is when the Release file was fetched
+SUITE_REFRESHED_FILE = ".refreshed"
+
+# URLs in the apt sources, in one line .list entries and deb822 .sources files
+SOURCES_URL = re.compile(r"\bhttp://([^/\s\]]+)")
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class AptCacheHandler(BaseHTTPRequestHandler):
+    """Serve proxy GET requests from the cache, or fetch and cache them."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._proxy(send_body=True)
+
+    def do_HEAD(self):
+        self._proxy(send_body=False)
+
+    def _proxy(self, send_body):
+        url = urlsplit(self.path)
+        if url.scheme != "http" or not url.hostname or ".." in url.path.split("/"):
+            self.send_error(400, "Only absolute http:// proxy requests are supported")
+            return
+        if _netloc(url.netloc) not in self.server.mirror_hosts:
+            self.server.count("denied")
+            self.send_error(403, "Only the guest apt mirrors are proxied")
+            return
+        host_dir = os.path.join(self.server.cache_dir, url.hostname)
+        cache_path = os.path.join(host_dir, url.path.lstrip("/") or "index")
+        if url.query:
+            cache_path += "?" + url.query
+        suite_dir = _suite_dir(cache_path, host_dir)
+
+        if self._is_fresh(cache_path, url.path, suite_dir):
+            self.server.count("hits")
+        elif not send_body:
+            status, headers = self._fetch_head(self.path)
+            if status == 200 or not os.path.isfile(cache_path):
+                self._send_upstream_head(status, headers)
+                return
+            self.server.count("stale")
+        else:
+            status = self._fetch(self.path, cache_path, suite_dir)
+            if status == 200:
+                self.server.count("misses")
+            elif os.path.isfile(cache_path):
+                # Upstream is not reachable, but a stale copy is better than nothing
+                self.server.count("stale")
+            else:
+                self.send_error(status)
+                return
+
+        size = os.path.getsize(cache_path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Last-Modified", self.date_time_string(os.path.getmtime(cache_path)))
+        self.end_headers()
+        if send_body:
+            with open(cache_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+            self.server.count("bytes_served", size)
+
+    def _is_fresh(self, cache_path, url_path, suite_dir):
+        if not os.path.isfile(cache_path):
+            return False
+        if url_path.endswith(IMMUTABLE_SUFFIXES) or any(p in url_path for p in IMMUTABLE_PATH_PARTS):
+            return True
+        if suite_dir is None:
+            return time.time() - os.path.getmtime(cache_path) < self.server.index_max_age
+        # All the indexes of a suite expire with its Release file, and the
+        # ones cached before it was last fetched are stale
+        refreshed_path = os.path.join(suite_dir, SUITE_REFRESHED_FILE)
+        if not os.path.isfile(refreshed_path):
+            return False
+        refreshed_time = os.path.getmtime(refreshed_path)
+        return time.time() - refreshed_time < self.server.index_max_age and \
+            os.path.getmtime(cache_path) >= refreshed_time
+
+    def _fetch(self, url, cache_path, suite_dir):
+        """Download a URL into the cache, returns the HTTP status code."""
+        fetch_time = time.time()
+        try:
+            response = self.server.session.get(url, stream=True, timeout=60)
+        except requests.exceptions.RequestException:
+            return 502
+        if response.status_code != 200:
+            return response.status_code
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                self.server.count("bytes_downloaded", len(chunk))
+        os.replace(tmp_path, cache_path)
+        if suite_dir and os.path.basename(cache_path) in RELEASE_FILES:
+            self._refresh_suite(suite_dir, fetch_time)
+        return 200
+
+    def _refresh_suite(self, suite_dir, fetch_time):
+        """Start a new generation of the suite indexes, unless the Release
+        file fetched is an alternative one of the current generation."""
+        refreshed_path = os.path.join(suite_dir, SUITE_REFRESHED_FILE)
+        with self.server.suites_lock:
+            if os.path.isfile(refreshed_path) and \
+                    time.time() - os.path.getmtime(refreshed_path) < self.server.index_max_age:
+                return
+            with open(refreshed_path, "w"):
+                pass
+            os.utime(refreshed_path, (fetch_time, fetch_time))
+
+    def _fetch_head(self, url):
+        """Forward a HEAD request, returns the HTTP status code and headers."""
+        try:
+            response = self.server.session.head(url, allow_redirects=True, timeout=60)
+        except requests.exceptions.RequestException:
+            return 502, {}
+        return response.status_code, response.headers
+
+    def _send_upstream_head(self, status, headers):
+        if status != 200:
+            self.send_error(status)
+            return
+        self.send_response(200)
+        for header in ("Content-Length", "Last-Modified"):
+            if header in headers:
+                self.send_header(header, headers[header])
+        self.end_headers()
+
+
+class AptCacheProxy(ThreadingHTTPServer):
+    """The apt caching proxy server, running in a background thread.
+
+    :param mirror_hosts: Hosts, and ports other than 80, of the apt mirrors
+        to proxy, e.g. from mirror_hosts(). Requests to other hosts are denied.
+    :param bind_address: IP address to listen on, reachable by the guest.
+    :param port: Port to listen on, 0 to pick a free one.
+    :param cache_dir: Directory to store the cached files.
+    :param index_max_age: Seconds to serve cached indexes without refreshing.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, mirror_hosts, bind_address: str = "127.0.0.1", port: int = 0,
+                 cache_dir: str = APT_CACHE_DIR, index_max_age: int = APT_INDEX_MAX_AGE):
+        super().__init__((bind_address, port), AptCacheHandler)
+        self.mirror_hosts = set(_netloc(host) for host in mirror_hosts)
+        self.cache_dir = cache_dir
+        self.index_max_age = index_max_age
+        self.session = requests.Session()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "denied": 0, "bytes_served": 0, "bytes_downloaded": 0}
+        self.stats_lock = threading.Lock()
+        self.suites_lock = threading.Lock()
+        self.thread = None
+
+    def count(self, stat: str, value: int = 1) -> None:
+        with self.stats_lock:
+            self.stats[stat] += value
+
+    def start(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        print("Apt cache proxy running on port {}, cache: {}".format(self.server_port, self.cache_dir))
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        print("Apt cache proxy stats: {} hits, {} misses, {} stale, {} denied, {:.1f}MB served, "
+              "{:.1f}MB downloaded".format(
+            self.stats["hits"], self.stats["misses"], self.stats["stale"], self.stats["denied"],
+            self.stats["bytes_served"] / (1024 * 1024), self.stats["bytes_downloaded"] / (1024 * 1024),
+        ))
+
+
+def _netloc(netloc: str) -> str:
+    """Normalise a URL host and port, without the default HTTP port."""
+    netloc = netloc.lower()
+    return netloc[:-3] if netloc.endswith(":80") else netloc
+
+
+def _suite_dir(cache_path: str, host_dir: str) -> Optional[str]:
+    """The cached directory of the suite a file in `dists/` belongs to.
+
+    That is the directory of a Release file, or for the other indexes the
+    closest parent directory where a Release file was fetched, as suites
+    can be nested like `dists/buster/updates`.
+
+    :param cache_path: Path of the file in the cache.
+    :param host_dir: Cache directory of the mirror host.
+    :return: The suite directory, None if the file is not in a suite.
+    """
+    if "dists" not in os.path.relpath(cache_path, host_dir).split(os.sep)[:-2]:
+        return None
+    if os.path.basename(cache_path) in RELEASE_FILES:
+        return os.path.dirname(cache_path)
+    suite_dir = os.path.dirname(cache_path)
+    while os.path.basename(suite_dir) != "dists":
+        if os.path.isfile(os.path.join(suite_dir, SUITE_REFRESHED_FILE)):
+            return suite_dir
+        suite_dir = os.path.dirname(suite_dir)
+    return None
+
+
+def mirror_hosts(img_path: str) -> list:
+    """Hosts of the http:// apt sources configured in an image.
+
+    :param img_path: Path to the .img file, the sources are read from its
+        root partition.
+    :return: The hosts, with the port if it's not 80, in the order found.
+    """
+    hosts = []
+    with ext4_edit.Ext4Editor(img_path) as editor:
+        apt_dir = editor.dump("/etc/apt")
+        source_paths = [os.path.join(apt_dir, "sources.list")] + \
+            sorted(glob.glob(os.path.join(apt_dir, "sources.list.d", "*.list"))) + \
+            sorted(glob.glob(os.path.join(apt_dir, "sources.list.d", "*.sources")))
+        for source_path in source_paths:
+            if not os.path.isfile(source_path):
+                continue
+            with open(source_path, errors="replace") as f:
+                for line in f:
+                    line = line.split("#", 1)[0]
+                    for netloc in SOURCES_URL.findall(line):
+                        if _netloc(netloc) not in hosts:
+                            hosts.append(_netloc(netloc))
+    return hosts
+
+
+def docker_host_address() -> Optional[str]:
+    """IP address of the host in the default Docker bridge network.
+
+    This is the address the QEMU guest, running inside the dockerpi
+    container, can use to reach a server running on the host.
+    """
+    try:
+        result = subprocess.run(
+            ["docker", "network", "inspect", "bridge", "--format",
+             "{{range .IPAM.Config}}{{.Gateway}}{{end}}"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+        )
+    except OSError:
+        return None
+    address = result.stdout.strip()
+    return address if result.returncode == 0 and address else None
+
+
+def guest_proxy_commands(proxy_url: str, hosts) -> list:
+    """Guest commands to configure apt to use the proxy for the mirror
+    hosts, other repositories are accessed directly."""
+    conf = "".join(
+        'Acquire::http::Proxy::{} "{}";\\n'.format(host.split(":")[0], proxy_url) for host in hosts
+    )
+    return [
+        "printf '{}' | sudo tee {}".format(conf, GUEST_APT_PROXY_CONF),
+    ]
+
+
+def guest_remove_proxy_commands() -> list:
+    """Guest commands to remove the apt proxy configuration."""
+    return ["sudo rm -f {}".format(GUEST_APT_PROXY_CONF)]
+
+
+def main():
+    """Run the proxy on its own, e.g. to test it with a local repository.
+
+    python apt_cache.py <mirror host>[,<mirror host>...] [bind address] [port]
+    """
+    proxy = AptCacheProxy(
+        sys.argv[1].split(","),
+        sys.argv[2] if len(sys.argv) > 2 else "127.0.0.1",
+        int(sys.argv[3]) if len(sys.argv) > 3 else 3142,
+    )
+    proxy.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        proxy.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
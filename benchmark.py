@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the image pipeline without the real OS download or QEMU.
+
+A local HTTP server serves synthetic .img.xz and .zip archives, and a fake
+guest running in a pty emulates the Raspberry Pi OS serial console login
+and shell, so the download, decompression, copy and guest command steps can
+be measured on any Linux computer.
+
+The results are printed and saved as JSON, e.g.:
+    python benchmark.py --size-mb 512 --output benchmark-results.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pexpect
+
+import download_os
+import image_copy
+import export_image
+import build_trace
+import customise_os
+
+
+# Default size of the synthetic image
+IMAGE_SIZE_MB = 256
+# Fraction of the synthetic image with data, the rest are zeros like the
+# free space of a real image
+IMAGE_DATA_FRACTION = 0.4
+# The data is made of random blocks repeated this many times, so it
+# compresses roughly as much as a real image
+IMAGE_DATA_REPEAT = 4
+IMAGE_DATA_BLOCK_SIZE = 64 * 1024
+
+# Fake guest defaults
+GUEST_BOOT_SECONDS = 1.0
+GUEST_BOOT_LINES = 500
+GUEST_COMMANDS = 20
+GUEST_COMMAND_OUTPUT_LINES = 200
+
+
+def create_image(img_path: str, size_mb: int = IMAGE_SIZE_MB, data_fraction: float = IMAGE_DATA_FRACTION,
+                 seed: int = 0) -> None:
+    """Create a synthetic sparse image with compressible data and zeros.
+
+    :param img_path: Path to the .img file to create.
+    :param size_mb: Size of the image in MB.
+    :param data_fraction: Fraction of the image blocks that contain data.
+    :param seed: Random seed, so the same image is created every time.
+    """
+    rand = random.Random(seed)
+    size = size_mb * 1024 * 1024
+    part_size = IMAGE_DATA_BLOCK_SIZE // IMAGE_DATA_REPEAT
+    with open(img_path, "wb") as f:
+        f.truncate(size)
+        for offset in range(0, size, IMAGE_DATA_BLOCK_SIZE):
+            if rand.random() < data_fraction:
+                part = rand.getrandbits(part_size * 8).to_bytes(part_size, "little")
+                f.seek(offset)
+                f.write(part * IMAGE_DATA_REPEAT)
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """Serve the files in the server directory, with HTTP Range support."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._send_file(send_body=False)
+
+    def do_GET(self):
+        self._send_file(send_body=True)
+
+    def _send_file(self, send_body):
+        file_path = os.path.join(self.server.directory, os.path.basename(self.path))
+        if not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(file_path)
+        start, end = 0, size
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if not send_body:
+            return
+        with self.server.drops_lock:
+            drop = self.server.drops > 0
+            self.server.drops -= drop
+        if drop:
+            # Close the connection in the middle of the response
+            self.close_connection = True
+            end = min(end, start + self.server.drop_after)
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class ImageServer(ThreadingHTTPServer):
+    """Local HTTP server for the synthetic image archives.
+
+    :param directory: Directory with the files to serve.
+    :param ranges: Support HTTP Range requests.
+    :param drops: Number of responses to cut short, to simulate dropped
+        connections.
+    :param drop_after: Bytes sent in those responses before dropping them.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory: str, ranges: bool = True, drops: int = 0, drop_after: int = 256 * 1024):
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+        self.directory = directory
+        self.ranges = ranges
+        self.drops = drops
+        self.drop_after = drop_after
+        self.drops_lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def image_url(self, file_name: str) -> download_os.ImageURL:
+        url = "http://127.0.0.1:{}/{}".format(self.server_port, file_name)
+        return download_os.ImageURL(url, url + ".sha256")
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def fake_guest(boot_seconds: float, boot_lines: int, failed_logins: int = 0,
+               first_boot_msg: str = "before") -> None:
+    """Emulate the Raspberry Pi OS boot and login on the console.
+
+    After the login it replaces itself with a bash shell with the same
+    prompt as Raspberry Pi OS, where `sudo shutdown` exits the shell.
+
+    :param failed_logins: Number of correct logins that are rejected, as if
+        the first boot wizard hadn't created the user yet.
+    :param first_boot_msg: When the first boot done message is printed,
+        "before" or "after" the first login prompt, or "never".
+    """
+    for i in range(boot_lines):
+        print("[  OK  ] Started Fake Service {}.".format(i))
+        time.sleep(boot_seconds / max(boot_lines, 1))
+    if first_boot_msg == "before":
+        print("[  OK  ] Reached target Multi-User System.")
+    elif first_boot_msg == "after":
+        sys.stdout.write("\nraspberrypi login: ")
+        sys.stdout.flush()
+        time.sleep(0.5)
+        print("\n[  OK  ] Finished User configuration dialog.")
+    while True:
+        sys.stdout.write("\nraspberrypi login: ")
+        sys.stdout.flush()
+        username = input()
+        sys.stdout.write("Password: ")
+        sys.stdout.flush()
+        password = input()
+        if username == customise_os.RPI_OS_USERNAME and password == customise_os.RPI_OS_PASSWORD:
+            if failed_logins <= 0:
+                break
+            failed_logins -= 1
+        print("\nLogin incorrect")
+
+    rc_file = tempfile.NamedTemporaryFile("w", suffix=".bashrc", delete=False)
+    with rc_file:
+        rc_file.write("\n".join([
+            "PS1='{}'".format(customise_os.BASH_PROMPT),
+            # Run commands without root, and exit the shell on shutdown
+            'sudo() { case "$1" in shutdown|poweroff) rm -f ' + rc_file.name + '; exit 0;; esac; "$@"; }',
+            "",
+        ]))
+    os.execvp("bash", ["bash", "--noprofile", "--rcfile", rc_file.name, "-i"])
+
+
+def spawn_fake_guest(boot_seconds: float = GUEST_BOOT_SECONDS, boot_lines: int = GUEST_BOOT_LINES,
+                     failed_logins: int = 0, first_boot_msg: str = "before"):
+    """Start the fake guest in a pty, like customise_os.launch_docker_spawn.
+
+    The arguments are the same as fake_guest().
+    """
+    child = pexpect.spawn(
+        sys.executable,
+        [os.path.abspath(__file__), "fake-guest", str(boot_seconds), str(boot_lines), str(failed_logins),
+         first_boot_msg],
+        timeout=600, encoding="utf-8",
+    )
+    child.logfile = build_trace.ConsoleRingBuffer()
+    return child
+
+
+def _result(name: str, seconds: float, size: int = None, **extra) -> dict:
+    result = {"benchmark": name, "seconds": round(seconds, 4)}
+    if size is not None:
+        result["bytes"] = size
+        result["mb_per_s"] = round(size / (1024 * 1024) / max(seconds, 1e-9), 2)
+    result.update(extra)
+    result["peak_memory_mb"] = round(download_os.peak_memory_mb(), 1)
+    print("{:<40} {:>9.3f}s {}".format(
+        name, seconds, "{:>9.1f}MB/s".format(result["mb_per_s"]) if size is not None else ""
+    ))
+    return result
+
+
+def bench_download(server: ImageServer, archive_name: str, work_dir: str, segments: int) -> dict:
+    download_os.IMAGE_SAVE_LOCATION = os.path.join(work_dir, "download")
+    download_os.DOWNLOAD_SEGMENTS = segments
+    start = time.perf_counter()
+    path = download_os.download_compressed_image(server.image_url(archive_name))
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path)
+    shutil.rmtree(download_os.IMAGE_SAVE_LOCATION)
+    return _result("download {} segments={}".format(archive_name, segments), seconds, size,
+                   segments=segments)
+
+
+def bench_download_decompress(server: ImageServer, archive_name: str, work_dir: str) -> dict:
+    download_os.IMAGE_SAVE_LOCATION = os.path.join(work_dir, "pipeline")
+    start = time.perf_counter()
+    img_path = download_os.download_decompress_image(server.image_url(archive_name))
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(img_path)
+    shutil.rmtree(download_os.IMAGE_SAVE_LOCATION)
+    return _result("download+decompress {}".format(archive_name), seconds, size)
+
+
+def bench_decompress(archive_path: str, work_dir: str) -> dict:
+    download_os.IMAGE_SAVE_LOCATION = os.path.join(work_dir, "decompress")
+    start = time.perf_counter()
+    img_path = download_os.decompress_image(archive_path)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(img_path)
+    shutil.rmtree(download_os.IMAGE_SAVE_LOCATION)
+    return _result("decompress {}".format(os.path.basename(archive_path)), seconds, size)
+
+
+def bench_copy(img_path: str, work_dir: str) -> list:
+    results = []
+    size = os.path.getsize(img_path)
+    for name, copy_fn in (
+        ("copy image", image_copy.copy_image),
+        ("copy image sparse", image_copy.sparse_copy),
+        ("copy image full", shutil.copyfile),
+    ):
+        dst_path = os.path.join(work_dir, "copy.img")
+        start = time.perf_counter()
+        copy_fn(img_path, dst_path)
+        seconds = time.perf_counter() - start
+        os.remove(dst_path)
+        results.append(_result(name, seconds, size))
+    return results
+
+
+def bench_guest(boot_seconds: float, boot_lines: int, commands: int, output_lines: int) -> list:
+    results = []
+    child = spawn_fake_guest(boot_seconds, boot_lines)
+    try:
+        start = time.perf_counter()
+        customise_os.login(child)
+        results.append(_result("guest login", time.perf_counter() - start,
+                               boot_seconds=boot_seconds, boot_lines=boot_lines))
+
+        cmd_list = ["seq {} | sed 's/^/output line /'".format(output_lines)] * commands
+        start = time.perf_counter()
+        customise_os.run_guest_commands(child, cmd_list)
+        results.append(_result("guest commands", time.perf_counter() - start,
+                               commands=commands, output_lines=output_lines))
+
+        start = time.perf_counter()
+        for cmd in cmd_list:
+            customise_os.run_guest_commands(child, [cmd])
+        results.append(_result("guest commands one by one", time.perf_counter() - start,
+                               commands=commands, output_lines=output_lines))
+
+        start = time.perf_counter()
+        child.sendline("sudo shutdown now")
+        child.expect(pexpect.EOF)
+        results.append(_result("guest shutdown", time.perf_counter() - start))
+    except Exception:
+        customise_os.dump_console(child)
+        raise
+    finally:
+        child.close()
+    return results
+
+
+def run_benchmarks(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="rpi-os-bench-")
+    results = []
+    server = None
+    try:
+        print("Creating {}MB synthetic image in {}".format(args.size_mb, work_dir))
+        source_dir = os.path.join(work_dir, "source")
+        os.makedirs(source_dir)
+        img_path = os.path.join(source_dir, "bench.img")
+        create_image(img_path, args.size_mb, args.data_fraction)
+        archives = [
+            export_image.export_image(img_path, "xz"),
+            export_image.export_image(img_path, "zip"),
+        ]
+        server = ImageServer(source_dir, ranges=True)
+        print()
+
+        for _ in range(args.repeat):
+            if "download" in args.only:
+                for archive_path in archives:
+                    name = os.path.basename(archive_path)
+                    results.append(bench_download(server, name, work_dir, 0))
+                    results.append(bench_download(server, name, work_dir, 4))
+                    results.append(bench_download_decompress(server, name, work_dir))
+            if "decompress" in args.only:
+                for archive_path in archives:
+                    results.append(bench_decompress(archive_path, work_dir))
+            if "copy" in args.only:
+                results += bench_copy(img_path, work_dir)
+            if "guest" in args.only:
+                results += bench_guest(args.boot_seconds, args.boot_lines, args.commands, args.output_lines)
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "system": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "params": {
+            "size_mb": args.size_mb,
+            "data_fraction": args.data_fraction,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "fake-guest":
+        fake_guest(float(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), sys.argv[5])
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size-mb", type=int, default=IMAGE_SIZE_MB, help="Synthetic image size")
+    parser.add_argument("--data-fraction", type=float, default=IMAGE_DATA_FRACTION,
+                        help="Fraction of the image with data, the rest are zeros")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to run each benchmark")
+    parser.add_argument("--only", nargs="+", default=["download", "decompress", "copy", "guest"],
+                        choices=["download", "decompress", "copy", "guest"], help="Benchmarks to run")
+    parser.add_argument("--boot-seconds", type=float, default=GUEST_BOOT_SECONDS, help="Fake guest boot time")
+    parser.add_argument("--boot-lines", type=int, default=GUEST_BOOT_LINES, help="Fake guest boot log lines")
+    parser.add_argument("--commands", type=int, default=GUEST_COMMANDS, help="Number of guest commands")
+    parser.add_argument("--output-lines", type=int, default=GUEST_COMMAND_OUTPUT_LINES,
+                        help="Output lines per guest command")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON results file")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\nResults saved to: {}".format(args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
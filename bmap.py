@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Create block maps of OS images, and flash them writing only mapped blocks.
+
+A block map (.bmap) lists the blocks of an image that contain data, in the
+bmaptool 2.0 format, so `bmaptool copy` or flash() can skip the rest.
+Blocks are unmapped if they are a hole in the sparse image file, or if the
+FAT32 or ext4 filesystem they belong to marks them as free. Each range of
+mapped blocks has a SHA256 checksum, calculated in parallel.
+
+    python bmap.py create image.img
+    python bmap.py flash image.img /dev/sdX
+"""
+import os
+import re
+import sys
+import lzma
+import struct
+import hashlib
+import argparse
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import fat32
+import partitions
+import image_copy
+
+
+BMAP_BLOCK_SIZE = 4096
+BMAP_VERSION = "2.0"
+# Long ranges are split so their checksums can be calculated in parallel
+MAX_RANGE_BLOCKS = 16 * 1024
+READ_SIZE = 1024 * 1024
+
+EXT4_SUPERBLOCK_OFFSET = 1024
+EXT4_MAGIC = 0xEF53
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_FEATURE_INCOMPAT_META_BG = 0x10
+EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x01
+EXT4_FEATURE_COMPAT_SPARSE_SUPER2 = 0x200
+EXT4_BG_BLOCK_UNINIT = 0x02
+
+BMAP_TEMPLATE = """<?xml version="1.0" ?>
+<!-- This file contains the block map for an image file, which is basically
+     a list of useful (mapped) block numbers in the image file. In other
+     words, it lists only those blocks which contain data (boot sector,
+     partition table, file-system metadata, files, directories, extents, etc).
+     These blocks have to be copied to the target device. The other blocks
+     do not contain any useful data and do not have to be copied to the
+     target device. -->
+<bmap version="{version}">
+    <!-- Image size in bytes: {image_size_human} -->
+    <ImageSize> {image_size} </ImageSize>
+
+    <!-- Size of a block in bytes -->
+    <BlockSize> {block_size} </BlockSize>
+
+    <!-- Count of blocks in the image file -->
+    <BlocksCount> {blocks_count} </BlocksCount>
+
+    <!-- Count of mapped blocks: {mapped_human} or {mapped_percent:.1f}% -->
+    <MappedBlocksCount> {mapped_count} </MappedBlocksCount>
+
+    <!-- Type of checksum used in this file -->
+    <ChecksumType> sha256 </ChecksumType>
+
+    <!-- The checksum of this bmap file. When it is calculated, the value of
+         the checksum has be zero (all ASCII "0" symbols).  -->
+    <BmapFileChecksum> {bmap_checksum} </BmapFileChecksum>
+
+    <!-- The block map which consists of elements which may either be a
+         range of blocks or a single block. The 'chksum' attribute
+         (if present) is the checksum of this blocks range. -->
+    <BlockMap>
+{ranges}
+    </BlockMap>
+</bmap>
+"""
+RANGE_RE = re.compile(r'<Range chksum="([0-9a-f]+)">\s*(\d+)(?:-(\d+))?\s*</Range>')
+
+
+def _human_size(size: int) -> str:
+    if size < 1024:
+        return "{} bytes".format(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            return "{:.1f} {}".format(size, unit)
+
+
+def _fat32_free_regions(img_path: str, partition: partitions.Partition) -> List[Tuple[int, int]]:
+    """Byte (start, end) regions of the free clusters in a FAT32 partition."""
+    regions = []
+    with fat32.Fat32Filesystem(img_path, partition) as fs:
+        cluster = 2
+        while cluster < fs.clusters + 2:
+            if fs.fat[cluster] & fat32.FAT_ENTRY_MASK != fat32.FAT_FREE:
+                cluster += 1
+                continue
+            first = cluster
+            while cluster < fs.clusters + 2 and fs.fat[cluster] & fat32.FAT_ENTRY_MASK == fat32.FAT_FREE:
+                cluster += 1
+            regions.append((fs._cluster_offset(first), fs._cluster_offset(cluster)))
+    return regions
+
+
+def _is_power_of(number: int, base: int) -> bool:
+    while number > 1 and number % base == 0:
+        number //= base
+    return number == 1
+
+
+def _ext4_uninit_free_blocks(group_start: int, group_end: int, used: List[Tuple[int, int]]):
+    """Free (start, end) blocks of a group with an uninitialised block
+    bitmap, all except the used metadata blocks."""
+    free = []
+    for used_start, used_end in sorted(used):
+        if used_end <= group_start or used_start >= group_end:
+            continue
+        if used_start > group_start:
+            free.append((group_start, used_start))
+        group_start = max(group_start, used_end)
+    if group_start < group_end:
+        free.append((group_start, group_end))
+    return free
+
+
+def _ext4_free_regions(img_path: str, partition: partitions.Partition) -> List[Tuple[int, int]]:
+    """Byte (start, end) regions of the free blocks in an ext4 partition.
+
+    Block groups with an uninitialised block bitmap are free, except for
+    the superblock and group descriptor backups and the bitmaps and inode
+    tables stored in them.
+    """
+    regions = []
+    with open(img_path, "rb") as f:
+        f.seek(partition.offset + EXT4_SUPERBLOCK_OFFSET)
+        sb = f.read(1024)
+        if struct.unpack_from("<H", sb, 0x38)[0] != EXT4_MAGIC:
+            raise Exception("Partition {} is not ext2/3/4".format(partition.number))
+        blocks_count_lo, = struct.unpack_from("<I", sb, 0x04)
+        first_data_block, log_block_size = struct.unpack_from("<II", sb, 0x14)
+        blocks_per_group, = struct.unpack_from("<I", sb, 0x20)
+        inodes_per_group, = struct.unpack_from("<I", sb, 0x28)
+        rev_level, = struct.unpack_from("<I", sb, 0x4C)
+        inode_size, = struct.unpack_from("<H", sb, 0x58)
+        feature_compat, feature_incompat, feature_ro_compat = struct.unpack_from("<III", sb, 0x5C)
+        reserved_gdt_blocks, = struct.unpack_from("<H", sb, 0xCE)
+        desc_size, = struct.unpack_from("<H", sb, 0xFE)
+        blocks_count_hi, = struct.unpack_from("<I", sb, 0x150)
+        backup_groups = struct.unpack_from("<II", sb, 0x24C)
+        is_64bit = feature_incompat & EXT4_FEATURE_INCOMPAT_64BIT
+        blocks_count = blocks_count_lo | (blocks_count_hi << 32 if is_64bit else 0)
+        desc_size = desc_size if is_64bit else 32
+        inode_size = inode_size if rev_level else 128
+        block_size = 1024 << log_block_size
+        groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+        gdt_blocks = -(-groups * desc_size // block_size)
+        inode_table_blocks = -(-inodes_per_group * inode_size // block_size)
+
+        def has_super_backup(group):
+            if feature_compat & EXT4_FEATURE_COMPAT_SPARSE_SUPER2:
+                return group == 0 or group in backup_groups
+            if not feature_ro_compat & EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER or group <= 1:
+                return True
+            return any(_is_power_of(group, base) for base in (3, 5, 7))
+
+        f.seek(partition.offset + (first_data_block + 1) * block_size)
+        descriptors = f.read(groups * desc_size)
+        bitmap_blocks, metadata = [], []
+        for group in range(groups):
+            desc = descriptors[group * desc_size:(group + 1) * desc_size]
+            block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc, 0x00)
+            flags, = struct.unpack_from("<H", desc, 0x12)
+            if is_64bit and desc_size >= 64:
+                hi = struct.unpack_from("<III", desc, 0x20)
+                block_bitmap, inode_bitmap, inode_table = (
+                    lo | high << 32 for lo, high in zip((block_bitmap, inode_bitmap, inode_table), hi)
+                )
+            bitmap_blocks.append(None if flags & EXT4_BG_BLOCK_UNINIT else block_bitmap)
+            # With flex_bg the bitmaps and inode tables can be in any group
+            metadata += [
+                (block_bitmap, block_bitmap + 1),
+                (inode_bitmap, inode_bitmap + 1),
+                (inode_table, inode_table + inode_table_blocks),
+            ]
+            group_start = first_data_block + group * blocks_per_group
+            if has_super_backup(group):
+                metadata.append((group_start, group_start + 1 + gdt_blocks + reserved_gdt_blocks))
+
+        for group, bitmap_block in enumerate(bitmap_blocks):
+            group_start = first_data_block + group * blocks_per_group
+            group_blocks = min(blocks_per_group, blocks_count - group_start)
+            if bitmap_block is None:
+                # The group descriptors are elsewhere with meta_bg, keep it mapped
+                if feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+                    continue
+                regions += [
+                    (partition.offset + start * block_size, partition.offset + end * block_size)
+                    for start, end in _ext4_uninit_free_blocks(group_start, group_start + group_blocks, metadata)
+                ]
+                continue
+            f.seek(partition.offset + bitmap_block * block_size)
+            bitmap = f.read(blocks_per_group // 8)
+            bit = 0
+            while bit < group_blocks:
+                if bitmap[bit >> 3] == 0xFF:
+                    bit = (bit | 7) + 1
+                    continue
+                if bitmap[bit >> 3] >> (bit & 7) & 1:
+                    bit += 1
+                    continue
+                first = bit
+                while bit < group_blocks and not bitmap[bit >> 3] >> (bit & 7) & 1:
+                    bit += 1
+                regions.append((
+                    partition.offset + (group_start + first) * block_size,
+                    partition.offset + (group_start + bit) * block_size,
+                ))
+    return regions
+
+
+def _free_regions(img_path: str) -> List[Tuple[int, int]]:
+    """Free regions of all the FAT32 and ext4 partitions in the image."""
+    regions = []
+    try:
+        image_partitions = partitions.read_partitions(img_path)
+    except Exception as e:
+        print("Could not read the partitions, only skipping the holes: {}".format(e))
+        return regions
+    for partition in image_partitions:
+        try:
+            if partition.type_id in partitions.FAT32_TYPE_IDS:
+                regions += _fat32_free_regions(img_path, partition)
+            elif partition.type_id == partitions.LINUX_TYPE_ID:
+                regions += _ext4_free_regions(img_path, partition)
+        except Exception as e:
+            print("Could not read the free space of partition {}: {}".format(partition.number, e))
+    return sorted(regions)
+
+
+def mapped_ranges(img_path: str, block_size: int = BMAP_BLOCK_SIZE) -> List[Tuple[int, int]]:
+    """Find the blocks of an image with useful data.
+
+    :param img_path: Path to the .img file.
+    :param block_size: Size of the blocks in bytes.
+    :return: Sorted list of (first, last) block ranges, inclusive.
+    """
+    size = os.path.getsize(img_path)
+    fd = os.open(img_path, os.O_RDONLY)
+    try:
+        data_blocks = [
+            (start // block_size, -(-end // block_size))
+            for start, end in image_copy.data_regions(fd, size)
+        ]
+    finally:
+        os.close(fd)
+    # Only whole blocks inside a free region can be skipped
+    free_blocks = [
+        (-(-start // block_size), end // block_size) for start, end in _free_regions(img_path)
+    ]
+
+    ranges = []
+    free_index = 0
+    for start, end in data_blocks:
+        while free_index < len(free_blocks) and free_blocks[free_index][1] <= start:
+            free_index += 1
+        i = free_index
+        while start < end:
+            if i < len(free_blocks) and free_blocks[i][0] < end:
+                free_start, free_end = free_blocks[i]
+                if free_start > start:
+                    ranges.append((start, free_start))
+                start = max(start, free_end)
+                i += 1
+            else:
+                ranges.append((start, end))
+                break
+
+    # Merge adjacent ranges and split the long ones
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return [
+        (first, min(first + MAX_RANGE_BLOCKS, end) - 1)
+        for start, end in merged
+        for first in range(start, end, MAX_RANGE_BLOCKS)
+    ]
+
+
+def _range_checksum(img_path: str, start: int, end: int) -> str:
+    sha256 = hashlib.sha256()
+    fd = os.open(img_path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset < end:
+            data = os.pread(fd, min(READ_SIZE, end - offset), offset)
+            if not data:
+                break
+            sha256.update(data)
+            offset += len(data)
+    finally:
+        os.close(fd)
+    return sha256.hexdigest()
+
+
+def create_bmap(img_path: str, bmap_path: str = None, block_size: int = BMAP_BLOCK_SIZE,
+                workers: int = None) -> str:
+    """Write a bmaptool compatible block map of an image.
+
+    :param img_path: Path to the .img file.
+    :param bmap_path: Path for the .bmap file, defaults to the image path
+        with a .bmap extension added.
+    :param block_size: Size of the blocks in bytes.
+    :param workers: Number of threads calculating checksums, defaults to
+        the number of CPU cores.
+    :return: Path to the .bmap file.
+    """
+    bmap_path = bmap_path or img_path + ".bmap"
+    image_size = os.path.getsize(img_path)
+    blocks_count = -(-image_size // block_size)
+    ranges = mapped_ranges(img_path, block_size)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        checksums = list(executor.map(
+            lambda r: _range_checksum(img_path, r[0] * block_size, min((r[1] + 1) * block_size, image_size)),
+            ranges,
+        ))
+
+    mapped_count = sum(last - first + 1 for first, last in ranges)
+    range_lines = "\n".join(
+        '        <Range chksum="{}"> {} </Range>'.format(
+            checksum, first if first == last else "{}-{}".format(first, last)
+        ) for (first, last), checksum in zip(ranges, checksums)
+    )
+    bmap_fields = dict(
+        version=BMAP_VERSION,
+        image_size=image_size,
+        image_size_human=_human_size(image_size),
+        block_size=block_size,
+        blocks_count=blocks_count,
+        mapped_count=mapped_count,
+        mapped_human=_human_size(mapped_count * block_size),
+        mapped_percent=100 * mapped_count / blocks_count if blocks_count else 0,
+        ranges=range_lines,
+    )
+    # The file checksum is calculated with the checksum field set to zeros
+    zero_bmap = BMAP_TEMPLATE.format(bmap_checksum="0" * 64, **bmap_fields)
+    bmap_checksum = hashlib.sha256(zero_bmap.encode("utf-8")).hexdigest()
+    with open(bmap_path, "w") as f:
+        f.write(BMAP_TEMPLATE.format(bmap_checksum=bmap_checksum, **bmap_fields))
+    print("Block map saved to {}, {} of {} mapped".format(
+        bmap_path, _human_size(mapped_count * block_size), _human_size(image_size),
+    ))
+    return bmap_path
+
+
+def read_bmap(bmap_path: str):
+    """Read a block map and verify its file checksum.
+
+    :return: Tuple with the image size, block size and a list of
+        (first, last, sha256) ranges.
+    :raises Exception: If the file is not a valid bmap or has been modified.
+    """
+    with open(bmap_path) as f:
+        text = f.read()
+
+    def field(name):
+        match = re.search(r"<{0}>\s*(\S+)\s*</{0}>".format(name), text)
+        if not match:
+            raise Exception("Missing {} in bmap file: {}".format(name, bmap_path))
+        return match.group(1)
+
+    if field("ChecksumType") != "sha256":
+        raise Exception("Only sha256 bmap files are supported: {}".format(bmap_path))
+    bmap_checksum = field("BmapFileChecksum")
+    zero_text = text.replace(bmap_checksum, "0" * len(bmap_checksum), 1)
+    if hashlib.sha256(zero_text.encode("utf-8")).hexdigest() != bmap_checksum:
+        raise Exception("The bmap file checksum does not match: {}".format(bmap_path))
+    ranges = [
+        (int(first), int(last or first), checksum)
+        for checksum, first, last in RANGE_RE.findall(text)
+    ]
+    return int(field("ImageSize")), int(field("BlockSize")), ranges
+
+
+def _check_not_mounted(device: str, mounts_path: str = "/proc/mounts") -> None:
+    """Check that neither the device nor any of its partitions are mounted.
+
+    :raises Exception: If they are.
+    """
+    real_device = os.path.realpath(device)
+    # Partitions of devices ending in a digit have a "p" before their number,
+    # like mmcblk0p1, otherwise only the number, like sda1
+    partition_suffix = r"p\d+" if real_device[-1:].isdigit() else r"\d+"
+    device_re = re.compile(r"{}(?:{})?".format(re.escape(real_device), partition_suffix))
+    try:
+        with open(mounts_path) as f:
+            mounted = [line.split()[0] for line in f if line.strip()]
+    except OSError:
+        return
+    for mount_device in mounted:
+        if device_re.fullmatch(os.path.realpath(mount_device)):
+            raise Exception("{} is mounted, unmount it before flashing".format(mount_device))
+
+
+def flash(img_path: str, device: str, bmap_path: str = None) -> int:
+    """Write only the mapped blocks of an image to a device or file.
+
+    Each range is verified against its checksum before it's written.
+
+    :param img_path: Path to the .img file, or a .img.xz file.
+    :param device: Path to the block device, or to an image file to create.
+    :param bmap_path: Path to the .bmap file, defaults to the image path
+        without the .xz extension and with a .bmap extension added.
+    :return: Number of bytes written.
+    :raises Exception: If a range checksum doesn't match.
+    """
+    if bmap_path is None:
+        bmap_path = (img_path[:-len(".xz")] if img_path.endswith(".xz") else img_path) + ".bmap"
+    image_size, block_size, ranges = read_bmap(bmap_path)
+    _check_not_mounted(device)
+
+    written = 0
+    open_image = lzma.open if img_path.endswith(".xz") else open
+    is_file = not os.path.exists(device) or os.path.isfile(device)
+    fd = os.open(device, os.O_WRONLY | (os.O_CREAT if is_file else 0), 0o644)
+    try:
+        if is_file:
+            os.ftruncate(fd, image_size)
+        with open_image(img_path, "rb") as img:
+            for first, last, checksum in ranges:
+                start = first * block_size
+                end = min((last + 1) * block_size, image_size)
+                img.seek(start)
+                data = img.read(end - start)
+                if hashlib.sha256(data).hexdigest() != checksum:
+                    raise Exception("Checksum mismatch in blocks {}-{} of {}".format(first, last, img_path))
+                os.pwrite(fd, data, start)
+                written += len(data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    print("Flashed {} of {} to {}".format(_human_size(written), _human_size(image_size), device))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create block maps and flash OS images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create_parser = subparsers.add_parser("create", help="Create the .bmap file of an image")
+    create_parser.add_argument("image")
+    create_parser.add_argument("bmap", nargs="?", default=None)
+    flash_parser = subparsers.add_parser("flash", help="Write the mapped blocks of an image")
+    flash_parser.add_argument("image")
+    flash_parser.add_argument("device")
+    flash_parser.add_argument("--bmap", default=None)
+    args = parser.parse_args()
+
+    if args.command == "create":
+        create_bmap(args.image, args.bmap)
+    else:
+        flash(args.image, args.device, args.bmap)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Cache the output image of each customisation step, like Docker layers.
+
+Each layer is keyed by the hash of its parent layer key, the step name, the
+step parameters, the configuration that changes how the steps run, and the
+source code of the module that runs the step and of all the modules of this
+repository it imports. The first layer parent is the SHA256 of the
+downloaded OS image.
+When a step output is cached the step is skipped and the cached image is
+copied into place, so a build that failed half way, or a variant that shares
+steps with a previous one, starts from the deepest cached layer.
+
+The layers are stored with image_cache in a separate directory, so they
+have the same LRU eviction and locking.
+"""
+import os
+import sys
+import json
+import hashlib
+import inspect
+import types
+
+import manifest
+import image_copy
+import image_cache
+import build_trace
+import customise_os
+import qemu_launcher
+
+
+LAYERS_CACHE_DIR = os.path.join(image_cache.CACHE_DIR, "layers")
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_config() -> dict:
+    """Configuration that changes the output of the steps without being one
+    of their parameters."""
+    return {
+        "OFFLINE_EDITS": customise_os.OFFLINE_EDITS,
+        "RPI_OS_LAUNCHER": customise_os.LAUNCHER,
+        "SSH_TRANSPORT": customise_os.SSH_TRANSPORT,
+        "QEMU_MACHINE": qemu_launcher.QEMU_MACHINE,
+    }
+
+
+def _local_modules(module, found: dict) -> None:
+    """Add a module and the modules of this repository it imports, directly
+    or through other local modules, to found as {file name: path}."""
+    try:
+        source_path = os.path.abspath(inspect.getsourcefile(module))
+    except TypeError:
+        return
+    if os.path.dirname(source_path) != REPO_DIR or os.path.basename(source_path) in found:
+        return
+    found[os.path.basename(source_path)] = source_path
+    for value in list(vars(module).values()):
+        if isinstance(value, types.ModuleType):
+            _local_modules(value, found)
+        elif getattr(value, "__module__", None) in sys.modules:
+            # Functions and classes imported with `from module import name`
+            _local_modules(sys.modules[value.__module__], found)
+
+
+def _source_hash(step_fn) -> str:
+    """Hash of the source files a step runs, to invalidate on changes."""
+    module = sys.modules.get(getattr(step_fn, "__module__", None))
+    if module is None:
+        return ""
+    found = {}
+    _local_modules(module, found)
+    source_hash = hashlib.sha256()
+    for file_name, source_path in sorted(found.items()):
+        with open(source_path, "rb") as f:
+            source_hash.update("{}\0{}\0".format(file_name, hashlib.sha256(f.read()).hexdigest()).encode("utf-8"))
+    return source_hash.hexdigest()
+
+
+def layer_key(parent_key: str, step_name: str, params: dict, step_fn=None, config: dict = None) -> str:
+    """Calculate the key of a layer.
+
+    :param parent_key: Key of the parent layer, or the base image SHA256.
+    :param step_name: Name of the customisation step.
+    :param params: JSON serialisable parameters that affect the step output.
+    :param step_fn: Function that runs the step, the source code of its
+        module and the local modules it imports is hashed.
+    :param config: Configuration that affects the step output, defaults to
+        build_config().
+    :return: The hex SHA256 layer key.
+    """
+    layer_info = {
+        "parent": parent_key,
+        "step": step_name,
+        "params": params,
+        "config": build_config() if config is None else config,
+        "code": _source_hash(step_fn) if step_fn else "",
+    }
+    return hashlib.sha256(json.dumps(layer_info, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def run_step(img_path: str, parent_key: str, step_name: str, params: dict, step_fn, cache_dir: str = LAYERS_CACHE_DIR) -> str:
+    """Run a customisation step on an image, or reuse its cached output.
+
+    :param img_path: Path to the image, the step modifies it in place.
+    :param parent_key: Key of the layer the image currently is.
+    :param step_name: Name of the customisation step.
+    :param params: Parameters for step_fn, also part of the layer key.
+    :param step_fn: Function to call as step_fn(img_path, **params).
+    :param cache_dir: Path to the layers cache directory.
+    :return: The key of the new layer, to use as the next parent.
+    """
+    key = layer_key(parent_key, step_name, params, step_fn)
+    with image_cache.lock_entry(key, cache_dir), \
+            build_trace.span("layer {}".format(step_name), "cache", key=key[:16]) as trace_args:
+        entry = image_cache.lookup(key, cache_dir)
+        trace_args["cached"] = bool(entry)
+        if entry:
+            print("Using cached layer for step '{}': {}".format(step_name, key[:16]))
+            os.remove(img_path)
+            image_copy.copy_image(entry.img_path, img_path)
+            manifest.record_changes(img_path, None)
+            return key
+
+        step_fn(img_path, **params)
+
+        # The cache takes ownership of the file, so store a copy
+        layer_img_path = img_path + ".layer"
+        image_copy.copy_image(img_path, layer_img_path)
+        image_cache.store(key, None, layer_img_path, cache_dir)
+    print("Cached layer for step '{}': {}".format(step_name, key[:16]))
+    return key
+
+
+if __name__ == "__main__":
+    image_cache.CACHE_DIR = LAYERS_CACHE_DIR
+    sys.exit(image_cache.main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run the customisation steps of a build and write the image manifests.
+
+Shared by run_all.py, matrix_build.py and recipe_plan.py, so the steps use
+the same layer cache and manifest configuration in all of them.
+"""
+import os
+
+import manifest
+import image_copy
+import build_cache
+import build_trace
+
+
+###############################################################################
+# Configuration data start
+
+# Reuse the cached output of customisation steps from previous builds
+LAYER_CACHE = True
+
+# Create a manifest with the SHA256 of each chunk of the downloaded and
+# custom images, to verify them with `manifest.py verify`
+IMAGE_MANIFESTS = True
+
+# Configuration data end
+###############################################################################
+
+
+def run_step(img_path, parent_key, step_name, step_fn, **params):
+    """Run a customisation step, through the layer cache if enabled.
+
+    qcow2 overlays are not cached, as they depend on their base image.
+    """
+    manifest.track_changes(img_path)
+    if LAYER_CACHE and image_copy.image_format(img_path) == "raw":
+        return build_cache.run_step(img_path, parent_key, step_name, params, step_fn)
+    step_fn(img_path, **params)
+    return None
+
+
+def write_manifest(img_path, parent_img=None):
+    """Create the chunk manifest of an image, if enabled.
+
+    If the image was copied from parent_img before its customisation steps
+    ran, and the byte ranges the steps modified are known, only the chunks
+    in those ranges are hashed to update the parent manifest.
+    qcow2 overlays don't have a manifest until they are flattened.
+    """
+    changed_ranges = manifest.tracked_changes(img_path)
+    if not IMAGE_MANIFESTS or image_copy.image_format(img_path) != "raw":
+        return
+    parent_manifest = parent_img and manifest.manifest_path_for(parent_img)
+    with build_trace.span("manifest", "export") as trace_args:
+        if changed_ranges is not None and parent_manifest and os.path.isfile(parent_manifest):
+            manifest.update_manifest(img_path, parent_manifest, ranges=changed_ranges)
+            trace_args["changed_ranges"] = len(changed_ranges)
+        else:
+            manifest.create_manifest(img_path)
+        trace_args["bytes"] = os.path.getsize(img_path)
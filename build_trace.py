@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Record how long each phase of the image build takes.
+
+Phases are recorded as nested spans, with optional arguments like the
+number of bytes processed, and can be saved in the Chrome trace JSON format
+(open it in chrome://tracing or https://ui.perfetto.dev) or printed as a
+summary table.
+
+The QEMU serial console output can be captured in a ConsoleRingBuffer, which
+only keeps the last part of the output, to be printed if the build fails.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+
+# Max number of characters kept from the serial console output
+CONSOLE_BUFFER_SIZE = 256 * 1024
+
+_start_time = time.perf_counter()
+_spans = []
+_spans_lock = threading.Lock()
+_local = threading.local()
+
+
+def _depth() -> int:
+    return getattr(_local, "depth", 0)
+
+
+def add_span(name: str, start: float, duration: float, category: str = "build", **args) -> None:
+    """Record a span that has already finished.
+
+    :param name: Name of the phase.
+    :param start: Start time, from time.perf_counter().
+    :param duration: Duration in seconds.
+    :param category: Category of the phase, e.g. "download" or "guest".
+    :param args: Extra information to add to the trace, e.g. bytes=1024.
+    """
+    with _spans_lock:
+        _spans.append({
+            "name": name,
+            "cat": category,
+            "start": start - _start_time,
+            "duration": duration,
+            "depth": _depth(),
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+
+@contextmanager
+def span(name: str, category: str = "build", **args):
+    """Record the time spent in a block of code.
+
+    The yielded dictionary can be used to add more arguments before the
+    block finishes, e.g. the number of bytes processed.
+
+    :param name: Name of the phase.
+    :param category: Category of the phase, e.g. "download" or "guest".
+    :param args: Extra information to add to the trace.
+    """
+    start = time.perf_counter()
+    _local.depth = _depth() + 1
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        _local.depth = _depth() - 1
+        add_span(name, start, time.perf_counter() - start, category, **args)
+
+
+def reset() -> None:
+    global _start_time
+    with _spans_lock:
+        _spans.clear()
+        _start_time = time.perf_counter()
+
+
+def chrome_trace() -> dict:
+    """Recorded spans in the Chrome trace event format."""
+    with _spans_lock:
+        spans = list(_spans)
+    return {
+        "traceEvents": [{
+            "name": s["name"],
+            "cat": s["cat"],
+            "ph": "X",
+            "ts": round(s["start"] * 1e6),
+            "dur": round(s["duration"] * 1e6),
+            "pid": os.getpid(),
+            "tid": s["tid"],
+            "args": s["args"],
+        } for s in spans],
+        "displayTimeUnit": "ms",
+    }
+
+
+def write_chrome_trace(path: str) -> None:
+    """Save the recorded spans as a Chrome trace JSON file."""
+    with open(path, "w") as f:
+        json.dump(chrome_trace(), f, indent=1, default=str)
+    print("Build trace saved to: {}".format(path))
+
+
+def summary() -> list:
+    """Recorded spans grouped by name, in the order they first started.
+
+    :return: List of dictionaries with the name, depth, count, total
+        seconds and total bytes of each group.
+    """
+    with _spans_lock:
+        spans = sorted(_spans, key=lambda s: s["start"])
+    groups = collections.OrderedDict()
+    for s in spans:
+        group = groups.setdefault(s["name"], {
+            "name": s["name"], "depth": s["depth"], "count": 0, "seconds": 0.0, "bytes": 0,
+        })
+        group["count"] += 1
+        group["seconds"] += s["duration"]
+        group["bytes"] += s["args"].get("bytes", 0) or 0
+    return list(groups.values())
+
+
+def print_summary(file=sys.stdout) -> None:
+    """Print a table with the time spent in each phase."""
+    rows = summary()
+    if not rows:
+        return
+    name_width = max(len(r["name"]) + r["depth"] * 2 for r in rows)
+    name_width = min(max(name_width, 5), 70)
+    print("\n{:<{w}}  {:>5}  {:>9}  {:>9}  {:>8}".format(
+        "Phase", "Count", "Seconds", "MB", "MB/s", w=name_width,
+    ), file=file)
+    for r in rows:
+        name = ("  " * r["depth"] + r["name"])[:name_width]
+        mb = r["bytes"] / (1024 * 1024)
+        rate = "{:8.1f}".format(mb / r["seconds"]) if r["bytes"] and r["seconds"] else ""
+        print("{:<{w}}  {:>5}  {:>9.1f}  {:>9}  {:>8}".format(
+            name, r["count"], r["seconds"], "{:.1f}".format(mb) if r["bytes"] else "", rate,
+            w=name_width,
+        ), file=file)
+
+
+class ConsoleRingBuffer:
+    """File-like object that keeps only the last part of the text written.
+
+    :param max_size: Max number of characters to keep.
+    """
+
+    def __init__(self, max_size: int = CONSOLE_BUFFER_SIZE):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data: str) -> None:
+        if not data:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.max_size:
+            removed = self.chunks.popleft()
+            self.size -= len(removed)
+            self.dropped += len(removed)
+
+    def flush(self) -> None:
+        pass
+
+    def getvalue(self) -> str:
+        text = "".join(self.chunks)
+        return text[-self.max_size:]
+
+    def dump(self, file=sys.stdout) -> None:
+        """Print the captured console output."""
+        print("\n! Last {} characters of the console output ({} dropped):".format(
+            min(self.size, self.max_size), self.dropped + max(self.size - self.max_size, 0),
+        ), file=file)
+        print(self.getvalue(), file=file)
+        print("! End of console output", file=file)
+
+
+if __name__ == "__main__":
+    # Print the summary of a saved trace file
+    with open(sys.argv[1]) as f:
+        events = sorted(json.load(f)["traceEvents"], key=lambda e: (e["tid"], e["ts"], -e["dur"]))
+    # Rebuild the nesting depth from the spans that contain each other
+    open_span_ends, tid = [], None
+    for event in events:
+        if event["tid"] != tid:
+            open_span_ends, tid = [], event["tid"]
+        while open_span_ends and open_span_ends[-1] <= event["ts"]:
+            open_span_ends.pop()
+        _local.depth = len(open_span_ends)
+        add_span(event["name"], _start_time + event["ts"] / 1e6, event["dur"] / 1e6,
+                 event["cat"], **event["args"])
+        open_span_ends.append(event["ts"] + event["dur"])
+    print_summary()
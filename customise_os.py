@@ -2,14 +2,26 @@
 # -*- coding: utf-8 -*-
 """Run a Raspberry PI OS image with Docker and QEMU to customise it."""
 import os
+import re
 import sys
 import uuid
 import time
-import subprocess
+import base64
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 
 import pexpect
 
+import fat32
+import ext4_edit
+import image_copy
+import guest_ssh
+import manifest
+import build_trace
+import sha512_crypt
+import ram_staging
+import qemu_launcher
+
 
 ###############################################################################
 # Configuration data start
@@ -19,15 +31,68 @@ AUTOLOGIN = True
 SSH = False
 EXPAND_FS = False
 
+# Apply the edits directly to the image filesystem, without booting it,
+# when all the selected features support it
+OFFLINE_EDITS = True
+
+# Print the QEMU serial console output as it arrives, otherwise only the
+# last part is kept and printed if the customisation fails
+ECHO_CONSOLE = False
+
+# How to run the image: "docker" with the dockerpi container, or "qemu" to
+# run qemu-system-arm/aarch64 directly, configured in qemu_launcher.py
+LAUNCHER = os.environ.get("RPI_OS_LAUNCHER", "docker")
+
+# Copy the image to RAM while the guest runs, if there is enough free memory,
+# and write back the changes at the end, configured in ram_staging.py
+RAM_STAGING = os.environ.get("RPI_OS_RAM_STAGING", "0") == "1"
+
+# Once SSH is enabled in the guest, run the commands and copy files over SSH
+# instead of typing them in the serial console, configured in guest_ssh.py
+SSH_TRANSPORT = True
+
 # Configuration data end
 ###############################################################################
 
 DOCKER_IMAGE = "lukechilds/dockerpi:vm"
+# Container port the dockerpi QEMU forwards to the guest SSH port
+DOCKER_GUEST_SSH_PORT = 5022
 
 RPI_OS_USERNAME = "pi"
 RPI_OS_PASSWORD = "raspberry"
 
 BASH_PROMPT = "{}@raspberrypi:~$ ".format(RPI_OS_USERNAME)
+LOGIN_PROMPT = "raspberrypi login: "
+
+# Max seconds from boot to a logged in prompt
+LOGIN_DEADLINE = 15 * 60
+# Console messages printed when the first boot wizard has created the user
+FIRST_BOOT_DONE_MSGS = (
+    "Finished User configuration dialog",
+    "Reached target Multi-User System",
+)
+# Max seconds to wait for those messages after the login prompt is shown
+FIRST_BOOT_MSG_TIMEOUT = 60
+# Console messages printed when the guest kernel has halted, QEMU might not
+# exit on its own after these
+HALTED_MSGS = ("reboot: System halted", "reboot: Power down")
+# Messages of the launchers when the host port for the guest SSH port is
+# already in use, and the first kernel message, printed after it was bound
+PORT_IN_USE_MSGS = (
+    "Could not set up host forwarding rule",
+    "port is already allocated",
+    "address already in use",
+)
+KERNEL_BOOT_MSG = "Booting Linux"
+# Max seconds to wait for those messages, and times to launch the guest
+PORT_IN_USE_TIMEOUT = 10
+LAUNCH_ATTEMPTS = 3
+# Seconds to wait before retrying an incorrect login, doubled on each retry
+LOGIN_RETRY_BACKOFF = 2
+LOGIN_RETRY_BACKOFF_MAX = 30
+
+# Result of a command run in the guest with run_guest_commands()
+CommandResult = guest_ssh.CommandResult
 
 TTY_SERVICE_AUTOLOGIN_CONF ="""[Service]
 ExecStart=
@@ -39,23 +104,26 @@ ExecStart=-/sbin/agetty --autologin {} --keep-baud 115200,38400,9600 %I $TERM
 """.format(RPI_OS_USERNAME)
 
 
+def write_boot_file(img_path, file_name, content=b""):
+    """Create or replace a file in the FAT32 boot partition of the image.
+
+    :param img_path: Path to the Raspberry Pi OS image.
+    :param file_name: Short 8.3 name of the file, e.g. 'ssh'.
+    :param content: Bytes to write in the file.
+    """
+    print("Writing boot partition file: {}".format(file_name))
+    with fat32.Fat32Filesystem(img_path) as boot_fs:
+        boot_fs.write_file(file_name, content)
+
+
 def set_username_password(img_path, username=RPI_OS_USERNAME, password=RPI_OS_PASSWORD):
-    """Create the user and password in the Raspberry Pi OS image."""
-    cmds_to_run = [
-        # Create a userconf file with the username and encrypted password
-        f'echo -n "{username}:" >> userconf',
-        f'echo "{password}" | openssl passwd -6 -stdin | tee -a userconf',
-        # Workout the FAT32 boot filesystem offset (offset in bytes,
-        # fdisk info in sectors) and copy the userconf there
-        f"OFFSET=$(fdisk -lu {img_path} "
-            "| awk '/^Sector size/ {sector_size=$4} /FAT32 \(LBA\)/ {print $2 * sector_size}') && "
-            f"mcopy -o -i {img_path}" "@@${OFFSET} userconf ::/",
-        f"rm -d userconf",
-    ]
+    """Create the user and password in the Raspberry Pi OS image.
 
-    for cmd in cmds_to_run:
-        print(f"Running command: {cmd}")
-        subprocess.run(cmd, shell=True, check=True)
+    The first boot wizard reads the username and encrypted password from
+    a 'userconf' file in the boot partition.
+    """
+    userconf = "{}:{}\n".format(username, sha512_crypt.sha512_crypt(password))
+    write_boot_file(img_path, "userconf", userconf.encode("utf-8"))
 
 
 def launch_docker_spawn(img_path):
@@ -71,6 +139,7 @@ def launch_docker_spawn(img_path):
         raise Exception("Provided OS .img file does not have the right extension: {}".format(img_path))
 
     docker_container_name = "rpi-os-{}".format(str(uuid.uuid4())[:8])
+    ssh_port = guest_ssh.free_port()
     docker_cmd = " ".join([
         "docker",
         "run",
@@ -78,73 +147,369 @@ def launch_docker_spawn(img_path):
         "--rm",
         "--name {}".format(docker_container_name),
         "-v {}:/sdcard/filesystem.img".format(img_path),
+        "-p 127.0.0.1:{}:{}".format(ssh_port, DOCKER_GUEST_SSH_PORT),
         DOCKER_IMAGE
     ])
     print("Docker cmd: {}".format(docker_cmd))
 
     child = pexpect.spawn(docker_cmd, timeout=600, encoding='utf-8')
-    child.logfile = sys.stdout
+    child.logfile = sys.stdout if ECHO_CONSOLE else build_trace.ConsoleRingBuffer()
+    child.ssh_port = ssh_port
 
     return child, docker_container_name
 
 
-def login(child, img_tag):
+def launch_guest(img_path):
+    """Boot the image with the configured LAUNCHER.
+
+    The host port forwarded to the guest SSH port is free when it's picked,
+    but another process can bind it before the launcher does, so the guest
+    is launched again with a new port if the launcher reports it in use.
+
+    :param img_path: Path to the Raspberry Pi OS Lite image to update.
+    :return: The child process and the Docker container name, which is None
+        when QEMU is run directly.
+    """
+    # The guest can write anywhere in the image
+    manifest.record_changes(img_path, None)
+    for attempt in range(1, LAUNCH_ATTEMPTS + 1):
+        if LAUNCHER == "docker":
+            child, docker_container_name = launch_docker_spawn(img_path)
+        elif LAUNCHER == "qemu":
+            child, docker_container_name = qemu_launcher.launch_qemu_spawn(img_path), None
+            child.logfile = sys.stdout if ECHO_CONSOLE else build_trace.ConsoleRingBuffer()
+        else:
+            raise Exception("Unknown launcher: {}".format(LAUNCHER))
+        # Commands go through the serial console until start_ssh_transport()
+        child.guest_ssh = None
+        i = child.expect_exact(
+            [pexpect.TIMEOUT, pexpect.EOF, KERNEL_BOOT_MSG] + list(PORT_IN_USE_MSGS), timeout=PORT_IN_USE_TIMEOUT
+        )
+        if i < 3:
+            return child, docker_container_name
+        print("! SSH port {} is already in use, launching the guest again ({}/{})".format(
+            child.ssh_port, attempt, LAUNCH_ATTEMPTS
+        ))
+        close_guest(child, docker_container_name)
+    raise Exception("Could not launch the guest, the SSH port was in use {} times".format(LAUNCH_ATTEMPTS))
+
+
+def shutdown_guest(child):
+    """Shutdown the guest OS and wait until QEMU exits."""
+    stop_ssh_transport(child)
+    child.sendline("sudo shutdown now")
+    index = child.expect([pexpect.EOF] + list(HALTED_MSGS))
+    if index:
+        # The emulated board can't power off, so exit QEMU from its monitor
+        child.send(qemu_launcher.QEMU_EXIT_KEYS)
+        child.expect(pexpect.EOF, timeout=60)
+    child.wait()
+
+
+def staged_image(img_path):
+    """Context manager with the path of the image the guest should use, a
+    copy in RAM if RAM_STAGING is enabled and there is enough free memory.
+    qcow2 overlays are used in place, they only store the changed blocks.
+
+    :param img_path: Path to the image to customise.
+    """
+    if not RAM_STAGING or image_copy.image_format(img_path) != "raw":
+        return nullcontext(img_path)
+    return ram_staging.staged_image(img_path)
+
+
+def dump_console(child):
+    """Print the console output captured in the ring buffer, if any."""
+    if isinstance(child.logfile, build_trace.ConsoleRingBuffer):
+        child.logfile.dump()
+
+
+def login(child, img_tag=None, deadline=LOGIN_DEADLINE):
     """Login to the Raspberry Pi OS image.
 
     Since the 2022-04 bullseye release the first boot wizard creates an
     an account based from the userconf file in the boot partition.
     This first boot wizard runs in a different session as a different user,
-    so sometimes it can take a while before it's able to create the user and
-    we need to wait before attempting to login.
+    so sometimes it can take a while before it's able to create the user.
+    So we wait for the console messages indicating the first boot services
+    are done, and retry with backoff if the login is still incorrect.
 
     :param child: The pexpect spawn child process to run commands in.
     :param img_tag: The date of the image in YYYY-MM-DD format.
+    :param deadline: Max seconds to wait from boot until logged in.
+    :return: List of timings for each boot and login attempt step.
     """
-    extra_wait_time = True
+    first_boot_wizard = True
     try:
         img_date = datetime.strptime(img_tag, "%Y-%m-%d")
-    except ValueError:
+    except (TypeError, ValueError):
         # Not a valid date to compare, keep default to wait
         pass
     else:
-        # Older releases don't need to wait
+        # Older releases don't have the first boot wizard
         if img_date < datetime(year=2022, month=4, day=1):
-            extra_wait_time = False
+            first_boot_wizard = False
+
+    start_time = time.monotonic()
+
+    def remaining_time():
+        remaining = start_time + deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception("Could not login within {} seconds.".format(deadline))
+        return remaining
+
+    # The first boot messages can come before or after the login prompt
+    timings = []
+    seen_login_prompt, first_boot_done = False, not first_boot_wizard
+    while not (seen_login_prompt and first_boot_done):
+        timeout = remaining_time()
+        if seen_login_prompt:
+            timeout = min(timeout, FIRST_BOOT_MSG_TIMEOUT)
+        i = child.expect_exact(
+            [LOGIN_PROMPT, pexpect.TIMEOUT] + list(FIRST_BOOT_DONE_MSGS), timeout=timeout
+        )
+        if i == 0:
+            seen_login_prompt = True
+            timings.append(("login prompt", time.monotonic() - start_time))
+        elif i == 1:
+            if not seen_login_prompt:
+                raise Exception("Could not login within {} seconds.".format(deadline))
+            # Try to login anyway, it will be retried if the user isn't ready
+            break
+        else:
+            first_boot_done = True
+            timings.append(("first boot done", time.monotonic() - start_time))
+
+    backoff = LOGIN_RETRY_BACKOFF
+    attempt = 0
+    while True:
+        attempt += 1
+        attempt_start = time.monotonic()
+        child.sendline(RPI_OS_USERNAME)
+        child.expect_exact("Password: ", timeout=remaining_time())
+        child.sendline(RPI_OS_PASSWORD)
+        i = child.expect_exact([BASH_PROMPT, "Login incorrect"], timeout=remaining_time())
+        timings.append((
+            "login attempt {} {}".format(attempt, "ok" if i == 0 else "incorrect"),
+            time.monotonic() - attempt_start,
+        ))
+        if i == 0:
+            break
+        time.sleep(min(backoff, remaining_time()))
+        backoff = min(backoff * 2, LOGIN_RETRY_BACKOFF_MAX)
+        child.expect_exact(LOGIN_PROMPT, timeout=remaining_time())
+
+    print("\n! Login timings:")
+    for step, seconds in timings:
+        print("!\t{}: {:.1f}s".format(step, seconds))
+    return timings
+
+
+def run_guest_commands(child, commands, timeout=600, check=True):
+    """Run a list of commands in the guest, in order.
+
+    The commands run over SSH after start_ssh_transport(), otherwise they
+    are typed in the serial console as a single script.
+    It stops at the first command that fails.
+
+    :param child: The pexpect spawn child process to run commands in.
+    :param commands: List of shell commands to run in order.
+    :param timeout: Max seconds to wait for all the commands to finish.
+    :param check: Raise an exception if a command fails or doesn't run.
+    :return: List of CommandResult for the commands that ran.
+    """
+    if getattr(child, "guest_ssh", None):
+        with build_trace.span("guest commands", "guest", commands=len(commands), transport="ssh"):
+            results = child.guest_ssh.run_commands(commands, timeout)
+    else:
+        results = _run_console_commands(child, commands, timeout)
+    if check:
+        _check_results(commands, results)
+    return results
+
+
+def run_guest_commands_parallel(child, commands, timeout=600, check=True):
+    """Run a list of independent commands in the guest at the same time.
+
+    Only over SSH, in the serial console they run in order as in
+    run_guest_commands().
+
+    :return: List of CommandResult for the commands that ran.
+    """
+    if not getattr(child, "guest_ssh", None):
+        return run_guest_commands(child, commands, timeout, check)
+    with build_trace.span("guest commands", "guest", commands=len(commands), transport="ssh", parallel=True):
+        results = child.guest_ssh.run_commands(commands, timeout, parallel=True)
+    if check:
+        _check_results(commands, results)
+    return results
+
+
+def _check_results(commands, results):
+    for result in results:
+        if result.exit_code != 0:
+            raise Exception("Guest command failed with exit code {}: {}\n{}".format(
+                result.exit_code, result.command, result.output
+            ))
+    if len(results) != len(commands):
+        raise Exception("Only {} of {} guest commands ran.".format(len(results), len(commands)))
+
+
+def _run_console_commands(child, commands, timeout=600):
+    """Run a list of commands in the serial console as a single script.
+
+    The script is sent base64 encoded over the console in a heredoc and run
+    with a single wait for the prompt. Each command output is wrapped in
+    unique sentinels with its exit code, so they can be parsed back.
+    The script stops at the first command that fails.
+    """
+    token = "CMD{}".format(uuid.uuid4().hex)
+    script_lines = ["#!/bin/bash", 'rm -f "$0"']
+    for i, cmd in enumerate(commands):
+        # The sentinels include the guest time, to measure each command
+        script_lines += [
+            "printf '\\n%s:start:{}:%s\\n' {} \"$(date +%s.%N)\"".format(i, token),
+            "{{\n{}\n}} 2>&1 < /dev/null".format(cmd),
+            "rc=$?",
+            "printf '\\n%s:end:{}:%d:%s\\n' {} \"$rc\" \"$(date +%s.%N)\"".format(i, token),
+            '[ "$rc" -eq 0 ] || exit "$rc"',
+        ]
+    script = "\n".join(script_lines) + "\n"
+    script_b64 = base64.b64encode(script.encode("utf-8")).decode("ascii")
+
+    script_path = "/tmp/{}.sh".format(token)
+    with build_trace.span("guest commands", "guest", commands=len(commands), transport="serial"):
+        start_time = time.perf_counter()
+        child.sendline("base64 -d > {0} << '{1}_EOF' && bash {0}".format(script_path, token))
+        # Short lines to stay well below the tty line length limit
+        for i in range(0, len(script_b64), 76):
+            child.sendline(script_b64[i:i + 76])
+        child.sendline("{}_EOF".format(token))
+        child.expect_exact(BASH_PROMPT, timeout=timeout)
+        output = child.before
+
+        results = []
+        pattern = re.compile(
+            r"{0}:start:(\d+):([^\r\n]*)\r?\n(.*?)\r?\n{0}:end:\1:(\d+):([^\r\n]*)".format(token),
+            re.DOTALL,
+        )
+        guest_start_time = None
+        for match in pattern.finditer(output):
+            i = int(match.group(1))
+            # The tty adds a \r before each \n, also to the \r\n line endings
+            cmd_output = re.sub(r"\r+\n", "\n", match.group(3)).strip()
+            results.append(CommandResult(commands[i], int(match.group(4)), cmd_output))
+            try:
+                cmd_start, cmd_end = float(match.group(2)), float(match.group(5))
+            except ValueError:
+                continue
+            # Place the guest timings relative to when the script was sent
+            if guest_start_time is None:
+                guest_start_time = cmd_start
+            build_trace.add_span(
+                commands[i][:60], start_time + cmd_start - guest_start_time, cmd_end - cmd_start,
+                "guest", exit_code=int(match.group(4)),
+            )
+    return results
+
 
-    child.expect_exact("raspberrypi login: ")
-    if extra_wait_time:
-        time.sleep(90)
-    child.sendline(RPI_OS_USERNAME)
-    child.expect_exact("Password: ")
-    if extra_wait_time:
-        time.sleep(5)
-    child.sendline(RPI_OS_PASSWORD)
-    child.expect_exact(BASH_PROMPT)
+def write_guest_files(child, files, sudo=False):
+    """Create or replace files in the guest.
+
+    Over SSH all the files are copied in a single tar stream, otherwise
+    each file is sent base64 encoded through the serial console.
+
+    :param child: The pexpect spawn child process to run commands in.
+    :param files: Dictionary of {absolute guest path: content}, where the
+        content is bytes or the path to a local file, which keeps its mode.
+    :param sudo: Write the files as root, otherwise as the guest user.
+    """
+    if getattr(child, "guest_ssh", None):
+        child.guest_ssh.put_files(files, sudo)
+        return
+    sudo_prefix = "sudo " if sudo else ""
+    commands = []
+    for guest_path, content in files.items():
+        mode = None
+        if not isinstance(content, bytes):
+            mode = os.stat(content).st_mode & 0o7777
+            with open(content, "rb") as f:
+                content = f.read()
+        commands += [
+            "{}mkdir -p {}".format(sudo_prefix, os.path.dirname(guest_path)),
+            "echo '{}' | base64 -d | {}tee {} > /dev/null".format(
+                base64.b64encode(content).decode("ascii"), sudo_prefix, guest_path
+            ),
+        ]
+        if mode is not None:
+            commands.append("{}chmod {:o} {}".format(sudo_prefix, mode, guest_path))
+    run_guest_commands(child, commands)
 
 
 def enable_autologin(child):
-    # Setup a service to configure autologin in ttyAMA0, which is what QEMU uses
-    child.sendline("sudo mkdir -pv /etc/systemd/system/serial-getty@ttyAMA0.service.d")
-    child.expect_exact(BASH_PROMPT)
-    child.sendline('echo -en "{}" >> autologin.conf'.format(
-        SERIAL_TTY_SERVICE_AUTOLOGIN_CONF.replace("\n", "\\n"))
-    )
-    child.expect_exact(BASH_PROMPT)
-    child.sendline("sudo mv autologin.conf /etc/systemd/system/serial-getty@ttyAMA0.service.d/autologin.conf")
-    child.expect_exact(BASH_PROMPT)
-    child.sendline("sudo systemctl enable serial-getty@ttyAMA0.service")
-    child.expect_exact(BASH_PROMPT)
-    # Setup a service to autologin in the default tty
-    child.sendline("sudo mkdir -pv /etc/systemd/system/getty@tty1.service.d")
-    child.expect_exact(BASH_PROMPT)
-    child.sendline('echo -en "{}" >> autologin.conf'.format(
-        TTY_SERVICE_AUTOLOGIN_CONF.replace("\n", "\\n"))
-    )
-    child.expect_exact(BASH_PROMPT)
-    child.sendline("sudo mv autologin.conf /etc/systemd/system/getty@tty1.service.d/autologin.conf")
-    child.expect_exact(BASH_PROMPT)
-    child.sendline("sudo systemctl enable getty@tty1.service")
-    child.expect_exact(BASH_PROMPT)
+    write_guest_files(child, {
+        # Setup a service to configure autologin in ttyAMA0, which is what QEMU uses
+        "/etc/systemd/system/serial-getty@ttyAMA0.service.d/autologin.conf":
+            SERIAL_TTY_SERVICE_AUTOLOGIN_CONF.encode("utf-8"),
+        # Setup a service to autologin in the default tty
+        "/etc/systemd/system/getty@tty1.service.d/autologin.conf": TTY_SERVICE_AUTOLOGIN_CONF.encode("utf-8"),
+    }, sudo=True)
+    run_guest_commands(child, [
+        "sudo systemctl enable serial-getty@ttyAMA0.service",
+        "sudo systemctl enable getty@tty1.service",
+    ])
+
+
+def start_ssh_transport(child):
+    """Switch the guest commands from the serial console to SSH.
+
+    Only if SSH_TRANSPORT is enabled, the SSH service is enabled in the
+    guest and the launcher forwarded a host port to it. A temporary key is
+    added to the user authorized_keys over the serial console, and removed
+    by stop_ssh_transport() before shutdown.
+
+    :param child: The pexpect spawn child process to run commands in.
+    :return: True if the commands run over SSH.
+    """
+    if getattr(child, "guest_ssh", None):
+        return True
+    if not SSH_TRANSPORT or not getattr(child, "ssh_port", None):
+        return False
+    ssh = guest_ssh.GuestSsh(child.ssh_port, RPI_OS_USERNAME)
+    commands = [
+        "systemctl is-enabled --quiet ssh",
+        "mkdir -p ~/.ssh && chmod 700 ~/.ssh",
+        "echo '{}' >> ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys".format(ssh.public_key),
+        "sudo systemctl start ssh",
+    ]
+    results = run_guest_commands(child, commands, check=False)
+    if all(r.exit_code == 0 for r in results) and len(results) == len(commands) and ssh.connect():
+        print("Running the guest commands over SSH, port {}".format(child.ssh_port))
+        child.guest_ssh = ssh
+        return True
+    print("SSH is not available in the guest, using the serial console")
+    ssh.close()
+    if len(results) > 2:
+        run_guest_commands(child, [_remove_ssh_key_command(ssh)], check=False)
+    return False
+
+
+def _remove_ssh_key_command(ssh):
+    return (
+        "sed -i '/ {}$/d' ~/.ssh/authorized_keys; "
+        "[ -s ~/.ssh/authorized_keys ] || rm -f ~/.ssh/authorized_keys"
+    ).format(ssh.key_comment)
+
+
+def stop_ssh_transport(child):
+    """Close the SSH connection and remove its key from the guest, so it's
+    not left in the image. The serial console is used from then on."""
+    ssh = getattr(child, "guest_ssh", None)
+    if not ssh:
+        return
+    ssh.close()
+    child.guest_ssh = None
+    run_guest_commands(child, [_remove_ssh_key_command(ssh)])
 
 
 def enable_ssh(child, img_tag):
@@ -168,28 +533,28 @@ def enable_ssh(child, img_tag):
     :param child: The pexpect spawn child process to run commands in.
     :param img_tag: The date of the image in YYYY-MM-DD format.
     """
+    commands = []
     try:
         img_date = datetime.strptime(img_tag, "%Y-%m-%d")
-    except ValueError:
+    except (TypeError, ValueError):
         # Not a valid date to compare, default to the new method
         pass
     else:
         # Old method should still work in older versions where raspi-config might not have 'do_ssh'
         if img_date < datetime(year=2022, month=9, day=26):
-            child.sendline("sudo systemctl enable ssh")
-            child.expect_exact(BASH_PROMPT)
+            run_guest_commands(child, ["sudo systemctl enable ssh"])
             return
         if img_date <= datetime(year=2023, month=2, day=22):
             # For versions between 2022-09-26 and 2023-02-22, we need to
             # update 'raspberrypi-sys-mods' and then run 'raspi-config'
-            child.sendline("sudo apt update -qq")
-            child.expect_exact(BASH_PROMPT)
-            child.sendline("sudo apt install -y raspberrypi-sys-mods")
-            child.expect_exact(BASH_PROMPT)
+            commands += [
+                "sudo apt update -qq",
+                "sudo apt install -y raspberrypi-sys-mods",
+            ]
 
     # Current method uses raspi-config, which should be supported in all buster+ releases
-    child.sendline("sudo raspi-config nonint do_ssh 0")
-    child.expect_exact(BASH_PROMPT)
+    commands.append("sudo raspi-config nonint do_ssh 0")
+    run_guest_commands(child, commands)
 
 
 def expand_root_fs(child, img_tag):
@@ -200,26 +565,81 @@ def expand_root_fs(child, img_tag):
     """
     try:
         img_date = datetime.strptime(img_tag, "%Y-%m-%d")
-    except ValueError:
+    except (TypeError, ValueError):
         # Not a valid date to compare, default to the newer method
         pass
     else:
-        if img_date < datetime(year=2020, month=5, day=1):
+        # The dockerpi guest sees the image as sda instead of an SD card
+        if LAUNCHER == "docker" and img_date < datetime(year=2020, month=5, day=1):
             # Temporary solution for older Raspbian issue: sda2 is not on SD card. Don't know how to expand
             # https://www.raspberrypi.org/forums/viewtopic.php?t=44856#p563673
-            child.sendline("sed -e 's/mmcblk0p/sda/' -e 's/mmcblk0/sda/' /usr/bin/raspi-config > ~/raspi-config")
-            child.expect_exact(BASH_PROMPT)
-            child.sendline("chmod +x ~/raspi-config")
-            child.expect_exact(BASH_PROMPT)
-            child.sendline("sudo ~/raspi-config --expand-rootfs")
-            child.expect_exact(BASH_PROMPT)
-            child.sendline("rm ~/raspi-config")
-            child.expect_exact(BASH_PROMPT)
+            run_guest_commands(child, [
+                "sed -e 's/mmcblk0p/sda/' -e 's/mmcblk0/sda/' /usr/bin/raspi-config > ~/raspi-config",
+                "chmod +x ~/raspi-config",
+                "sudo ~/raspi-config --expand-rootfs",
+                "rm ~/raspi-config",
+            ])
             return
 
     # This simpler method works in any newer release
-    child.sendline("sudo raspi-config --expand-rootfs")
-    child.expect_exact(BASH_PROMPT)
+    run_guest_commands(child, ["sudo raspi-config --expand-rootfs"])
+
+
+def ssh_offline_capable(img_tag):
+    """Check if SSH can be enabled offline, without booting the image.
+
+    Between 2022-09-26 and 2023-02-22 SSH needs 'raspberrypi-sys-mods' to be
+    updated in the running OS (see enable_ssh), and unknown dates might
+    need it too.
+
+    :param img_tag: The date of the image in YYYY-MM-DD format.
+    """
+    try:
+        img_date = datetime.strptime(img_tag, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return False
+    return not (datetime(year=2022, month=9, day=26) <= img_date <= datetime(year=2023, month=2, day=22))
+
+
+def enable_autologin_offline(editor):
+    """Same changes as enable_autologin, edited directly in the root partition.
+
+    :param editor: The ext4_edit.Ext4Editor for the image root partition.
+    """
+    # Autologin in ttyAMA0, which is what QEMU uses
+    editor.mkdir("/etc/systemd/system/serial-getty@ttyAMA0.service.d")
+    editor.write_file(
+        "/etc/systemd/system/serial-getty@ttyAMA0.service.d/autologin.conf",
+        SERIAL_TTY_SERVICE_AUTOLOGIN_CONF,
+    )
+    editor.symlink(
+        "/etc/systemd/system/getty.target.wants/serial-getty@ttyAMA0.service",
+        "/lib/systemd/system/serial-getty@.service",
+    )
+    # Autologin in the default tty
+    editor.mkdir("/etc/systemd/system/getty@tty1.service.d")
+    editor.write_file(
+        "/etc/systemd/system/getty@tty1.service.d/autologin.conf",
+        TTY_SERVICE_AUTOLOGIN_CONF,
+    )
+    editor.symlink(
+        "/etc/systemd/system/getty.target.wants/getty@tty1.service",
+        "/lib/systemd/system/getty@.service",
+    )
+
+
+def enable_ssh_offline(editor):
+    """Enable the SSH service, same as 'systemctl enable ssh'.
+
+    The SSH host keys are generated by Raspberry Pi OS on first boot.
+
+    :param editor: The ext4_edit.Ext4Editor for the image root partition.
+    """
+    editor.symlink(
+        "/etc/systemd/system/multi-user.target.wants/ssh.service",
+        "/lib/systemd/system/ssh.service",
+    )
+    editor.symlink("/etc/systemd/system/sshd.service", "/lib/systemd/system/ssh.service")
 
 
 def close_container(child, docker_container_name):
@@ -244,36 +664,107 @@ def close_container(child, docker_container_name):
             print('! Docker container was already stopped.')
 
 
-def run_edits(img_path, img_tag=None, needs_login=True, autologin=None, ssh=None, expand_fs=None):
-    print("Staring Raspberry Pi OS customisation: {}".format(img_path))
+def close_guest(child, docker_container_name):
+    """Clean up after the guest, however it was launched.
+
+    If the SSH transport is still open, e.g. because a step failed before
+    stop_ssh_transport(), its key is removed from the guest over SSH first,
+    so it's not left in the image.
+    """
+    ssh = getattr(child, "guest_ssh", None)
+    if ssh:
+        try:
+            result = ssh.run(_remove_ssh_key_command(ssh) + " && sync", timeout=30)
+            if result.exit_code != 0:
+                print("! Could not remove the SSH key from the guest:\n{}".format(result.output))
+        except Exception as e:
+            print("! Could not remove the SSH key from the guest: {}".format(e))
+        ssh.close()
+        child.guest_ssh = None
+    if docker_container_name:
+        close_container(child, docker_container_name)
+    else:
+        qemu_launcher.close_qemu(child)
+
 
-    # Since bullseye 2022-04-07 an extra step is needed to create a username and password
-    set_username_password(img_path)
+@contextmanager
+def guest_session(img_path, img_tag=None, needs_login=True, storage="disk"):
+    """Context manager that boots an image and yields the logged in child
+    process, switched to the SSH transport if the guest has SSH enabled.
 
-    # Increase the image by 1 GB using qemu-img
-    if expand_fs or (expand_fs is None and EXPAND_FS):
-        print("Expanding {} image +1GB:".format(img_path))
-        print(pexpect.run("qemu-img resize {} +1G".format(img_path)))
+    When the block ends the guest is shut down. If it raises an exception
+    the console output is printed instead, and the guest is always cleaned up.
 
+    :param img_path: Path to the image to boot, e.g. from staged_image().
+    :param img_tag: The date of the image in YYYY-MM-DD format.
+    :param needs_login: Login with the user and password, otherwise wait
+        for the prompt of an image with autologin.
+    :param storage: Where the image is, "disk" or "ram", for the trace.
+    """
     child, docker_container_name = None, None
     try:
-        child, docker_container_name = launch_docker_spawn(img_path)
-        if needs_login:
-            login(child, img_tag)
-        if autologin or (autologin is None and AUTOLOGIN):
-            enable_autologin(child)
-        if ssh or (ssh is None and SSH):
-            enable_ssh(child, img_tag)
-        if expand_fs or (expand_fs is None and EXPAND_FS):
-            expand_root_fs(child, img_tag)
+        child, docker_container_name = launch_guest(img_path)
+        with build_trace.span("boot and login", "guest", storage=storage):
+            if needs_login:
+                login(child, img_tag)
+            else:
+                child.expect_exact(BASH_PROMPT, timeout=LOGIN_DEADLINE)
+        start_ssh_transport(child)
+        yield child
         # We are done, let's exit
-        child.sendline("sudo shutdown now")
-        child.expect(pexpect.EOF)
-        child.wait()
+        with build_trace.span("shutdown", "guest"):
+            shutdown_guest(child)
+    except Exception:
+        if child:
+            dump_console(child)
+        raise
     # Let ay exceptions bubble up, but ensure clean-up is run
     finally:
         if child:
-            close_container(child, docker_container_name)
+            with build_trace.span("close guest", "guest"):
+                close_guest(child, docker_container_name)
+
+
+def run_edits(img_path, img_tag=None, needs_login=True, autologin=None, ssh=None, expand_fs=None):
+    print("Staring Raspberry Pi OS customisation: {}".format(img_path))
+
+    # Since bullseye 2022-04-07 an extra step is needed to create a username and password,
+    # images without a login prompt were already customised and have one
+    if needs_login:
+        with build_trace.span("set username and password", "offline"):
+            set_username_password(img_path)
+
+    autologin = autologin or (autologin is None and AUTOLOGIN)
+    ssh = ssh or (ssh is None and SSH)
+    expand_fs = expand_fs or (expand_fs is None and EXPAND_FS)
+
+    # If all edits can be done offline there is no need to boot the image
+    if OFFLINE_EDITS and not expand_fs and (not ssh or ssh_offline_capable(img_tag)):
+        print("Editing the image offline, without booting it.")
+        with build_trace.span("offline edits", "offline"), ext4_edit.Ext4Editor(img_path) as editor:
+            if autologin:
+                enable_autologin_offline(editor)
+            if ssh:
+                enable_ssh_offline(editor)
+        return
+
+    with staged_image(img_path) as work_img_path:
+        storage = "disk" if work_img_path == img_path else "ram"
+        # Increase the image by 1 GB using qemu-img
+        if expand_fs:
+            print("Expanding {} image +1GB:".format(work_img_path))
+            with build_trace.span("qemu-img resize", "offline"):
+                print(pexpect.run("qemu-img resize {} +1G".format(work_img_path)))
+
+        with guest_session(work_img_path, img_tag, needs_login, storage) as child:
+            # SSH first, so the rest of the edits can run over it
+            if ssh:
+                enable_ssh(child, img_tag)
+                start_ssh_transport(child)
+            if autologin:
+                enable_autologin(child)
+            if expand_fs:
+                expand_root_fs(child, img_tag)
 
 
 if __name__ == "__main__":
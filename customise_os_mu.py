@@ -6,55 +6,95 @@ apt packages.
 """
 import sys
 
-import pexpect
-
+import apt_cache
+import image_copy
+import build_trace
 import customise_os
 
 
-def install_mu_apt_dependencies(child):
-    child.sendline("df -h")
-    child.expect_exact(customise_os.BASH_PROMPT)
-    child.sendline("sudo apt-get update -qq")
-    child.expect_exact(customise_os.BASH_PROMPT)
-    # Break down the install in multiple commands to kee the time per command low 
-    child.sendline("sudo apt-get install -y xvfb")
-    child.expect_exact(customise_os.BASH_PROMPT, timeout=15*60)
-    child.sendline("sudo apt-get install -y git python3-pip")
-    child.expect_exact(customise_os.BASH_PROMPT)
-    child.sendline("sudo apt-get install -y python3-pyqt5 python3-pyqt5.qtserialport")
-    child.expect_exact(customise_os.BASH_PROMPT, timeout=15*60)
-    child.sendline("sudo apt-get install -y python3-pyqt5.qsci python3-pyqt5.qtsvg")
-    child.expect_exact(customise_os.BASH_PROMPT)
+###############################################################################
+# Configuration data start
+
+# Install the apt packages via a caching proxy running on the host
+APT_CACHE = True
+
+# Configuration data end
+###############################################################################
+
+
+# Address of the host from a QEMU guest with user mode networking
+QEMU_USER_NET_HOST = "10.0.2.2"
+
+
+def start_apt_proxy(img_path):
+    """Start the apt caching proxy for the apt mirrors of an image.
+
+    :param img_path: Path to the image, to read its apt sources.
+    :return: Tuple with the proxy and its URL as seen from the guest, or
+        (None, None) if the guest can't reach it.
+    """
+    if image_copy.image_format(img_path) != "raw":
+        print("The apt sources can't be read from a qcow2 overlay, apt packages will not be cached")
+        return None, None
+    mirror_hosts = apt_cache.mirror_hosts(img_path)
+    if not mirror_hosts:
+        print("No http:// apt sources found in the image, apt packages will not be cached")
+        return None, None
+    if customise_os.LAUNCHER == "qemu":
+        proxy = apt_cache.AptCacheProxy(mirror_hosts, "127.0.0.1")
+        guest_host = QEMU_USER_NET_HOST
+    else:
+        host_address = apt_cache.docker_host_address()
+        if not host_address:
+            print("Docker bridge network not found, apt packages will not be cached")
+            return None, None
+        proxy = apt_cache.AptCacheProxy(mirror_hosts, host_address)
+        guest_host = host_address
+    proxy.start()
+    return proxy, "http://{}:{}".format(guest_host, proxy.server_address[1])
+
+
+def install_mu_apt_dependencies(child, apt_proxy=None, apt_proxy_url=None):
+    if apt_proxy_url:
+        customise_os.run_guest_commands(
+            child, apt_cache.guest_proxy_commands(apt_proxy_url, apt_proxy.mirror_hosts)
+        )
+    customise_os.run_guest_commands(child, [
+        "df -h",
+        "sudo apt-get update -qq",
+        # Break down the install in multiple commands to kee the time per command low
+        "sudo apt-get install -y xvfb",
+        "sudo apt-get install -y git python3-pip",
+        "sudo apt-get install -y python3-pyqt5 python3-pyqt5.qtserialport",
+        "sudo apt-get install -y python3-pyqt5.qsci python3-pyqt5.qtsvg",
+    ], timeout=60*60)
     # Older versions of Raspbian might not have QtChart
-    child.sendline("sudo apt-get install -y python3-pyqt5.qtchart")
-    child.expect_exact(customise_os.BASH_PROMPT)
-    child.sendline(
-        "sudo apt-get install -y libxmlsec1-dev libxml2 libxml2-dev libxkbcommon-x11-0 libatlas-base-dev"
-    )
-    child.expect_exact(customise_os.BASH_PROMPT)
-    child.sendline("df -h")
-    child.expect_exact(customise_os.BASH_PROMPT)
+    customise_os.run_guest_commands(child, ["sudo apt-get install -y python3-pyqt5.qtchart"], check=False)
+    customise_os.run_guest_commands(child, [
+        "sudo apt-get install -y libxmlsec1-dev libxml2 libxml2-dev libxkbcommon-x11-0 libatlas-base-dev",
+        "df -h",
+    ], timeout=30*60)
+    if apt_proxy_url:
+        customise_os.run_guest_commands(child, apt_cache.guest_remove_proxy_commands())
 
 
 def run_edits(img_path, needs_login=True):
     print("Staring Raspberry Pi OS Mu customisation: {}".format(img_path))
 
-    child, docker_container_name = None, None
-    try:
-        child, docker_container_name = customise_os.launch_docker_spawn(img_path)
-        if needs_login:
-            customise_os.login(child)
-        else:
-            child.expect_exact(customise_os.BASH_PROMPT)
-        install_mu_apt_dependencies(child)
-        # We are done, let's exit
-        child.sendline("sudo shutdown now")
-        child.expect(pexpect.EOF)
-        child.wait()
-    # Let ay exceptions bubble up, but ensure clean-up is run
-    finally:
-        if child:
-            customise_os.close_container(child, docker_container_name)
+    with customise_os.staged_image(img_path) as work_img_path:
+        storage = "disk" if work_img_path == img_path else "ram"
+        apt_proxy, apt_proxy_url = None, None
+        try:
+            if APT_CACHE:
+                apt_proxy, apt_proxy_url = start_apt_proxy(img_path)
+            with customise_os.guest_session(work_img_path, needs_login=needs_login, storage=storage) as child:
+                with build_trace.span("install Mu apt packages", "guest", storage=storage) as trace_args:
+                    install_mu_apt_dependencies(child, apt_proxy, apt_proxy_url)
+                    if apt_proxy:
+                        trace_args.update(apt_proxy.stats)
+        finally:
+            if apt_proxy:
+                apt_proxy.stop()
 
 
 if __name__ == "__main__":
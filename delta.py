@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Create and apply block level patches between a base image and a variant.
+
+A patch contains only the blocks of the variant image that differ from the
+base image, compressed with xz, so a device or mirror that already has the
+stock Raspberry Pi OS image only needs the patch to rebuild a custom image.
+
+The images are compared in chunks processed by a thread pool, with only a
+few chunks per thread in memory. The patch stores the SHA256 of each chunk
+of the variant image, so applying it verifies the result, in parallel too.
+
+    python delta.py create base.img custom.img [custom.img.delta]
+    python delta.py apply base.img custom.img.delta custom.img
+
+Patch format, all integers little endian:
+    header: magic, version, block size, chunk size, base size, target size
+    records: for each changed chunk, the number of changed block runs, the
+        (first block, block count) of each run, and the xz compressed blocks
+    index: for each chunk, the record offset and length (0 if the chunk is
+        unchanged) and the SHA256 of the chunk in the target image
+    footer: index offset, magic
+"""
+import os
+import sys
+import lzma
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import export_image
+
+
+DELTA_BLOCK_SIZE = 4096
+DELTA_CHUNK_SIZE = 4 * 1024 * 1024
+DELTA_XZ_PRESET = 6
+
+DELTA_MAGIC = b"RPIDELTA"
+DELTA_VERSION = 1
+HEADER = struct.Struct("<8sHIIQQ")
+INDEX_ENTRY = struct.Struct("<QI32s")
+FOOTER = struct.Struct("<Q8s")
+RUN = struct.Struct("<II")
+ZERO_BLOCK = bytes(DELTA_BLOCK_SIZE)
+
+
+def _read_chunk(fd: int, offset: int, length: int, file_size: int) -> bytes:
+    """Read a chunk of a file, padded with zeros after the end of the file."""
+    data = os.pread(fd, max(0, min(length, file_size - offset)), offset) if offset < file_size else b""
+    return data + bytes(length - len(data))
+
+
+def _diff_worker(base_fd: int, target_fd: int, base_size: int, offset: int, length: int):
+    """Compare a chunk, returns the patch record (or None) and the target SHA256."""
+    base = _read_chunk(base_fd, offset, length, base_size)
+    target = os.pread(target_fd, length, offset)
+    sha256 = hashlib.sha256(target).digest()
+    if base == target:
+        return None, sha256
+
+    runs, changed = [], []
+    base_view, target_view = memoryview(base), memoryview(target)
+    for block_offset in range(0, length, DELTA_BLOCK_SIZE):
+        block_end = block_offset + DELTA_BLOCK_SIZE
+        if base_view[block_offset:block_end] == target_view[block_offset:block_end]:
+            continue
+        block = block_offset // DELTA_BLOCK_SIZE
+        if runs and runs[-1][0] + runs[-1][1] == block:
+            runs[-1][1] += 1
+        else:
+            runs.append([block, 1])
+        changed.append(target_view[block_offset:block_end])
+    record = struct.pack("<I", len(runs)) + b"".join(RUN.pack(*run) for run in runs)
+    record += lzma.compress(b"".join(changed), preset=DELTA_XZ_PRESET)
+    return record, sha256
+
+
+def _patch_worker(base_fd: int, patch_fd: int, out_fd: int, base_size: int, offset: int, length: int,
+                  record_offset: int, record_length: int, sha256: bytes) -> int:
+    """Rebuild and verify a chunk of the target image, returns the bytes written."""
+    chunk = bytearray(_read_chunk(base_fd, offset, length, base_size))
+    if record_length:
+        record = os.pread(patch_fd, record_length, record_offset)
+        runs_count, = struct.unpack_from("<I", record, 0)
+        runs_end = 4 + runs_count * RUN.size
+        changed = lzma.decompress(record[runs_end:])
+        changed_offset = 0
+        for i in range(runs_count):
+            block, count = RUN.unpack_from(record, 4 + i * RUN.size)
+            start = block * DELTA_BLOCK_SIZE
+            end = min(start + count * DELTA_BLOCK_SIZE, length)
+            chunk[start:end] = changed[changed_offset:changed_offset + end - start]
+            changed_offset += end - start
+    if hashlib.sha256(chunk).digest() != sha256:
+        raise Exception("Rebuilt image does not match the patch at offset {}, "
+                        "is the base image the right one?".format(offset))
+    # Keep the output sparse, only the blocks with data are written
+    written = 0
+    view = memoryview(chunk)
+    block_offset = 0
+    while block_offset < length:
+        if view[block_offset:block_offset + DELTA_BLOCK_SIZE] == ZERO_BLOCK[:length - block_offset]:
+            block_offset += DELTA_BLOCK_SIZE
+            continue
+        # Write each run of non-zero blocks at once
+        run_end = block_offset + DELTA_BLOCK_SIZE
+        while run_end < length and view[run_end:run_end + DELTA_BLOCK_SIZE] != ZERO_BLOCK[:length - run_end]:
+            run_end += DELTA_BLOCK_SIZE
+        run_end = min(run_end, length)
+        os.pwrite(out_fd, view[block_offset:run_end], offset + block_offset)
+        written += run_end - block_offset
+        block_offset = run_end
+    return written
+
+
+def create_delta(base_path: str, target_path: str, patch_path: str = None, workers: int = None) -> str:
+    """Write a patch with the blocks of the target image that differ from the base.
+
+    :param base_path: Path to the base image, e.g. the stock OS image.
+    :param target_path: Path to the customised image.
+    :param patch_path: Path for the patch, defaults to the target path with
+        a .delta extension added.
+    :param workers: Number of threads, defaults to the CPU count.
+    :return: Path to the patch file.
+    """
+    patch_path = patch_path or target_path + ".delta"
+    workers = workers or os.cpu_count() or 1
+    base_size = os.path.getsize(base_path)
+    target_size = os.path.getsize(target_path)
+    zero_sha256 = hashlib.sha256(bytes(DELTA_CHUNK_SIZE)).digest()
+
+    base_fd = os.open(base_path, os.O_RDONLY)
+    target_fd = os.open(target_path, os.O_RDONLY)
+    tmp_path = patch_path + ".part"
+    try:
+        base_blocks = export_image.blocks(base_path, DELTA_CHUNK_SIZE)
+
+        def tasks():
+            for offset, length, has_data in export_image.blocks(target_path, DELTA_CHUNK_SIZE):
+                base_has_data = next(base_blocks, (0, 0, False))[2]
+                # Chunks in holes of both images are unchanged, and don't need reading
+                if not has_data and not base_has_data and length == DELTA_CHUNK_SIZE:
+                    yield ((None, zero_sha256),)
+                else:
+                    yield (base_fd, target_fd, base_size, offset, length)
+
+        index = []
+        with open(tmp_path, "wb") as f, ThreadPoolExecutor(max_workers=workers) as executor:
+            f.write(HEADER.pack(
+                DELTA_MAGIC, DELTA_VERSION, DELTA_BLOCK_SIZE, DELTA_CHUNK_SIZE, base_size, target_size,
+            ))
+            for record, sha256 in export_image.ordered_results(executor, _diff_worker, tasks(), workers):
+                if record is None:
+                    index.append(INDEX_ENTRY.pack(0, 0, sha256))
+                else:
+                    index.append(INDEX_ENTRY.pack(f.tell(), len(record), sha256))
+                    f.write(record)
+            index_offset = f.tell()
+            f.write(b"".join(index))
+            f.write(FOOTER.pack(index_offset, DELTA_MAGIC))
+        os.replace(tmp_path, patch_path)
+    finally:
+        os.close(base_fd)
+        os.close(target_fd)
+    print("Patch {} is {:.1f}MB for a {:.1f}MB image".format(
+        patch_path, os.path.getsize(patch_path) / (1024 * 1024), target_size / (1024 * 1024),
+    ))
+    return patch_path
+
+
+def apply_delta(base_path: str, patch_path: str, out_path: str, workers: int = None) -> str:
+    """Rebuild a customised image from the base image and a patch.
+
+    Each chunk of the output is verified against the SHA256 in the patch.
+
+    :param base_path: Path to the base image the patch was created from.
+    :param patch_path: Path to the patch file.
+    :param out_path: Path for the rebuilt image.
+    :param workers: Number of threads, defaults to the CPU count.
+    :raises Exception: If the patch is invalid or the result doesn't match.
+    :return: Path to the rebuilt image.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(patch_path, "rb") as f:
+        magic, version, block_size, chunk_size, base_size, target_size = HEADER.unpack(f.read(HEADER.size))
+        f.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, footer_magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != DELTA_MAGIC or footer_magic != DELTA_MAGIC or version != DELTA_VERSION:
+            raise Exception("Not a valid image patch file: {}".format(patch_path))
+        if block_size != DELTA_BLOCK_SIZE or chunk_size != DELTA_CHUNK_SIZE:
+            raise Exception("Unsupported block or chunk size in patch: {}".format(patch_path))
+        f.seek(index_offset)
+        index = f.read(os.path.getsize(patch_path) - FOOTER.size - index_offset)
+    if os.path.getsize(base_path) != base_size:
+        raise Exception("Base image {} is not the one the patch was created from".format(base_path))
+
+    base_fd = os.open(base_path, os.O_RDONLY)
+    patch_fd = os.open(patch_path, os.O_RDONLY)
+    tmp_path = out_path + ".part"
+    out_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(out_fd, target_size)
+
+        def tasks():
+            for i, offset in enumerate(range(0, target_size, chunk_size)):
+                record_offset, record_length, sha256 = INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+                yield (base_fd, patch_fd, out_fd, base_size, offset, min(chunk_size, target_size - offset),
+                       record_offset, record_length, sha256)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            written = sum(export_image.ordered_results(executor, _patch_worker, tasks(), workers))
+        os.fsync(out_fd)
+    except Exception:
+        os.close(out_fd)
+        os.remove(tmp_path)
+        raise
+    else:
+        os.close(out_fd)
+    finally:
+        os.close(base_fd)
+        os.close(patch_fd)
+    os.replace(tmp_path, out_path)
+    print("Rebuilt and verified {}, {:.1f}MB written".format(out_path, written / (1024 * 1024)))
+    return out_path
+
+
+def main():
+    usage = "Usage:\n\tdelta.py create base.img custom.img [patch]\n\tdelta.py apply base.img patch out.img"
+    if len(sys.argv) < 4 or sys.argv[1] not in ("create", "apply"):
+        print(usage)
+        return 1
+    if sys.argv[1] == "create":
+        create_delta(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+    else:
+        if len(sys.argv) < 5:
+            print(usage)
+            return 1
+        apply_delta(sys.argv[2], sys.argv[3], sys.argv[4])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
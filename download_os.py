@@ -3,13 +3,28 @@
 """Download a Raspberry PI OS image."""
 import os
 import sys
+import time
 import lzma
+import zlib
+import queue
+import struct
+import json
 import hashlib
-from typing import Optional
+import resource
+import threading
+from typing import Optional, Tuple
 from zipfile import ZipFile
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import image_copy
+import image_cache
+import build_trace
+import release_catalog
 
 
 ###############################################################################
@@ -18,6 +33,22 @@ import requests
 DEFAULT_IMG_RELEASE = "bookworm"
 DEFAULT_IMG_TAG = "2023-10-10"
 
+# Download, verify and decompress in a single pass, without saving the
+# compressed file to disk
+DOWNLOAD_PIPELINE = False
+
+# Keep verified images in the local image_cache, to skip downloading and
+# decompressing them again in the next run
+IMAGE_CACHE = True
+
+# Number of concurrent HTTP Range requests to download the image, if the
+# server supports it, 0 to always download in a single stream
+DOWNLOAD_SEGMENTS = 4
+
+# Find the images in the downloads server index pages, with the OS_IMGS
+# dictionary as a fallback, and keep the published hashes in the catalog
+RELEASE_CATALOG = True
+
 # Configuration data end
 ###############################################################################
 
@@ -25,6 +56,25 @@ IMAGE_SAVE_LOCATION = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "rpiosimage"
 )
 
+# Size of the chunks read from the network and written to disk
+DOWNLOAD_CHUNK_SIZE = 10 * 1024 * 1024
+# Segmented downloads save progress after each chunk of this size
+DOWNLOAD_RANGE_CHUNK_SIZE = 1024 * 1024
+# Retries for failed connections, with exponential backoff
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_BACKOFF = 1
+# Segmented downloads flush the data and save the progress after this many
+# bytes of each segment
+DOWNLOAD_STATE_SAVE_SIZE = 8 * 1024 * 1024
+# Seconds without receiving data before a connection is considered dropped
+DOWNLOAD_TIMEOUT = 60
+# Size of the decompressed chunks held in memory while decompressing
+DECOMPRESS_CHUNK_SIZE = 16 * 1024 * 1024
+# All-zero blocks of this size are not written to the decompressed image
+SPARSE_BLOCK_SIZE = 4096
+# Max number of downloaded chunks waiting to be decompressed in the pipeline
+PIPELINE_QUEUE_CHUNKS = 4
+
 # NamedTuple of a img URL and its SHA256 hash
 ImageURL = namedtuple("ImageURL", ["url", "sha256_url"])
 
@@ -139,10 +189,335 @@ OS_IMGS = {
 DEFAULT_IMAGE_URL = OS_IMGS[DEFAULT_IMG_RELEASE][DEFAULT_IMG_TAG]
 
 
-def download_compressed_image(img: ImageURL = DEFAULT_IMAGE_URL) -> str:
+_session = None
+
+
+def get_session() -> requests.Session:
+    """Shared HTTP session, so connections are pooled between requests.
+
+    Connection errors and 5xx responses are retried with backoff.
+    """
+    global _session
+    if _session is None:
+        retries = Retry(
+            total=DOWNLOAD_RETRIES, backoff_factor=1,
+            status_forcelist=(500, 502, 503, 504),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=max(DOWNLOAD_SEGMENTS, 1) + 2,
+            max_retries=retries,
+        )
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def fetch_sha256(sha256_url: str) -> str:
+    """Fetch the published SHA256 hash from a .sha256 sidecar URL.
+
+    :param sha256_url: URL to the .sha256 file, in `sha256sum` format.
+    :return: The lowercase hex SHA256 hash.
+    """
+    # Released images never change, so their hashes are stored in the catalog
+    if RELEASE_CATALOG and sha256_url.startswith(release_catalog.CATALOG_BASE_URL):
+        with build_trace.span("fetch sha256", "download"):
+            return release_catalog.published_sha256(sha256_url, get_session())
+    with build_trace.span("fetch sha256", "download"):
+        response = get_session().get(sha256_url)
+    if response.status_code != 200:
+        raise Exception("Could not reach the SHA256 file URL, error code {}: {}".format(
+            response.status_code, sha256_url
+        ))
+    return response.text.split()[0].lower()
+
+
+def list_images() -> dict:
+    """All the known images, from the release catalog and OS_IMGS.
+
+    :return: Dictionary of {release: {tag: ImageURL}}.
+    """
+    images = {release: dict(tags) for release, tags in OS_IMGS.items()}
+    if RELEASE_CATALOG:
+        try:
+            catalog_images = release_catalog.list_images(session=get_session())
+        except Exception as e:
+            print("Release catalog not available, using the known images list: {}".format(e))
+        else:
+            for release, tags in catalog_images.items():
+                for tag, img in tags.items():
+                    images.setdefault(release, {})[tag] = ImageURL(*img)
+    return images
+
+
+def resolve_image(release: str = DEFAULT_IMG_RELEASE, tag: str = DEFAULT_IMG_TAG) -> ImageURL:
+    """Find the URLs of an image, in the release catalog or OS_IMGS.
+
+    :param release: Release name, e.g. 'bookworm' or 'bullseye-legacy'.
+    :param tag: Date tag of the release, or 'latest' for the newest one.
+    :raises Exception: If the image can't be found.
+    """
+    if RELEASE_CATALOG:
+        try:
+            tags = release_catalog.list_images(release, session=get_session()).get(release, {})
+            if tag == "latest" and tags:
+                tag = max(tags)
+            if tag in tags:
+                return ImageURL(*tags[tag])
+        except Exception as e:
+            print("Release catalog not available, using the known images list: {}".format(e))
+    tags = OS_IMGS.get(release, {})
+    if tag == "latest" and tags:
+        tag = max(tags)
+    if tag not in tags:
+        raise Exception("Image not found: {} {}".format(release, tag))
+    return tags[tag]
+
+
+def peak_memory_mb() -> float:
+    """Peak resident memory of this process in MB.
+
+    `ru_maxrss` is in KB on Linux and in bytes on macOS.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss /= 1024
+    return max_rss / 1024
+
+
+def get_range_support(url: str) -> Optional[int]:
+    """Check if the server can serve byte ranges of the file.
+
+    :param url: URL of the file to download.
+    :return: The file size if ranges are supported, None otherwise.
+    """
+    response = get_session().head(url, allow_redirects=True)
+    if response.status_code != 200:
+        return None
+    if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    try:
+        size = int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+    return size if size > 0 else None
+
+
+def _load_segments_state(state_path: str, url: str, size: int) -> Optional[list]:
+    """Load the segments of an interrupted download, if it's the same file."""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("size") != size:
+        return None
+    return state.get("segments")
+
+
+def _save_segments_state(state_path: str, url: str, size: int, segments: list) -> None:
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"url": url, "size": size, "segments": segments}, f)
+    os.replace(tmp_path, state_path)
+
+
+class _PrefixHasher:
+    """SHA256 of a file being downloaded in segments, updated as the start
+    of the file is completed.
+
+    The data after the hashed prefix is read back from the file, while it's
+    still in the page cache, as soon as the segments before it complete.
+    """
+
+    def __init__(self, file_path: str, segments: list):
+        self.file_path = file_path
+        self.segments = segments
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def update(self, blocking: bool = False) -> None:
+        """Hash the downloaded data that follows the hashed prefix.
+
+        :param blocking: Wait if another thread is hashing, otherwise return
+            and let that thread hash the new data.
+        """
+        if not self.lock.acquire(blocking=blocking):
+            return
+        try:
+            # Unbuffered reads, a read ahead buffer could hold the data of a
+            # range that is still being downloaded
+            fd = os.open(self.file_path, os.O_RDONLY)
+            try:
+                for start, end, next_offset in self.segments:
+                    if self.offset >= end:
+                        continue
+                    while self.offset < next_offset:
+                        chunk = os.pread(fd, min(DOWNLOAD_CHUNK_SIZE, next_offset - self.offset), self.offset)
+                        self.hasher.update(chunk)
+                        self.offset += len(chunk)
+                    if self.offset < end:
+                        break
+            finally:
+                os.close(fd)
+        finally:
+            self.lock.release()
+
+    def hexdigest(self) -> str:
+        self.update(blocking=True)
+        return self.hasher.hexdigest()
+
+
+def download_segments(url: str, file_path: str, size: int,
+                      segments_num: int = DOWNLOAD_SEGMENTS) -> Tuple[int, str]:
+    """Download a file with concurrent HTTP Range requests.
+
+    The file is preallocated and each segment is written in place. Progress
+    is saved into a `.state` file next to it, after the data is flushed to
+    disk, so running this again after an interruption only downloads the
+    missing ranges.
+    A segment that drops its connection is retried from where it stopped.
+
+    :param url: URL of the file to download, the server must support ranges.
+    :param file_path: Path to write the downloaded file to.
+    :param size: Size of the file in bytes.
+    :param segments_num: Number of segments to download concurrently.
+    :return: Number of bytes downloaded in this run, and the SHA256 hash of
+        the file.
+    """
+    state_path = file_path + ".state"
+    segments = None
+    if os.path.exists(file_path) and os.path.getsize(file_path) == size:
+        segments = _load_segments_state(state_path, url, size)
+        if segments:
+            print("\t-> Resuming download, {}MB left".format(
+                sum(end - next_offset for _, end, next_offset in segments) // (1024 * 1024)
+            ))
+    if not segments:
+        segment_size = -(-size // max(segments_num, 1))
+        # Each segment is [start, end (exclusive), next offset to download]
+        segments = [
+            [start, min(start + segment_size, size), start]
+            for start in range(0, size, segment_size)
+        ]
+        with open(file_path, "wb") as f:
+            f.truncate(size)
+    _save_segments_state(state_path, url, size, segments)
+
+    state_lock = threading.Lock()
+    downloaded_bytes = [0]
+    # A resumed download hashes its already downloaded prefix here
+    hasher = _PrefixHasher(file_path, segments)
+    hasher.update()
+
+    def save_state(f):
+        """Flush the data before saving the state, so the state file never
+        gets ahead of the data on disk."""
+        with state_lock:
+            saved_segments = [list(segment) for segment in segments]
+        os.fsync(f.fileno())
+        with state_lock:
+            _save_segments_state(state_path, url, size, saved_segments)
+
+    def download_segment(segment):
+        _, end, _ = segment
+        attempt = 0
+        unsaved_bytes = 0
+        # Unbuffered, so the data is in the file when the state is saved
+        with open(file_path, "r+b", buffering=0) as f:
+            while segment[2] < end:
+                attempt_start = segment[2]
+                try:
+                    response = get_session().get(
+                        url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                        headers={"Range": "bytes={}-{}".format(segment[2], end - 1)},
+                    )
+                    if response.status_code != 206:
+                        raise Exception("Range request failed, error code {}: {}".format(
+                            response.status_code, url
+                        ))
+                    f.seek(segment[2])
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_RANGE_CHUNK_SIZE):
+                        chunk = chunk[:end - segment[2]]
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        with state_lock:
+                            segment[2] += len(chunk)
+                            downloaded_bytes[0] += len(chunk)
+                        unsaved_bytes += len(chunk)
+                        if unsaved_bytes >= DOWNLOAD_STATE_SAVE_SIZE:
+                            save_state(f)
+                            unsaved_bytes = 0
+                        hasher.update()
+                        if segment[2] >= end:
+                            break
+                    response.close()
+                    if segment[2] < end:
+                        raise requests.exceptions.ConnectionError(
+                            "Connection closed before the end of the range"
+                        )
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout) as e:
+                    save_state(f)
+                    unsaved_bytes = 0
+                    # Only give up on connections that make no progress
+                    attempt = 1 if segment[2] > attempt_start else attempt + 1
+                    if attempt > DOWNLOAD_RETRIES:
+                        raise
+                    print("\t-> Segment at {} interrupted, retrying: {}".format(segment[2], e))
+                    time.sleep(min(DOWNLOAD_RETRY_BACKOFF * 2 ** attempt, 30))
+
+    pending = [segment for segment in segments if segment[2] < segment[1]]
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        futures = [executor.submit(download_segment, segment) for segment in pending]
+        while not all(future.done() for future in futures):
+            time.sleep(0.5)
+            print("\t-> Downloaded {}MB...".format(downloaded_bytes[0] // (1024 * 1024)), end="\r")
+        for future in futures:
+            # Raise the first segment exception, the state file is kept to resume
+            future.result()
+    file_hash = hasher.hexdigest()
+    os.remove(state_path)
+    return downloaded_bytes[0], file_hash
+
+
+def download_stream(url: str, file_path: str) -> Tuple[int, str]:
+    """Download a file in a single stream, hashing it chunk by chunk.
+
+    :param url: URL of the file to download.
+    :param file_path: Path to write the downloaded file to.
+    :return: Number of bytes downloaded and the SHA256 hash of the file.
+    """
+    response = get_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception("Could not reach the file URL, error code {}: {}".format(
+            response.status_code, url
+        ))
+    hasher = hashlib.sha256()
+    downloaded_bytes = 0
+    with open(file_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:
+                f.write(chunk)
+                hasher.update(chunk)
+                downloaded_bytes += len(chunk)
+                print("\t-> Downloaded {}MB...".format(downloaded_bytes // (1024 * 1024)), end='\r')
+    return downloaded_bytes, hasher.hexdigest()
+
+
+def download_compressed_image(img: ImageURL = DEFAULT_IMAGE_URL, sha_hash: Optional[str] = None) -> str:
     """Download a compressed image from the internet.
 
+    If the server supports HTTP ranges the file is downloaded in concurrent
+    segments, and an interrupted download is resumed on the next run.
+    Otherwise it's downloaded in a single stream. Either way the SHA256 hash
+    is calculated as the data arrives.
+
     :param img: URL to the compressed file and sha256 to download.
+    :param sha_hash: Expected SHA256 hash, fetched from img if not provided.
     :return: Absolute path to the downloaded compressed file.
     """
     print("Downloading OS image: {}".format(img.url))
@@ -155,38 +530,121 @@ def download_compressed_image(img: ImageURL = DEFAULT_IMAGE_URL) -> str:
         os.makedirs(IMAGE_SAVE_LOCATION)
     compressed_img_filename = os.path.join(IMAGE_SAVE_LOCATION, img.url.split('/')[-1])
 
-    response = requests.get(img.url, stream=True)
-    if response.status_code != 200:
-        raise Exception("Could not reach the file URL, error code {}: {}".format(
-            response.status_code, img.url
-        ))
-    with open(compressed_img_filename, 'wb') as f:
-        for i, chunk in enumerate(response.iter_content(chunk_size=10*1024*1024)):
-            if chunk:
-                print("\t-> Downloaded {}0MB...".format(i), end='\r')
-                f.write(chunk)
+    # Get the expected hash first, so it's not worth downloading if missing
+    if not sha_hash:
+        sha_hash = fetch_sha256(img.sha256_url)
+    print("Expected SHA256 hash: {}".format(sha_hash))
+
+    start_time = time.monotonic()
+    size = get_range_support(img.url) if DOWNLOAD_SEGMENTS > 0 else None
+    if size:
+        partial_filename = compressed_img_filename + ".part"
+        with build_trace.span("download", "download", segments=DOWNLOAD_SEGMENTS) as trace_args:
+            downloaded_bytes, file_hash = download_segments(img.url, partial_filename, size)
+            trace_args["bytes"] = downloaded_bytes
+        os.replace(partial_filename, compressed_img_filename)
+    else:
+        print("\t-> Server does not support ranges, using a single stream")
+        with build_trace.span("download", "download", segments=1) as trace_args:
+            downloaded_bytes, file_hash = download_stream(img.url, compressed_img_filename)
+            trace_args["bytes"] = downloaded_bytes
+    elapsed_time = max(time.monotonic() - start_time, 1e-6)
     print("\nDownload done!                  ")
+    print("\t-> {:.1f}MB in {:.1f}s ({:.1f}MB/s), peak memory {:.1f}MB".format(
+        downloaded_bytes / (1024 * 1024), elapsed_time,
+        downloaded_bytes / (1024 * 1024) / elapsed_time, peak_memory_mb(),
+    ))
 
     print("Verifying SHA256 hash...  ", end="")
-    with open(compressed_img_filename, 'rb') as img_f:
-        img_data = img_f.read()
-    response = requests.get(img.sha256_url)
-    if response.status_code != 200:
-        raise Exception("Could not reach the SHA256 file URL, error code {}: {}".format(
-            response.status_code, img.sha256_url
-        ))
-    sha_hash = response.text.split()[0]
-    print(sha_hash)
-    if sha_hash != hashlib.sha256(img_data).hexdigest():
+    if sha_hash != file_hash:
+        os.remove(compressed_img_filename)
         raise Exception("SHA256 hash does not match the file.")
     print("SHA256 hash verified!")
 
     return os.path.abspath(compressed_img_filename)
 
 
+class SparseWriter:
+    """File writer that seeks over all-zero blocks instead of writing them.
+
+    Data is buffered so that the zero check is done on blocks aligned to the
+    start of the file, which is where the filesystem allocates its blocks.
+    The file is truncated to its full size on close, so trailing holes are
+    still part of the file.
+    """
+
+    def __init__(self, file_obj, block_size: int = SPARSE_BLOCK_SIZE):
+        self.file_obj = file_obj
+        self.block_size = block_size
+        self.zero_block = bytes(block_size)
+        self.buffer = bytearray()
+        self.size = 0
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        full_blocks_len = len(self.buffer) - (len(self.buffer) % self.block_size)
+        if full_blocks_len:
+            self._flush_blocks(memoryview(self.buffer)[:full_blocks_len])
+            del self.buffer[:full_blocks_len]
+
+    def close(self) -> None:
+        if self.buffer:
+            self._flush_blocks(memoryview(self.buffer))
+            self.buffer = bytearray()
+        self.file_obj.truncate(self.size)
+
+    def _flush_blocks(self, view: memoryview) -> None:
+        # Coalesce consecutive data blocks into a single write
+        data_start = None
+        for offset in range(0, len(view), self.block_size):
+            block = view[offset:offset + self.block_size]
+            if block == self.zero_block[:len(block)]:
+                if data_start is not None:
+                    self._write_at(view[data_start:offset], data_start)
+                    data_start = None
+            elif data_start is None:
+                data_start = offset
+        if data_start is not None:
+            self._write_at(view[data_start:], data_start)
+        self.size += len(view)
+
+    def _write_at(self, data: memoryview, view_offset: int) -> None:
+        self.file_obj.seek(self.size + view_offset)
+        self.file_obj.write(data)
+        self.bytes_written += len(data)
+
+
+def copy_to_sparse_file(src_f, img_path: str) -> None:
+    """Copy a readable file object into a sparse file, chunk by chunk.
+
+    :param src_f: Readable binary file object, e.g. from lzma or zip.
+    :param img_path: Path to the output file.
+    """
+    start_time = time.monotonic()
+    with build_trace.span("decompress", "decompress") as trace_args, open(img_path, "wb") as img_f:
+        writer = SparseWriter(img_f)
+        while True:
+            chunk = src_f.read(DECOMPRESS_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+        writer.close()
+        trace_args["bytes"] = writer.size
+        trace_args["bytes_written"] = writer.bytes_written
+    elapsed_time = max(time.monotonic() - start_time, 1e-6)
+    print("\t-> {:.1f}MB image, {:.1f}MB written to disk in {:.1f}s, peak memory {:.1f}MB".format(
+        writer.size / (1024 * 1024), writer.bytes_written / (1024 * 1024),
+        elapsed_time, peak_memory_mb(),
+    ))
+
+
 def decompress_image(compressed_path: str) -> str:
     """Decompress a file with a img file inside.
 
+    The image is decompressed in chunks with bounded memory, and all-zero
+    blocks are skipped, so the resulting .img file is sparse.
+
     :param compressed_path: Path to the zip or xz file to decompress.
     :raises Exception: If there is no .img file inside the compressed file.
     :return: Absolute path to an uncompressed .img file from the zip.
@@ -197,31 +655,311 @@ def decompress_image(compressed_path: str) -> str:
         os.makedirs(IMAGE_SAVE_LOCATION)
     if compressed_path.endswith(".zip"):
         with ZipFile(compressed_path, "r") as z:
-            name_list = z.namelist()
-            z.extractall(path=IMAGE_SAVE_LOCATION)
-        for file_name in name_list:
-            if file_name.endswith('.img'):
-                img_path = os.path.abspath(os.path.join(IMAGE_SAVE_LOCATION, file_name))
-                break
-        else:
-            raise Exception("Could not find img file inside zip")
+            for file_name in z.namelist():
+                if file_name.endswith('.img'):
+                    break
+            else:
+                raise Exception("Could not find img file inside zip")
+            img_path = os.path.abspath(
+                os.path.join(IMAGE_SAVE_LOCATION, os.path.basename(file_name))
+            )
+            with z.open(file_name) as zip_img_f:
+                copy_to_sparse_file(zip_img_f, img_path)
     elif compressed_path.endswith(".xz"):
         img_filename = os.path.basename(compressed_path)[:-len(".xz")]
-        img_path = os.path.join(IMAGE_SAVE_LOCATION, img_filename)
-        with lzma.open(compressed_path) as xz_f, open(img_path, 'wb') as img_f:
-            img_f.write(xz_f.read())
+        img_path = os.path.abspath(os.path.join(IMAGE_SAVE_LOCATION, img_filename))
+        with lzma.open(compressed_path) as xz_f:
+            copy_to_sparse_file(xz_f, img_path)
     else:
         raise Exception("Provided file is not a zip or xz file.")
     print("Decompression done!")
     return img_path
 
 
+class XzStreamDecompressor:
+    """Decompress an xz stream as the compressed data is fed in."""
+
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor()
+
+    def feed(self, data: bytes):
+        """Yield decompressed chunks of at most DECOMPRESS_CHUNK_SIZE bytes."""
+        while data:
+            if self.decompressor.eof:
+                # Concatenated xz streams can be separated by null padding
+                data = data.lstrip(b"\x00")
+                if not data:
+                    return
+                self.decompressor = lzma.LZMADecompressor()
+            chunk = self.decompressor.decompress(data, max_length=DECOMPRESS_CHUNK_SIZE)
+            data = b""
+            if chunk:
+                yield chunk
+            while not self.decompressor.eof and not self.decompressor.needs_input:
+                chunk = self.decompressor.decompress(b"", max_length=DECOMPRESS_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+
+    def finish(self) -> None:
+        if not self.decompressor.eof:
+            raise Exception("Compressed xz stream ended unexpectedly.")
+
+
+class ZipStreamDecompressor:
+    """Extract the first .img member of a zip file as the data is fed in.
+
+    A zip file can be read front to back using the local file headers, as
+    long as any member before the .img file has its compressed size in the
+    header.
+    """
+
+    LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+    LOCAL_HEADER_SIGNATURE = 0x04034b50
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = "header"
+        self.skip_bytes = 0
+        self.stored_bytes = 0
+        self.decompressor = None
+
+    def feed(self, data: bytes):
+        """Yield decompressed chunks of at most DECOMPRESS_CHUNK_SIZE bytes."""
+        self.buffer += data
+        while self.buffer:
+            if self.state == "header":
+                if not self._parse_header():
+                    return
+            elif self.state == "skip":
+                skipped = min(self.skip_bytes, len(self.buffer))
+                del self.buffer[:skipped]
+                self.skip_bytes -= skipped
+                if not self.skip_bytes:
+                    self.state = "header"
+            elif self.state == "stored":
+                chunk_len = min(self.stored_bytes, len(self.buffer), DECOMPRESS_CHUNK_SIZE)
+                yield bytes(self.buffer[:chunk_len])
+                del self.buffer[:chunk_len]
+                self.stored_bytes -= chunk_len
+                if not self.stored_bytes:
+                    self.state = "done"
+            elif self.state == "deflated":
+                data = bytes(self.buffer)
+                self.buffer = bytearray()
+                while data and not self.decompressor.eof:
+                    chunk = self.decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+                    data = self.decompressor.unconsumed_tail
+                    if chunk:
+                        yield chunk
+                if self.decompressor.eof:
+                    self.state = "done"
+            else:
+                # Anything after the .img file is not needed
+                self.buffer = bytearray()
+
+    def finish(self) -> None:
+        if self.state == "header":
+            raise Exception("Could not find img file inside zip")
+        if self.state != "done":
+            raise Exception("Compressed zip stream ended unexpectedly.")
+
+    def _parse_header(self) -> bool:
+        """Parse a local file header from the buffer, if it's all there."""
+        if len(self.buffer) < self.LOCAL_HEADER.size:
+            return False
+        (signature, _, flags, method, _, _, _, compressed_size, _,
+            name_len, extra_len) = self.LOCAL_HEADER.unpack_from(self.buffer)
+        if signature != self.LOCAL_HEADER_SIGNATURE:
+            # Reached the central directory without finding the img file
+            raise Exception("Could not find img file inside zip")
+        header_len = self.LOCAL_HEADER.size + name_len + extra_len
+        if len(self.buffer) < header_len:
+            return False
+        file_name = bytes(
+            self.buffer[self.LOCAL_HEADER.size:self.LOCAL_HEADER.size + name_len]
+        ).decode("utf-8", errors="replace")
+        del self.buffer[:header_len]
+
+        # Bit 3 indicates the sizes are only known after the data
+        size_known = not (flags & 0x08) and compressed_size != 0xFFFFFFFF
+        if file_name.endswith(".img"):
+            if method == 8:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.state = "deflated"
+            elif method == 0 and size_known:
+                self.stored_bytes = compressed_size
+                self.state = "stored" if compressed_size else "done"
+            else:
+                raise Exception("Unsupported compression in zip img file: {}".format(method))
+        elif size_known:
+            self.skip_bytes = compressed_size
+            self.state = "skip" if compressed_size else "header"
+        else:
+            raise Exception("Cannot stream zip file with a member of unknown size: {}".format(file_name))
+        return True
+
+
+def download_decompress_image(img: ImageURL = DEFAULT_IMAGE_URL, sha_hash: Optional[str] = None) -> str:
+    """Download, verify and decompress an image in a single pass.
+
+    The compressed file is never saved to disk, a download thread hashes
+    each chunk and hands it over to this thread, which decompresses it into
+    a sparse .img file as it arrives.
+    If the SHA256 hash doesn't match the .img file is deleted.
+
+    :param img: URL to the compressed file and sha256 to download.
+    :param sha_hash: Expected SHA256 hash, fetched from img if not provided.
+    :return: Absolute path to the decompressed .img file.
+    """
+    print("Downloading and decompressing OS image: {}".format(img.url))
+    if not img.url.startswith("http"):
+        raise Exception("Provided URL must be a zip/xz file.")
+    if img.url.endswith(".zip"):
+        decompressor = ZipStreamDecompressor()
+        img_filename = os.path.basename(img.url)[:-len(".zip")] + ".img"
+    elif img.url.endswith(".xz"):
+        decompressor = XzStreamDecompressor()
+        img_filename = os.path.basename(img.url)[:-len(".xz")]
+    else:
+        raise Exception("Provided URL must be a zip/xz file.")
+
+    if not os.path.exists(IMAGE_SAVE_LOCATION):
+        os.makedirs(IMAGE_SAVE_LOCATION)
+    img_path = os.path.abspath(os.path.join(IMAGE_SAVE_LOCATION, img_filename))
+
+    if not sha_hash:
+        sha_hash = fetch_sha256(img.sha256_url)
+    print("Expected SHA256 hash: {}".format(sha_hash))
+
+    response = get_session().get(img.url, stream=True)
+    if response.status_code != 200:
+        raise Exception("Could not reach the file URL, error code {}: {}".format(
+            response.status_code, img.url
+        ))
+
+    # The download thread puts chunks, an exception, or None when finished
+    chunk_queue = queue.Queue(maxsize=PIPELINE_QUEUE_CHUNKS)
+    stop_download = threading.Event()
+    hasher = hashlib.sha256()
+    downloaded_bytes = [0]
+
+    def download_worker():
+        try:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if stop_download.is_set():
+                    return
+                if chunk:
+                    hasher.update(chunk)
+                    downloaded_bytes[0] += len(chunk)
+                    chunk_queue.put(chunk)
+            chunk_queue.put(None)
+        except Exception as e:
+            chunk_queue.put(e)
+
+    start_time = time.monotonic()
+    download_thread = threading.Thread(target=download_worker, daemon=True)
+    download_thread.start()
+    try:
+        with build_trace.span("download and decompress", "download") as trace_args, \
+                open(img_path, "wb") as img_f:
+            writer = SparseWriter(img_f)
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for img_chunk in decompressor.feed(chunk):
+                    writer.write(img_chunk)
+                print("\t-> Downloaded {}MB...".format(downloaded_bytes[0] // (1024 * 1024)), end="\r")
+            decompressor.finish()
+            writer.close()
+            trace_args["bytes"] = downloaded_bytes[0]
+            trace_args["image_bytes"] = writer.size
+            trace_args["bytes_written"] = writer.bytes_written
+        print("\nDownload and decompression done!")
+
+        print("Verifying SHA256 hash...  ", end="")
+        if sha_hash != hasher.hexdigest():
+            raise Exception("SHA256 hash does not match the file.")
+        print("SHA256 hash verified!")
+    except BaseException:
+        stop_download.set()
+        # Unblock the download thread if it's waiting on a full queue
+        while download_thread.is_alive():
+            try:
+                chunk_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        response.close()
+        if os.path.exists(img_path):
+            os.remove(img_path)
+        raise
+    download_thread.join()
+
+    elapsed_time = max(time.monotonic() - start_time, 1e-6)
+    print("\t-> {:.1f}MB downloaded, {:.1f}MB image, {:.1f}MB written in {:.1f}s "
+          "({:.1f}MB/s), peak memory {:.1f}MB".format(
+        downloaded_bytes[0] / (1024 * 1024), writer.size / (1024 * 1024),
+        writer.bytes_written / (1024 * 1024), elapsed_time,
+        downloaded_bytes[0] / (1024 * 1024) / elapsed_time, peak_memory_mb(),
+    ))
+    return img_path
+
+
+def image_sha256(img: ImageURL) -> str:
+    """Published SHA256 hash of an image, from the image cache if the image
+    is cached, so a cache hit doesn't need the network."""
+    sha_hash = image_cache.lookup_url(img.url) if IMAGE_CACHE else None
+    return sha_hash or fetch_sha256(img.sha256_url)
+
+
+def get_image(img: ImageURL = DEFAULT_IMAGE_URL, save_dir: Optional[str] = None) -> str:
+    """Get a decompressed image, from the local image cache if available.
+
+    On a cache miss the image is downloaded, decompressed and added to the
+    cache. Either way a copy-on-write or sparse copy of the cached .img is
+    placed in IMAGE_SAVE_LOCATION, so it can be modified without affecting
+    the cache.
+
+    :param img: URL to the compressed file and sha256 to download.
+    :param save_dir: Directory for the .img copy, IMAGE_SAVE_LOCATION if None.
+    :return: Absolute path to the decompressed .img file.
+    """
+    if not IMAGE_CACHE:
+        if DOWNLOAD_PIPELINE:
+            return download_decompress_image(img)
+        return decompress_image(download_compressed_image(img))
+
+    sha_hash = image_sha256(img)
+    with image_cache.lock_entry(sha_hash):
+        entry = image_cache.lookup(sha_hash)
+        if entry:
+            build_trace.add_span("image cache hit", time.perf_counter(), 0, "download")
+            print("Using cached OS image: {}".format(entry.img_path))
+        else:
+            if DOWNLOAD_PIPELINE:
+                compressed_path = None
+                img_path = download_decompress_image(img, sha_hash)
+            else:
+                compressed_path = download_compressed_image(img, sha_hash)
+                img_path = decompress_image(compressed_path)
+            entry = image_cache.store(sha_hash, compressed_path, img_path, url=img.url)
+        save_dir = save_dir or IMAGE_SAVE_LOCATION
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        img_path = os.path.join(save_dir, os.path.basename(entry.img_path))
+        image_copy.copy_image(entry.img_path, img_path)
+    return img_path
+
+
 def main(img_zip_url: Optional[ImageURL] = None):
-    compressed_path = download_compressed_image(img_zip_url)
-    img_path = decompress_image(compressed_path)
+    img_path = get_image(img_zip_url or resolve_image())
     return 0
 
 
 if __name__ == "__main__":
     # We only use the first argument to receive a URL to the .img file
-    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_IMAGE_URL))
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else None))
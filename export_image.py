@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compress OS images into .xz or .zip files using all the CPU cores.
+
+The image is split into blocks that are compressed in parallel by a process
+pool, and then written in order with the SHA256 of the output calculated as
+it's written. Blocks inside holes of a sparse image, or full of zeros, reuse
+a compressed zero block instead of being compressed again.
+
+The .xz output is a single stream with one block per image block, like
+`xz -T0` creates, and the .zip output is a single deflate stream built from
+independently compressed chunks, like `pigz`. Both can be decompressed by
+the standard tools.
+"""
+import os
+import sys
+import lzma
+import zlib
+import time
+import bisect
+import struct
+import hashlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import fat32
+import image_copy
+
+
+# Same as the `xz -T0` default block size, 3 times the preset 6 dictionary size
+XZ_BLOCK_SIZE = 24 * 1024 * 1024
+XZ_PRESET = 6
+ZIP_BLOCK_SIZE = 8 * 1024 * 1024
+ZIP_LEVEL = 6
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_STREAM_FLAGS = b"\x00\x04"  # CRC64 check
+XZ_FOOTER_MAGIC = b"YZ"
+
+ZIP64_VERSION = 45
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_DEFLATED = 8
+ZIP64_EXTRA_ID = 0x0001
+ZIP_32BIT_MAX = 0xFFFFFFFF
+
+
+def _read_block(img_path: str, offset: int, length: int) -> bytes:
+    with open(img_path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _decode_vli(data: bytes, pos: int):
+    """Decode an xz variable length integer, returns (value, next_pos)."""
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_vli(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _xz_compress_block(data: bytes, preset: int):
+    """Compress data into a single xz block.
+
+    :return: Tuple with the block bytes, including padding, the unpadded
+        block size and the uncompressed size, for the stream index.
+    """
+    stream = lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=preset)
+    # The stream footer has the index size, and the index has the block sizes
+    index_size = (struct.unpack("<I", stream[-8:-4])[0] + 1) * 4
+    index = stream[-12 - index_size:-12]
+    records, pos = _decode_vli(index, 1)
+    if index[0] != 0 or records != 1:
+        raise Exception("Unexpected xz index with {} blocks".format(records))
+    unpadded_size, pos = _decode_vli(index, pos)
+    uncompressed_size, pos = _decode_vli(index, pos)
+    return stream[12:-12 - index_size], unpadded_size, uncompressed_size
+
+
+def _xz_worker(img_path: str, offset: int, length: int, preset: int):
+    data = _read_block(img_path, offset, length)
+    return _xz_compress_block(data, preset)
+
+
+def _deflate_chunk(data: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # A sync flush ends the chunk on a byte boundary, so chunks can be joined
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _zip_worker(img_path: str, offset: int, length: int, level: int, last: bool):
+    data = _read_block(img_path, offset, length)
+    zdict = b""
+    # Zero chunks are compressed without a dictionary, so they are all the same
+    if offset and data.count(0) != len(data):
+        zdict = _read_block(img_path, offset - DEFLATE_WINDOW_SIZE, DEFLATE_WINDOW_SIZE)
+    return _deflate_chunk(data, zdict, level, last), zlib.crc32(data), len(data)
+
+
+def _gf2_matrix_times(matrix, vector: int) -> int:
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """CRC32 of two concatenated blocks of data, same as zlib crc32_combine()."""
+    if len2 <= 0:
+        return crc1
+    # Operator for one zero bit, then square it to get the two and four bits ones
+    odd = [0xEDB88320] + [1 << i for i in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    # Apply len2 zero bytes to crc1
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+class _HashingWriter:
+    """Write to a file and calculate the SHA256 of everything written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> None:
+        self.f.write(data)
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+
+
+def blocks(img_path: str, block_size: int):
+    """Yield (offset, length, has_data) for each block of an image."""
+    size = os.path.getsize(img_path)
+    fd = os.open(img_path, os.O_RDONLY)
+    try:
+        regions = list(image_copy.data_regions(fd, size))
+    finally:
+        os.close(fd)
+    region_ends = [end for _, end in regions]
+    for offset in range(0, size, block_size):
+        length = min(block_size, size - offset)
+        # First data region that ends after the block start
+        i = bisect.bisect_right(region_ends, offset)
+        has_data = i < len(regions) and regions[i][0] < offset + length
+        yield offset, length, has_data
+
+
+def ordered_results(executor, worker, tasks, max_workers: int):
+    """Submit tasks to the pool and yield the results in order.
+
+    Only a few blocks per worker are in flight, to limit the memory used.
+    Tasks can also be a (result,) tuple instead of arguments to skip the pool.
+    """
+    in_flight = collections.deque()
+    for task in tasks:
+        if len(in_flight) >= max_workers * 2:
+            yield in_flight.popleft().result()
+        if isinstance(task, tuple) and len(task) == 1:
+            in_flight.append(_DoneFuture(task[0]))
+        else:
+            in_flight.append(executor.submit(worker, *task))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+class _DoneFuture:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+def _write_xz(img_path: str, out: _HashingWriter, executor, workers: int) -> None:
+    zero_block = _xz_compress_block(bytes(XZ_BLOCK_SIZE), XZ_PRESET)
+
+    def tasks():
+        for offset, length, has_data in blocks(img_path, XZ_BLOCK_SIZE):
+            if not has_data and length == XZ_BLOCK_SIZE:
+                yield (zero_block,)
+            else:
+                yield (img_path, offset, length, XZ_PRESET)
+
+    out.write(XZ_HEADER_MAGIC + XZ_STREAM_FLAGS + struct.pack("<I", zlib.crc32(XZ_STREAM_FLAGS)))
+    index_records = []
+    for block, unpadded_size, uncompressed_size in ordered_results(executor, _xz_worker, tasks(), workers):
+        out.write(block)
+        index_records.append(_encode_vli(unpadded_size) + _encode_vli(uncompressed_size))
+
+    index = b"\x00" + _encode_vli(len(index_records)) + b"".join(index_records)
+    index += bytes(-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+    out.write(index)
+    footer = struct.pack("<I", len(index) // 4 - 1) + XZ_STREAM_FLAGS
+    out.write(struct.pack("<I", zlib.crc32(footer)) + footer + XZ_FOOTER_MAGIC)
+
+
+def _write_zip(img_path: str, out: _HashingWriter, executor, workers: int) -> None:
+    zero_chunk = (
+        _deflate_chunk(bytes(ZIP_BLOCK_SIZE), b"", ZIP_LEVEL, False),
+        zlib.crc32(bytes(ZIP_BLOCK_SIZE)),
+        ZIP_BLOCK_SIZE,
+    )
+    size = os.path.getsize(img_path)
+
+    def tasks():
+        for offset, length, has_data in blocks(img_path, ZIP_BLOCK_SIZE):
+            last = offset + length >= size
+            if not has_data and not last:
+                yield (zero_chunk,)
+            else:
+                yield (img_path, offset, length, ZIP_LEVEL, last)
+
+    name = os.path.basename(img_path).encode("utf-8")
+    dos_date, dos_time = fat32.dos_date_time(os.path.getmtime(img_path))
+    # The sizes and CRC are in the data descriptor after the data, so the
+    # output is written in a single pass without seeking back
+    local_extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, 0, 0)
+    out.write(struct.pack(
+        "<IHHHHHIIIHH", 0x04034b50, ZIP64_VERSION, ZIP_FLAG_DATA_DESCRIPTOR, ZIP_DEFLATED,
+        dos_time, dos_date, 0, ZIP_32BIT_MAX, ZIP_32BIT_MAX, len(name), len(local_extra),
+    ) + name + local_extra)
+    data_offset = out.bytes_written
+
+    crc = 0
+    if not size:
+        out.write(_deflate_chunk(b"", b"", ZIP_LEVEL, True))
+    for chunk, chunk_crc, chunk_len in ordered_results(executor, _zip_worker, tasks(), workers):
+        out.write(chunk)
+        crc = crc32_combine(crc, chunk_crc, chunk_len)
+    compressed_size = out.bytes_written - data_offset
+    out.write(struct.pack("<IIQQ", 0x08074b50, crc, compressed_size, size))
+
+    cd_offset = out.bytes_written
+    cd_extra = struct.pack("<HHQQQ", ZIP64_EXTRA_ID, 24, size, compressed_size, 0)
+    out.write(struct.pack(
+        "<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION,
+        ZIP_FLAG_DATA_DESCRIPTOR, ZIP_DEFLATED, dos_time, dos_date, crc,
+        ZIP_32BIT_MAX, ZIP_32BIT_MAX, len(name), len(cd_extra), 0, 0, 0, 0o100644 << 16,
+        ZIP_32BIT_MAX,
+    ) + name + cd_extra)
+    cd_size = out.bytes_written - cd_offset
+
+    zip64_eocd_offset = out.bytes_written
+    out.write(struct.pack(
+        "<IQHHIIQQQQ", 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0, 1, 1, cd_size, cd_offset,
+    ))
+    out.write(struct.pack("<IIQI", 0x07064b50, 0, zip64_eocd_offset, 1))
+    out.write(struct.pack(
+        "<IHHHHIIH", 0x06054b50, 0, 0, 1, 1, min(cd_size, ZIP_32BIT_MAX),
+        min(cd_offset, ZIP_32BIT_MAX), 0,
+    ))
+
+
+def export_image(img_path: str, fmt: str = "xz", out_path: str = None, workers: int = None) -> str:
+    """Compress an image and write the .sha256 file of the output.
+
+    :param img_path: Path to the .img file.
+    :param fmt: Output format, "xz" or "zip".
+    :param out_path: Output file, defaults to the image path with the format
+        extension added (xz) or replacing .img (zip).
+    :param workers: Number of compression processes, defaults to the CPU count.
+    :return: The path to the compressed file.
+    """
+    writers = {"xz": _write_xz, "zip": _write_zip}
+    if fmt not in writers:
+        raise Exception("Unsupported export format: {}".format(fmt))
+    if not out_path:
+        if fmt == "xz":
+            out_path = img_path + ".xz"
+        else:
+            out_path = (img_path[:-4] if img_path.endswith(".img") else img_path) + ".zip"
+    workers = workers or os.cpu_count() or 1
+
+    print("Compressing {} into {} with {} processes".format(img_path, out_path, workers))
+    start_time = time.monotonic()
+    tmp_path = out_path + ".part"
+    with open(tmp_path, "wb") as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        out = _HashingWriter(f)
+        writers[fmt](img_path, out, executor, workers)
+    os.replace(tmp_path, out_path)
+
+    sha256 = out.sha256.hexdigest()
+    with open(out_path + ".sha256", "w") as f:
+        f.write("{}  {}\n".format(sha256, os.path.basename(out_path)))
+    print("Compressed {:.1f}MB into {:.1f}MB in {:.1f}s, SHA256: {}".format(
+        os.path.getsize(img_path) / (1024 * 1024), out.bytes_written / (1024 * 1024),
+        time.monotonic() - start_time, sha256,
+    ))
+    return out_path
+
+
+def main():
+    img_path = sys.argv[1]
+    fmt = sys.argv[2] if len(sys.argv) > 2 else "xz"
+    export_image(img_path, fmt)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
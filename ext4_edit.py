@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Edit files in the ext4 root partition of an OS image without booting it.
+
+The edits are queued and then applied in a single `debugfs` batch, directly
+on the partition inside the .img file, so no loop devices, mounts or root
+permissions are needed.
+"""
+import os
+import struct
+import posixpath
+import subprocess
+import tempfile
+from typing import List, Optional, Tuple
+
+import manifest
+import partitions
+
+
+# debugfs error messages that are expected when the edits are idempotent
+IGNORED_DEBUGFS_ERRORS = (
+    "File not found by ext2_lookup",
+)
+
+# debugfs undo file, which has a key with the position of every block the
+# edits overwrite, see undo_io.c in e2fsprogs
+UNDO_MAGIC = b"E2UNDO02"
+# magic, keys, superblock copy block, first key block, block size
+UNDO_HEADER = struct.Struct("<8sQQQI")
+UNDO_KEY_BLOCK_MAGIC = 0xCADECADE
+UNDO_KEY_BLOCK = struct.Struct("<IIQ")
+# filesystem block, CRC32C, size in bytes
+UNDO_KEY = struct.Struct("<QII")
+# The primary superblock is saved in the header instead of with a key
+EXT4_SUPERBLOCK_RANGE = (1024, 2048)
+
+
+def _undo_file_ranges(undo_path: str, fs_offset: int) -> Optional[List[Tuple[int, int]]]:
+    """Byte ranges of an image written by debugfs, from its undo file.
+
+    :param undo_path: Path to the undo file debugfs wrote with -z.
+    :param fs_offset: Offset of the filesystem in the image.
+    :return: List of (start, end) ranges, or None if the undo file can't
+        be read.
+    """
+    try:
+        with open(undo_path, "rb") as f:
+            undo = f.read()
+    except FileNotFoundError:
+        return None
+    if len(undo) < UNDO_HEADER.size:
+        return None
+    magic, keys_count, _, key_offset, block_size = UNDO_HEADER.unpack_from(undo, 0)
+    if magic != UNDO_MAGIC or not block_size:
+        return None
+
+    ranges = [(fs_offset + EXT4_SUPERBLOCK_RANGE[0], fs_offset + EXT4_SUPERBLOCK_RANGE[1])]
+    keys_per_block = (block_size - UNDO_KEY_BLOCK.size) // UNDO_KEY.size
+    offset = key_offset * block_size
+    while keys_count:
+        if offset + block_size > len(undo) or \
+                UNDO_KEY_BLOCK.unpack_from(undo, offset)[0] != UNDO_KEY_BLOCK_MAGIC:
+            return None
+        # Each key block is followed by the old data of its blocks
+        data_blocks = 0
+        for i in range(min(keys_count, keys_per_block)):
+            block, _, size = UNDO_KEY.unpack_from(undo, offset + UNDO_KEY_BLOCK.size + i * UNDO_KEY.size)
+            ranges.append((fs_offset + block * block_size, fs_offset + block * block_size + size))
+            data_blocks += -(-size // block_size)
+        keys_count -= min(keys_count, keys_per_block)
+        offset += (1 + data_blocks) * block_size
+    return ranges
+
+
+class Ext4Editor:
+    """Queue file edits to an ext4 partition and apply them with debugfs.
+
+    Files and directories are created as owned by root, as they would be
+    if created with sudo in the running OS.
+
+    :param img_path: Path to the .img file.
+    :param partition: Partition to edit, defaults to the root partition.
+    """
+
+    def __init__(self, img_path: str, partition: partitions.Partition = None):
+        self.img_path = os.path.abspath(img_path)
+        self.partition = partition or partitions.root_partition(self.img_path)
+        self.commands = []  # type: List[str]
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="ext4-edit-")
+        self.tmp_files = 0
+        # Directories known to exist, or queued to be created
+        self.dirs = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.apply()
+        finally:
+            self.tmp_dir.cleanup()
+
+    @staticmethod
+    def _quote(path: str) -> str:
+        if '"' in path:
+            raise Exception("Paths with quotes are not supported: {}".format(path))
+        return '"{}"'.format(path)
+
+    def _set_owner_mode(self, path: str, mode: int) -> None:
+        self.commands += [
+            "sif {} mode 0{:o}".format(self._quote(path), mode),
+            "sif {} uid 0".format(self._quote(path)),
+            "sif {} gid 0".format(self._quote(path)),
+        ]
+
+    def mkdir(self, path: str, mode: int = 0o755) -> None:
+        """Create a directory and any missing parents, like `mkdir -p`."""
+        parts = [part for part in path.split("/") if part]
+        for i in range(1, len(parts) + 1):
+            dir_path = "/" + "/".join(parts[:i])
+            if dir_path in self.dirs:
+                continue
+            # debugfs mkdir on an existing directory corrupts the filesystem
+            if not self.exists(dir_path):
+                self.commands.append("mkdir {}".format(self._quote(dir_path)))
+                self._set_owner_mode(dir_path, 0o040000 | mode)
+            self.dirs.add(dir_path)
+
+    def write_file(self, path: str, content: str, mode: int = 0o644) -> None:
+        """Create or replace a file, its directory has to exist."""
+        self.tmp_files += 1
+        local_path = os.path.join(self.tmp_dir.name, str(self.tmp_files))
+        with open(local_path, "w") as f:
+            f.write(content)
+        self.commands += [
+            "rm {}".format(self._quote(path)),
+            "write {} {}".format(self._quote(local_path), self._quote(path)),
+        ]
+        self._set_owner_mode(path, 0o100000 | mode)
+
+    def symlink(self, path: str, target: str) -> None:
+        """Create or replace a symbolic link, like `ln -sf target path`."""
+        self.mkdir(posixpath.dirname(path))
+        self.commands += [
+            "rm {}".format(self._quote(path)),
+            "symlink {} {}".format(self._quote(path), self._quote(target)),
+        ]
+
+    def apply(self) -> None:
+        """Run all the queued edits in a single debugfs invocation.
+
+        :raises Exception: If debugfs fails or reports an unexpected error.
+        """
+        if not self.commands:
+            return
+        device = "{}?offset={}".format(self.img_path, self.partition.offset)
+        cmd_file_path = os.path.join(self.tmp_dir.name, "commands")
+        with open(cmd_file_path, "w") as f:
+            f.write("\n".join(self.commands) + "\n")
+        cmd = ["debugfs", "-w", "-f", cmd_file_path, device]
+        # The undo file records the blocks written, to update the image
+        # manifest. debugfs reads the superblock copy for it at twice the
+        # partition offset, and fails if that is past the end of the image
+        undo_path = None
+        if 2 * self.partition.offset + EXT4_SUPERBLOCK_RANGE[1] <= os.path.getsize(self.img_path):
+            undo_path = os.path.join(self.tmp_dir.name, "undo")
+            cmd[2:2] = ["-z", undo_path]
+        print("Applying {} debugfs edits to {}".format(len(self.commands), device))
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        # If debugfs failed the undo file might not have all the keys
+        changed_ranges = None
+        if undo_path and result.returncode == 0:
+            changed_ranges = _undo_file_ranges(undo_path, self.partition.offset)
+        if undo_path and os.path.exists(undo_path):
+            os.remove(undo_path)
+        manifest.record_changes(self.img_path, changed_ranges)
+        errors = [
+            line for line in result.stderr.splitlines()
+            if line.strip() and not line.startswith("debugfs ")
+            and not any(ignored in line for ignored in IGNORED_DEBUGFS_ERRORS)
+        ]
+        if result.returncode != 0 or errors:
+            raise Exception("debugfs failed with exit code {}:\n{}".format(
+                result.returncode, "\n".join(errors) or result.stderr
+            ))
+        self.commands = []
+
+    def dump(self, path: str) -> str:
+        """Copy a file or directory from the partition, ignoring queued edits.
+
+        :return: Local path of the copy, in the editor temporary directory,
+            which doesn't exist if the path wasn't found in the partition.
+        """
+        device = "{}?offset={}".format(self.img_path, self.partition.offset)
+        dest_dir = tempfile.mkdtemp(dir=self.tmp_dir.name)
+        subprocess.run(
+            ["debugfs", "-R", "rdump {} {}".format(self._quote(path), self._quote(dest_dir)), device],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return os.path.join(dest_dir, posixpath.basename(path.rstrip("/")))
+
+    def exists(self, path: str) -> bool:
+        """Check if a path exists in the partition, ignoring queued edits."""
+        device = "{}?offset={}".format(self.img_path, self.partition.offset)
+        result = subprocess.run(
+            ["debugfs", "-R", "stat {}".format(self._quote(path)), device],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        return result.returncode == 0 and "File not found" not in result.stderr
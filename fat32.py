@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read and write files in the root directory of a FAT32 partition.
+
+This is a small FAT32 implementation to drop configuration files, like
+`userconf` or `ssh`, into the boot partition of an OS image in place, and
+to read files from it. Only the root directory is supported and new files
+need to have a short 8.3 name.
+"""
+import sys
+import time
+import struct
+from typing import Dict, List
+
+import manifest
+import partitions
+
+
+FAT_ENTRY_MASK = 0x0FFFFFFF
+FAT_END_OF_CHAIN = 0x0FFFFFF8
+FAT_EOC_MARK = 0x0FFFFFFF
+FAT_FREE = 0
+
+DIR_ENTRY = struct.Struct("<11sBBBHHHHHHHI")
+DIR_ENTRY_SIZE = 32
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+DELETED_ENTRY = 0xE5
+# Flags in the reserved byte used by Windows NT and Linux for lowercase names
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXT = 0x10
+
+SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+
+
+def _short_name(file_name: str):
+    """Convert a file name into a 8.3 directory entry name and case flags.
+
+    :raises Exception: If the name can't be stored as a short 8.3 name.
+    """
+    base, _, ext = file_name.partition(".")
+    if not base or len(base) > 8 or len(ext) > 3 or "." in ext or \
+            not set(base.upper() + ext.upper()) <= SHORT_NAME_CHARS:
+        raise Exception("File name is not a valid 8.3 name: {}".format(file_name))
+    if base != base.upper() and base != base.lower() or ext != ext.upper() and ext != ext.lower():
+        raise Exception("Mixed case file names are not supported: {}".format(file_name))
+    case_flags = (CASE_LOWER_BASE if base != base.upper() else 0) | \
+        (CASE_LOWER_EXT if ext != ext.upper() else 0)
+    return (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii"), case_flags
+
+
+def dos_date_time(timestamp: float):
+    """FAT directory entry date and time of a timestamp, also used in zip files."""
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = (max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_date, dos_time
+
+
+class DirEntry:
+    """A file in the root directory, offset is the entry position in the image
+    and lfn_offsets the positions of its long file name entries."""
+
+    def __init__(self, name: str, short_name: bytes, attr: int, cluster: int, size: int, offset: int,
+                 lfn_offsets: tuple = ()):
+        self.name = name
+        self.short_name = short_name
+        self.attr = attr
+        self.cluster = cluster
+        self.size = size
+        self.offset = offset
+        self.lfn_offsets = lfn_offsets
+
+
+class Fat32Filesystem:
+    """Edit a FAT32 partition inside an image file.
+
+    Changes to the FAT are written to all FAT copies when the filesystem is
+    closed, so use it as a context manager.
+
+    :param img_path: Path to the .img file.
+    :param partition: Partition to open, defaults to the boot partition.
+    """
+
+    def __init__(self, img_path: str, partition: partitions.Partition = None):
+        self.img_path = img_path
+        self.partition = partition or partitions.boot_partition(img_path)
+        self.f = open(img_path, "r+b")
+        try:
+            self._read_boot_sector()
+            self.f.seek(self.fat_offset)
+            fat_data = self.f.read(self.fat_size)
+        except Exception:
+            self.f.close()
+            raise
+        self.fat = list(struct.unpack("<{}I".format(self.clusters + 2), fat_data[:(self.clusters + 2) * 4]))
+        self.dirty_fat_entries = set()
+        # Byte ranges written, recorded to update the image manifest
+        self.changed_ranges = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_boot_sector(self) -> None:
+        self.f.seek(self.partition.offset)
+        bs = self.f.read(512)
+        if bs[510:512] != b"\x55\xaa":
+            raise Exception("Partition does not have a FAT boot sector")
+        (self.bytes_per_sector, self.sectors_per_cluster, reserved_sectors,
+            self.num_fats, root_entries, total_sectors_16, _, fat_size_16) = \
+            struct.unpack_from("<HBHBHHBH", bs, 0x0B)
+        total_sectors_32, fat_size_32, _, _, self.root_cluster, self.fsinfo_sector = \
+            struct.unpack_from("<IIHHIH", bs, 0x20)
+        if fat_size_16 != 0 or root_entries != 0 or not fat_size_32:
+            raise Exception("Partition is not FAT32")
+        total_sectors = total_sectors_16 or total_sectors_32
+        self.cluster_size = self.bytes_per_sector * self.sectors_per_cluster
+        self.fat_offset = self.partition.offset + reserved_sectors * self.bytes_per_sector
+        self.fat_size = fat_size_32 * self.bytes_per_sector
+        self.data_offset = self.fat_offset + self.num_fats * self.fat_size
+        data_sectors = total_sectors - reserved_sectors - self.num_fats * fat_size_32
+        self.clusters = min(data_sectors // self.sectors_per_cluster, self.fat_size // 4 - 2)
+
+    def close(self) -> None:
+        if self.f.closed:
+            return
+        try:
+            self._flush_fat()
+        finally:
+            self.f.close()
+            if self.changed_ranges:
+                manifest.record_changes(self.img_path, self.changed_ranges)
+
+    def _flush_fat(self) -> None:
+        if not self.dirty_fat_entries:
+            return
+        for fat_num in range(self.num_fats):
+            fat_offset = self.fat_offset + fat_num * self.fat_size
+            for cluster in sorted(self.dirty_fat_entries):
+                self._write_at(fat_offset + cluster * 4, struct.pack("<I", self.fat[cluster]))
+        # Mark the free cluster count in FSInfo as unknown, so it's recalculated
+        if self.fsinfo_sector not in (0, 0xFFFF):
+            self._write_at(self.partition.offset + self.fsinfo_sector * self.bytes_per_sector + 488,
+                           struct.pack("<II", 0xFFFFFFFF, 0xFFFFFFFF))
+        self.f.flush()
+        self.dirty_fat_entries = set()
+
+    def _write_at(self, offset: int, data: bytes) -> None:
+        self.f.seek(offset)
+        self.f.write(data)
+        self.changed_ranges.append((offset, offset + len(data)))
+
+    def _set_fat(self, cluster: int, value: int) -> None:
+        self.fat[cluster] = (self.fat[cluster] & ~FAT_ENTRY_MASK) | value
+        self.dirty_fat_entries.add(cluster)
+
+    def _cluster_offset(self, cluster: int) -> int:
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _chain(self, cluster: int) -> List[int]:
+        chain = []
+        while 2 <= cluster < FAT_END_OF_CHAIN:
+            if len(chain) > self.clusters:
+                raise Exception("Loop in FAT cluster chain")
+            chain.append(cluster)
+            cluster = self.fat[cluster] & FAT_ENTRY_MASK
+        return chain
+
+    def _allocate(self, count: int) -> List[int]:
+        """Allocate a chain of free clusters, the last one marked as the end."""
+        allocated = []
+        for cluster in range(2, self.clusters + 2):
+            if len(allocated) == count:
+                break
+            if self.fat[cluster] & FAT_ENTRY_MASK == FAT_FREE:
+                allocated.append(cluster)
+        if len(allocated) < count:
+            raise Exception("Not enough free space in the FAT32 partition")
+        for cluster, next_cluster in zip(allocated, allocated[1:] + [FAT_EOC_MARK]):
+            self._set_fat(cluster, next_cluster)
+        return allocated
+
+    def _free_chain(self, cluster: int) -> None:
+        for chain_cluster in self._chain(cluster):
+            self._set_fat(chain_cluster, FAT_FREE)
+
+    def _root_entry_offsets(self):
+        """Yield the image offset of each entry slot in the root directory."""
+        for cluster in self._chain(self.root_cluster):
+            cluster_offset = self._cluster_offset(cluster)
+            for i in range(0, self.cluster_size, DIR_ENTRY_SIZE):
+                yield cluster_offset + i
+
+    def list_root(self) -> Dict[str, DirEntry]:
+        """Read the root directory entries, indexed by lowercase file name."""
+        entries = {}
+        lfn_parts, lfn_offsets = [], []
+        for offset in self._root_entry_offsets():
+            self.f.seek(offset)
+            raw = self.f.read(DIR_ENTRY_SIZE)
+            if raw[0] == 0:
+                break
+            if raw[0] == DELETED_ENTRY:
+                lfn_parts, lfn_offsets = [], []
+                continue
+            if raw[11] == ATTR_LFN:
+                # Long file name parts are stored in reverse order
+                lfn_parts.insert(0, raw[1:11] + raw[14:26] + raw[28:32])
+                lfn_offsets.append(offset)
+                continue
+            short_name, attr, case_flags, _, _, _, _, cluster_hi, _, _, cluster_lo, size = \
+                DIR_ENTRY.unpack(raw)
+            if attr & ATTR_VOLUME_ID:
+                lfn_parts, lfn_offsets = [], []
+                continue
+            if lfn_parts:
+                name = b"".join(lfn_parts).decode("utf-16-le").split("\x00")[0]
+            else:
+                base = short_name[:8].decode("ascii", "replace").rstrip()
+                ext = short_name[8:].decode("ascii", "replace").rstrip()
+                base = base.lower() if case_flags & CASE_LOWER_BASE else base
+                ext = ext.lower() if case_flags & CASE_LOWER_EXT else ext
+                name = base + ("." + ext if ext else "")
+            entries[name.lower()] = DirEntry(
+                name, short_name, attr, (cluster_hi << 16) | cluster_lo, size, offset, tuple(lfn_offsets)
+            )
+            lfn_parts, lfn_offsets = [], []
+        return entries
+
+    def read_file(self, file_name: str) -> bytes:
+        """Read a file from the root directory.
+
+        :param file_name: Name of the file, case insensitive.
+        :raises Exception: If the file doesn't exist.
+        """
+        entry = self.list_root().get(file_name.lower())
+        if not entry or entry.attr & ATTR_DIRECTORY:
+            raise Exception("File not found in FAT32 partition: {}".format(file_name))
+        data = bytearray()
+        for cluster in self._chain(entry.cluster):
+            self.f.seek(self._cluster_offset(cluster))
+            data += self.f.read(self.cluster_size)
+        return bytes(data[:entry.size])
+
+    def _free_entry_offset(self) -> int:
+        """Find an unused root directory slot, extending the directory if full."""
+        for offset in self._root_entry_offsets():
+            self.f.seek(offset)
+            first_byte = self.f.read(1)[0]
+            if first_byte in (0, DELETED_ENTRY):
+                return offset
+        last_cluster = self._chain(self.root_cluster)[-1]
+        new_cluster = self._allocate(1)[0]
+        self._set_fat(last_cluster, new_cluster)
+        self._write_at(self._cluster_offset(new_cluster), bytes(self.cluster_size))
+        return self._cluster_offset(new_cluster)
+
+    def write_file(self, file_name: str, data: bytes) -> None:
+        """Create or replace a file in the root directory.
+
+        :param file_name: Short 8.3 name of the file, e.g. `userconf`.
+        :param data: Contents of the file.
+        """
+        short_name, case_flags = _short_name(file_name)
+        existing = self.list_root().get(file_name.lower())
+        if existing:
+            if existing.attr & ATTR_DIRECTORY:
+                raise Exception("Cannot replace a directory: {}".format(file_name))
+            self._free_chain(existing.cluster)
+            # The new entry only has a short name, so the long name entries
+            # of the old one would be orphaned
+            for lfn_offset in existing.lfn_offsets:
+                self._write_at(lfn_offset, bytes([DELETED_ENTRY]))
+            entry_offset = existing.offset
+        else:
+            entry_offset = self._free_entry_offset()
+
+        clusters = []
+        if data:
+            clusters = self._allocate(-(-len(data) // self.cluster_size))
+            for i, cluster in enumerate(clusters):
+                chunk = data[i * self.cluster_size:(i + 1) * self.cluster_size]
+                self._write_at(self._cluster_offset(cluster), chunk.ljust(self.cluster_size, b"\x00"))
+        first_cluster = clusters[0] if clusters else 0
+
+        dos_date, dos_time = dos_date_time(time.time())
+        self._write_at(entry_offset, DIR_ENTRY.pack(
+            short_name, ATTR_ARCHIVE, case_flags, 0, dos_time, dos_date, dos_date,
+            first_cluster >> 16, dos_time, dos_date, first_cluster & 0xFFFF, len(data),
+        ))
+        self._flush_fat()
+
+
+def main():
+    img_path = sys.argv[1]
+    with Fat32Filesystem(img_path) as fs:
+        if len(sys.argv) > 2:
+            sys.stdout.buffer.write(fs.read_file(sys.argv[2]))
+        else:
+            for entry in fs.list_root().values():
+                print("{:>10}  {}".format(entry.size, entry.name))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
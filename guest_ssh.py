@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run commands and copy files to a guest over SSH.
+
+Typing into the serial console is slow, fragile with long outputs and only
+runs one command at a time. Once SSH is enabled in the guest, the port
+forwarded to its port 22 can be used instead:
+
+- All the commands share a single OpenSSH connection (ControlMaster), so
+  each of them only opens a new channel in the existing connection.
+- Independent commands can run in parallel, each in its own channel.
+- Files are copied in bulk as a single tar stream.
+
+The host authenticates with a temporary key, which has to be added to the
+guest user authorized_keys, see customise_os.start_ssh_transport().
+
+It can be tried with any SSH server, like a local sshd container:
+
+    python guest_ssh.py --port 2222 --user pi --identity ~/.ssh/id_ed25519 "uname -a" "df -h"
+"""
+import io
+import os
+import sys
+import time
+import shlex
+import shutil
+import socket
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import build_trace
+
+
+###############################################################################
+# Configuration data start
+
+# Max seconds to wait for the SSH server in the guest to accept the connection
+SSH_CONNECT_TIMEOUT = 120
+# Max commands running at the same time, sshd allows 10 sessions per connection
+SSH_PARALLEL_COMMANDS = 4
+
+# Configuration data end
+###############################################################################
+
+# Seconds between connection attempts while the SSH server starts
+SSH_CONNECT_RETRY = 3
+
+# Result of a command run in the guest
+CommandResult = namedtuple("CommandResult", ["command", "exit_code", "output"])
+
+
+def free_port() -> int:
+    """A free TCP port in the host loopback interface, to forward to the guest."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class GuestSsh:
+    """Multiplexed SSH connection to a guest.
+
+    :param port: Host port forwarded to the guest SSH port.
+    :param username: User to login as.
+    :param identity_file: Private key to authenticate with, if None a
+        temporary key is created and its public key is in `public_key`.
+    :param host: Host to connect to.
+    """
+
+    def __init__(self, port: int, username: str, identity_file: str = None, host: str = "127.0.0.1"):
+        self.port = port
+        self.username = username
+        self.host = host
+        self.connected = False
+        # The control socket path has to be short, so it goes in its own temp dir
+        self.temp_dir = tempfile.mkdtemp(prefix="rpi-os-ssh-")
+        self.control_path = os.path.join(self.temp_dir, "control")
+        self.key_comment = "rpi-os-custom-image-{}".format(os.path.basename(self.temp_dir)[-8:])
+        self.public_key = None
+        if identity_file is None:
+            identity_file = os.path.join(self.temp_dir, "id_ed25519")
+            subprocess.run(
+                ["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-C", self.key_comment, "-f", identity_file],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+            with open(identity_file + ".pub") as f:
+                self.public_key = f.read().strip()
+        self.identity_file = identity_file
+
+    def _ssh_cmd(self, options=(), remote_cmd=None) -> list:
+        cmd = [
+            "ssh",
+            "-p", str(self.port),
+            "-i", self.identity_file,
+            "-o", "IdentitiesOnly=yes",
+            "-o", "BatchMode=yes",
+            # The guest host keys are new in every image
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "LogLevel=ERROR",
+            "-o", "ServerAliveInterval=15",
+            "-o", "ControlPath={}".format(self.control_path),
+        ]
+        cmd += list(options)
+        cmd.append("{}@{}".format(self.username, self.host))
+        if remote_cmd:
+            cmd.append(remote_cmd)
+        return cmd
+
+    def connect(self, timeout: int = SSH_CONNECT_TIMEOUT) -> bool:
+        """Open the master connection, retrying while the SSH server starts.
+
+        :return: True if connected, False if the timeout expired.
+        """
+        deadline = time.monotonic() + timeout
+        with build_trace.span("ssh connect", "guest") as trace_args:
+            attempts, error = 0, ""
+            while not self.connected and time.monotonic() < deadline:
+                attempts += 1
+                # Runs in the background after authenticating, until close()
+                result = subprocess.run(
+                    self._ssh_cmd(["-f", "-N", "-o", "ControlMaster=yes", "-o", "ControlPersist=yes",
+                                   "-o", "ConnectTimeout=10"]),
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                )
+                if result.returncode == 0:
+                    self.connected = True
+                else:
+                    error = result.stderr.strip()
+                    time.sleep(SSH_CONNECT_RETRY)
+            trace_args["attempts"] = attempts
+        if not self.connected:
+            print("Could not connect to the guest via SSH: {}".format(error))
+        return self.connected
+
+    def run(self, command: str, timeout: int = 600) -> CommandResult:
+        """Run a command in a new channel of the master connection."""
+        with build_trace.span(command[:60], "guest", transport="ssh") as trace_args:
+            result = subprocess.run(
+                self._ssh_cmd(["-o", "ControlMaster=no"], "bash -c {}".format(shlex.quote(command))),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, timeout=timeout,
+            )
+            trace_args["exit_code"] = result.returncode
+        return CommandResult(command, result.returncode, result.stdout.strip())
+
+    def run_commands(self, commands, timeout: int = 600, parallel: bool = False) -> list:
+        """Run a list of commands.
+
+        :param commands: List of shell commands.
+        :param timeout: Max seconds to wait for each command.
+        :param parallel: Run all the commands at the same time, otherwise run
+            them in order and stop at the first one that fails.
+        :return: List of CommandResult for the commands that ran.
+        """
+        if parallel:
+            with ThreadPoolExecutor(max_workers=SSH_PARALLEL_COMMANDS) as executor:
+                return list(executor.map(lambda cmd: self.run(cmd, timeout), commands))
+        results = []
+        for cmd in commands:
+            results.append(self.run(cmd, timeout))
+            if results[-1].exit_code != 0:
+                break
+        return results
+
+    def put_files(self, files: dict, sudo: bool = False, timeout: int = 600) -> int:
+        """Copy files to the guest as a single tar stream.
+
+        :param files: Dictionary of {absolute guest path: content}, where the
+            content is bytes or the path to a local file or directory,
+            which is streamed from disk and keeps its mode.
+        :param sudo: Write the files as root, otherwise as the SSH user.
+        :param timeout: Max seconds to wait for the copy to finish.
+        :return: Number of bytes sent.
+        """
+        # Keep the file modes, without the umask of the SSH user applied
+        tar_cmd = "tar --no-same-owner --preserve-permissions -xf - -C /"
+        if sudo:
+            tar_cmd = "sudo " + tar_cmd
+        with build_trace.span("copy files to guest", "guest", files=len(files)) as trace_args:
+            proc = subprocess.Popen(
+                self._ssh_cmd(["-o", "ControlMaster=no"], tar_cmd),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+            stream = _CountingWriter(proc.stdin)
+            try:
+                with tarfile.open(fileobj=stream, mode="w|") as tar:
+                    for guest_path, content in files.items():
+                        if not guest_path.startswith("/"):
+                            raise Exception("Guest file paths must be absolute: {}".format(guest_path))
+                        arcname = guest_path.lstrip("/")
+                        if isinstance(content, bytes):
+                            info = tarfile.TarInfo(arcname)
+                            info.size = len(content)
+                            info.mode = 0o644
+                            info.mtime = int(time.time())
+                            tar.addfile(info, io.BytesIO(content))
+                        else:
+                            tar.add(content, arcname=arcname)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # The remote tar exited early, its output has the reason
+                pass
+            output = proc.stdout.read().decode("utf-8", "replace")
+            exit_code = proc.wait(timeout=timeout)
+            trace_args["bytes"] = stream.count
+        if exit_code != 0:
+            raise Exception("Could not copy files to the guest, exit code {}:\n{}".format(exit_code, output))
+        return stream.count
+
+    def close(self) -> None:
+        """Close the master connection and delete the temporary key."""
+        if self.connected:
+            subprocess.run(
+                self._ssh_cmd(["-O", "exit"]),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            self.connected = False
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+class _CountingWriter:
+    """File object wrapper that counts the bytes written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run commands in an SSH server with a multiplexed connection.")
+    parser.add_argument("commands", nargs="+")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--identity", required=True, help="Private key to authenticate with")
+    parser.add_argument("--parallel", action="store_true", help="Run the commands at the same time")
+    args = parser.parse_args()
+
+    ssh = GuestSsh(args.port, args.user, args.identity, args.host)
+    try:
+        if not ssh.connect():
+            return 1
+        start_time = time.perf_counter()
+        results = ssh.run_commands(args.commands, parallel=args.parallel)
+        for result in results:
+            print("$ {}\n{}\n(exit code {})".format(result.command, result.output, result.exit_code))
+        print("{} commands in {:.2f}s".format(len(results), time.perf_counter() - start_time))
+    finally:
+        ssh.close()
+    return 0 if all(r.exit_code == 0 for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local cache of verified Raspberry PI OS images.
+
+Entries are keyed by the published SHA256 hash of the compressed image and
+contain the verified archive and its decompressed .img file. The URL each
+image was downloaded from is kept in the index too, so a cached image can
+be found without fetching its published hash. The cache is
+limited to a disk budget, evicting the least recently used entries, and file
+locks are used so that multiple builds can share it on the same host.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+from typing import Optional
+from contextlib import contextmanager
+from collections import namedtuple
+
+
+###############################################################################
+# Configuration data start
+
+# Location of the cache and max disk space it can use
+CACHE_DIR = os.environ.get(
+    "RPI_OS_IMAGE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "rpi-os-custom-image"),
+)
+CACHE_MAX_SIZE_GB = float(os.environ.get("RPI_OS_IMAGE_CACHE_MAX_GB", "20"))
+
+# Configuration data end
+###############################################################################
+
+INDEX_FILENAME = "index.json"
+
+# Paths to the files of a cache entry, archive_path can be None if the
+# image was downloaded without saving the archive
+CacheEntry = namedtuple("CacheEntry", ["archive_path", "img_path"])
+
+
+def disk_usage(path: str) -> int:
+    """Bytes of disk used by a file, which is less than its size if sparse."""
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+@contextmanager
+def _file_lock(lock_path: str, blocking: bool = True):
+    """Exclusive lock on a file, yields False if it's not blocking and busy."""
+    with open(lock_path, "a") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def _entry_dir(sha256: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, sha256)
+
+
+@contextmanager
+def lock_entry(sha256: str, cache_dir: str = CACHE_DIR):
+    """Hold the lock of a cache entry, to populate it or to read from it.
+
+    Concurrent builds of the same image wait here instead of downloading it
+    twice, and entries in use are not evicted.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with _file_lock(os.path.join(cache_dir, sha256 + ".lock")):
+        yield
+
+
+@contextmanager
+def _index(cache_dir: str):
+    """Load the cache index under its lock, and save it on exit."""
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, INDEX_FILENAME)
+    with _file_lock(index_path + ".lock"):
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        yield index
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, index_path)
+
+
+def lookup(sha256: str, cache_dir: str = CACHE_DIR) -> Optional[CacheEntry]:
+    """Find a cached image and mark it as recently used.
+
+    :param sha256: Published SHA256 hash of the compressed image.
+    :param cache_dir: Path to the cache directory.
+    :return: The cache entry, or None if the image is not cached.
+    """
+    with _index(cache_dir) as index:
+        entry = index.get(sha256)
+        if not entry:
+            return None
+        entry_dir = _entry_dir(sha256, cache_dir)
+        img_path = os.path.join(entry_dir, entry["img"])
+        if not os.path.isfile(img_path):
+            # Removed from outside the cache, forget about it
+            del index[sha256]
+            return None
+        archive_path = None
+        if entry.get("archive"):
+            archive_path = os.path.join(entry_dir, entry["archive"])
+            if not os.path.isfile(archive_path):
+                archive_path = None
+        entry["last_used"] = time.time()
+    return CacheEntry(archive_path, img_path)
+
+
+def lookup_url(url: str, cache_dir: str = CACHE_DIR) -> Optional[str]:
+    """Find the SHA256 of a cached image by the URL it was downloaded from.
+
+    :param url: URL of the compressed image.
+    :param cache_dir: Path to the cache directory.
+    :return: The published SHA256 hash, or None if the image is not cached.
+    """
+    with _index(cache_dir) as index:
+        for sha256, entry in index.items():
+            if entry.get("url") == url and os.path.isfile(os.path.join(_entry_dir(sha256, cache_dir), entry["img"])):
+                return sha256
+    return None
+
+
+def store(sha256: str, archive_path: Optional[str], img_path: str, cache_dir: str = CACHE_DIR,
+          url: Optional[str] = None) -> CacheEntry:
+    """Add a verified image to the cache and evict old entries if needed.
+
+    The files are moved into the cache, so cached images can't be modified
+    by accident, and a copy of the .img should be made to work on it.
+
+    :param sha256: Published SHA256 hash of the compressed image.
+    :param archive_path: Path to the verified compressed image, or None.
+    :param img_path: Path to the decompressed .img file, it's moved.
+    :param cache_dir: Path to the cache directory.
+    :param url: URL the compressed image was downloaded from.
+    :return: The new cache entry.
+    """
+    entry_dir = _entry_dir(sha256, cache_dir)
+    os.makedirs(entry_dir, exist_ok=True)
+    cached_paths = []
+    for src_path in (archive_path, img_path):
+        if not src_path:
+            cached_paths.append(None)
+            continue
+        dst_path = os.path.join(entry_dir, os.path.basename(src_path))
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        shutil.move(src_path, dst_path)
+        cached_paths.append(dst_path)
+
+    entry = {
+        "archive": os.path.basename(archive_path) if archive_path else None,
+        "img": os.path.basename(img_path),
+        "url": url,
+        "size": sum(disk_usage(path) for path in cached_paths if path),
+        "last_used": time.time(),
+    }
+    with _index(cache_dir) as index:
+        index[sha256] = entry
+    evict(cache_dir=cache_dir, keep=sha256)
+    return CacheEntry(*cached_paths)
+
+
+def evict(max_size_gb: float = CACHE_MAX_SIZE_GB, cache_dir: str = CACHE_DIR, keep: Optional[str] = None) -> None:
+    """Remove least recently used entries until the cache fits its budget.
+
+    Entries currently locked by another build are skipped.
+
+    :param max_size_gb: Max disk space the cache can use, in GB.
+    :param cache_dir: Path to the cache directory.
+    :param keep: SHA256 of an entry that should not be evicted.
+    """
+    max_size = int(max_size_gb * 1024 * 1024 * 1024)
+    with _index(cache_dir) as index:
+        total_size = sum(entry["size"] for entry in index.values())
+        for sha256, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= max_size:
+                break
+            if sha256 == keep:
+                continue
+            with _file_lock(os.path.join(cache_dir, sha256 + ".lock"), blocking=False) as locked:
+                if not locked:
+                    continue
+                print("Evicting cached image: {}".format(entry["img"]))
+                shutil.rmtree(_entry_dir(sha256, cache_dir), ignore_errors=True)
+                del index[sha256]
+                total_size -= entry["size"]
+
+
+def main():
+    with _index(CACHE_DIR) as index:
+        for sha256, entry in sorted(index.items(), key=lambda item: -item[1]["last_used"]):
+            print("{}  {:>8.1f}MB  {}".format(sha256[:16], entry["size"] / (1024 * 1024), entry["img"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Create copies of OS images without rewriting every byte.
+
+Copies are made with a reflink (copy-on-write clone) when the filesystem
+supports it, like Btrfs or XFS, so the copy is instant and shares the disk
+blocks with the original until they are modified.
+Otherwise only the data regions are copied, preserving the holes of sparse
+images.
+
+Variants can also be qcow2 overlays on a read-only parent image, which only
+store the blocks the variant changed, and are flattened into a raw image
+when exported.
+"""
+import os
+import sys
+import json
+import errno
+import fcntl
+import ctypes
+import subprocess
+
+import build_trace
+
+
+# ioctl request number to clone a file in Linux, from linux/fs.h
+FICLONE = 0x40049409
+# fallocate() flags to deallocate a range of a file, from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Max number of bytes copied per system call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# First bytes of a qcow2 image
+QCOW2_MAGIC = b"QFI\xfb"
+
+
+def reflink_copy(src_path: str, dst_path: str) -> bool:
+    """Clone a file with copy-on-write, if the filesystem supports it.
+
+    :param src_path: Path to the file to clone.
+    :param dst_path: Path to the new file.
+    :return: True if the file was cloned, False if not supported.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    with open(src_path, "rb") as src_f, open(dst_path, "wb") as dst_f:
+        try:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    """Deallocate a range of a file, which then reads as zeros.
+
+    :param fd: File descriptor open for writing.
+    :param offset: Start of the range.
+    :param length: Length of the range.
+    :return: True if the range is now a hole, False if not supported.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+def data_regions(fd: int, size: int):
+    """Yield the (start, end) regions of a file that contain data.
+
+    If the OS or filesystem don't support SEEK_DATA/SEEK_HOLE the whole file
+    is a single data region.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No more data until the end of the file
+                return
+            yield offset, size
+            return
+        data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+        yield data_start, data_end
+        offset = data_end
+
+
+def _copy_range(src_fd: int, dst_fd: int, start: int, end: int) -> None:
+    offset = start
+    while offset < end:
+        count = min(COPY_CHUNK_SIZE, end - offset)
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+            except OSError:
+                copied = 0
+        if not copied:
+            data = os.pread(src_fd, count, offset)
+            if not data:
+                raise Exception("Unexpected end of file while copying at {}".format(offset))
+            copied = os.pwrite(dst_fd, data, offset)
+        offset += copied
+
+
+def sparse_copy(src_path: str, dst_path: str) -> int:
+    """Copy only the data regions of a file, keeping the holes.
+
+    :param src_path: Path to the file to copy.
+    :param dst_path: Path to the new file.
+    :return: Number of bytes copied.
+    """
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = os.fstat(src_fd).st_size
+            os.ftruncate(dst_fd, size)
+            copied_bytes = 0
+            for start, end in data_regions(src_fd, size):
+                _copy_range(src_fd, dst_fd, start, end)
+                copied_bytes += end - start
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return copied_bytes
+
+
+def copy_image(src_path: str, dst_path: str) -> None:
+    """Copy an image using a reflink if possible, otherwise a sparse copy.
+
+    :param src_path: Path to the image to copy.
+    :param dst_path: Path to the new image.
+    """
+    print("Copying image {} -> {}".format(src_path, dst_path))
+    with build_trace.span("copy image", "copy") as trace_args:
+        if reflink_copy(src_path, dst_path):
+            trace_args["reflink"] = True
+            print("\t-> Created copy-on-write clone.")
+            return
+        copied_bytes = sparse_copy(src_path, dst_path)
+        trace_args["bytes"] = copied_bytes
+    print("\t-> Copied {:.1f}MB of data, out of {:.1f}MB.".format(
+        copied_bytes / (1024 * 1024), os.path.getsize(src_path) / (1024 * 1024),
+    ))
+
+
+def image_format(img_path: str) -> str:
+    """Format of an image for QEMU, "qcow2" or "raw"."""
+    with open(img_path, "rb") as f:
+        return "qcow2" if f.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC else "raw"
+
+
+def image_size(img_path: str) -> int:
+    """Size of the disk in an image, which for a qcow2 image is not its file size."""
+    if image_format(img_path) == "raw":
+        return os.path.getsize(img_path)
+    info = subprocess.run(
+        ["qemu-img", "info", "--output=json", img_path], check=True, stdout=subprocess.PIPE
+    ).stdout
+    return json.loads(info.decode("utf-8"))["virtual-size"]
+
+
+def resize_image(img_path: str, size: int) -> None:
+    """Extend or truncate the disk in an image to a size in bytes."""
+    if image_format(img_path) == "raw":
+        os.truncate(img_path, size)
+        return
+    subprocess.run(
+        ["qemu-img", "resize", "-q", "-f", "qcow2", "--shrink", img_path, str(size)], check=True
+    )
+
+
+def raw_head(img_path: str, dst_path: str, length: int) -> None:
+    """Write the first bytes of the disk in a qcow2 image into a raw file,
+    to read its partition table and boot partition.
+
+    :param img_path: Path to the qcow2 image.
+    :param dst_path: Path to the raw file to create.
+    :param length: Number of bytes to write, rounded up to 1MB.
+    """
+    subprocess.run([
+        "qemu-img", "dd", "-f", "qcow2", "-O", "raw", "bs=1M",
+        "count={}".format(-(-length // (1024 * 1024))), "if={}".format(img_path), "of={}".format(dst_path),
+    ], check=True, stdout=subprocess.DEVNULL)
+
+
+def create_overlay(base_path: str, overlay_path: str) -> None:
+    """Create a qcow2 overlay image on top of a read-only base image.
+
+    Writes go to the overlay, so multiple variants can share the same base.
+
+    :param base_path: Path to the raw or qcow2 base image, it must not be
+        modified while the overlay exists.
+    :param overlay_path: Path to the new qcow2 overlay.
+    """
+    print("Creating qcow2 overlay {} on {}".format(overlay_path, base_path))
+    with build_trace.span("create overlay", "copy"):
+        subprocess.run([
+            "qemu-img", "create", "-q", "-f", "qcow2", "-F", image_format(base_path),
+            "-b", os.path.abspath(base_path), overlay_path,
+        ], check=True)
+
+
+def flatten_overlay(overlay_path: str, img_path: str) -> None:
+    """Export a qcow2 overlay and its base into a single sparse raw image.
+
+    :param overlay_path: Path to the qcow2 overlay.
+    :param img_path: Path to the raw .img file to create.
+    """
+    print("Flattening qcow2 overlay {} -> {}".format(overlay_path, img_path))
+    with build_trace.span("flatten overlay", "export") as trace_args:
+        subprocess.run([
+            "qemu-img", "convert", "-f", "qcow2", "-O", "raw", "-S", "4k",
+            overlay_path, img_path,
+        ], check=True)
+        trace_args["bytes"] = os.path.getsize(img_path)
+
+
+if __name__ == "__main__":
+    copy_image(sys.argv[1], sys.argv[2])
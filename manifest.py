@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Chunked SHA256 manifests of OS images, to verify all or part of an image.
+
+The manifest has the SHA256 of each fixed size chunk of the image and the
+Merkle root of those hashes, so a single trusted root authenticates all the
+chunk hashes. Chunks are hashed by a thread pool over a memory map of the
+image, which scales with the CPU cores on fast disks, and chunks in holes of
+a sparse image are not read.
+
+With the manifest, only some byte ranges or partitions of an image can be
+verified, and after a customisation step only the chunks that could have
+changed need to be hashed again.
+
+    python manifest.py create image.img
+    python manifest.py verify image.img [--partition 2] [--range START:END]
+    python manifest.py update image.img [--partition 2] [--range START:END]
+"""
+import os
+import sys
+import mmap
+import json
+import bisect
+import hashlib
+import argparse
+import threading
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import partitions
+import image_copy
+
+
+MANIFEST_CHUNK_SIZE = 4 * 1024 * 1024
+MANIFEST_VERSION = 1
+
+# Prefixes so a leaf hash can't be passed off as an internal node
+MERKLE_LEAF_PREFIX = b"\x00"
+MERKLE_NODE_PREFIX = b"\x01"
+
+# Byte ranges modified in the images tracked with track_changes(), None
+# when the changes are unknown
+_changes = {}
+_changes_lock = threading.Lock()
+
+
+def manifest_path_for(img_path: str) -> str:
+    return img_path + ".manifest.json"
+
+
+def track_changes(img_path: str) -> None:
+    """Start recording the byte ranges modified in an image, e.g. right
+    after it was copied from an image with a manifest.
+
+    The tools that edit images call record_changes(), so the manifest of
+    the copy can then be made with update_manifest(), only hashing the
+    chunks in tracked_changes().
+    """
+    with _changes_lock:
+        _changes[os.path.abspath(img_path)] = []
+
+
+def record_changes(img_path: str, ranges: Optional[List[Tuple[int, int]]]) -> None:
+    """Record byte ranges modified in an image, if its changes are tracked.
+
+    :param img_path: Path to the modified .img file.
+    :param ranges: Byte (start, end) ranges written, or None if the changes
+        are unknown, e.g. a guest booted from the image.
+    """
+    with _changes_lock:
+        tracked = _changes.get(os.path.abspath(img_path))
+        if tracked is None:
+            return
+        if ranges is None:
+            _changes[os.path.abspath(img_path)] = None
+        else:
+            tracked.extend(ranges)
+
+
+def tracked_changes(img_path: str) -> Optional[List[Tuple[int, int]]]:
+    """Stop tracking an image and return the byte ranges modified since
+    track_changes(), or None if they are unknown or weren't tracked."""
+    with _changes_lock:
+        return _changes.pop(os.path.abspath(img_path), None)
+
+
+def merkle_root(chunk_hashes: List[str]) -> str:
+    """Merkle root of a list of hex chunk hashes.
+
+    An odd node at the end of a level is moved up to the next level.
+    """
+    level = [hashlib.sha256(MERKLE_LEAF_PREFIX + bytes.fromhex(h)).digest() for h in chunk_hashes]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        next_level = [
+            hashlib.sha256(MERKLE_NODE_PREFIX + level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def _chunks_with_data(img_path: str, size: int, chunk_size: int) -> List[bool]:
+    fd = os.open(img_path, os.O_RDONLY)
+    try:
+        regions = list(image_copy.data_regions(fd, size))
+    finally:
+        os.close(fd)
+    region_ends = [end for _, end in regions]
+    has_data = []
+    for offset in range(0, size, chunk_size):
+        i = bisect.bisect_right(region_ends, offset)
+        has_data.append(i < len(regions) and regions[i][0] < offset + chunk_size)
+    return has_data
+
+
+def hash_chunks(img_path: str, chunk_indexes=None, chunk_size: int = MANIFEST_CHUNK_SIZE,
+                workers: int = None) -> dict:
+    """Calculate the SHA256 of chunks of an image in parallel.
+
+    :param img_path: Path to the .img file.
+    :param chunk_indexes: Chunks to hash, all of them if None.
+    :param chunk_size: Size of the chunks in bytes.
+    :param workers: Number of threads, defaults to the CPU count.
+    :return: Dictionary of {chunk index: hex SHA256}.
+    """
+    size = os.path.getsize(img_path)
+    chunks_count = -(-size // chunk_size)
+    if chunk_indexes is None:
+        chunk_indexes = range(chunks_count)
+    has_data = _chunks_with_data(img_path, size, chunk_size)
+    zero_hash = hashlib.sha256(bytes(chunk_size)).hexdigest()
+
+    hashes = {}
+    to_read = []
+    for i in chunk_indexes:
+        if not has_data[i] and (i + 1) * chunk_size <= size:
+            hashes[i] = zero_hash
+        else:
+            to_read.append(i)
+    if not to_read:
+        return hashes
+
+    with open(img_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            def hash_chunk(i):
+                # hashlib releases the GIL while hashing, so the threads run in parallel
+                return hashlib.sha256(view[i * chunk_size:(i + 1) * chunk_size]).hexdigest()
+
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+                hashes.update(zip(to_read, executor.map(hash_chunk, to_read)))
+        finally:
+            view.release()
+    return hashes
+
+
+def create_manifest(img_path: str, manifest_path: str = None, chunk_size: int = MANIFEST_CHUNK_SIZE,
+                    workers: int = None) -> dict:
+    """Hash all the chunks of an image and save the manifest.
+
+    :param img_path: Path to the .img file.
+    :param manifest_path: Path for the manifest, defaults to the image path
+        with a .manifest.json extension added.
+    :return: The manifest dictionary.
+    """
+    size = os.path.getsize(img_path)
+    hashes = hash_chunks(img_path, None, chunk_size, workers)
+    chunks = [hashes[i] for i in range(len(hashes))]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "algorithm": "sha256",
+        "size": size,
+        "chunk_size": chunk_size,
+        "root": merkle_root(chunks),
+        "chunks": chunks,
+    }
+    save_manifest(manifest, manifest_path or manifest_path_for(img_path))
+    return manifest
+
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    tmp_path = manifest_path + ".part"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_manifest(manifest_path: str, expected_root: Optional[str] = None) -> dict:
+    """Load a manifest and check the chunk hashes match its Merkle root.
+
+    :param manifest_path: Path to the manifest file.
+    :param expected_root: Trusted Merkle root to check, if available.
+    :raises Exception: If the manifest is invalid or doesn't match the root.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("algorithm") != "sha256":
+        raise Exception("Unsupported image manifest: {}".format(manifest_path))
+    root = merkle_root(manifest["chunks"])
+    if root != manifest["root"] or (expected_root and root != expected_root):
+        raise Exception("Image manifest chunk hashes do not match the Merkle root: {}".format(manifest_path))
+    return manifest
+
+
+def partition_ranges(img_path: str, numbers: List[int]) -> List[Tuple[int, int]]:
+    """Byte (start, end) ranges of the given partition numbers."""
+    image_partitions = {p.number: p for p in partitions.read_partitions(img_path)}
+    ranges = []
+    for number in numbers:
+        if number not in image_partitions:
+            raise Exception("Partition {} not found in {}".format(number, img_path))
+        p = image_partitions[number]
+        ranges.append((p.offset, p.offset + p.size))
+    return ranges
+
+
+def _chunks_in_ranges(ranges, size: int, chunk_size: int) -> List[int]:
+    chunks_count = -(-size // chunk_size)
+    if ranges is None:
+        return list(range(chunks_count))
+    indexes = set()
+    for start, end in ranges:
+        indexes.update(range(start // chunk_size, min(-(-end // chunk_size), chunks_count)))
+    return sorted(indexes)
+
+
+def verify_image(img_path: str, manifest_path: str = None, ranges: List[Tuple[int, int]] = None,
+                 expected_root: Optional[str] = None, workers: int = None) -> List[int]:
+    """Verify an image, or only some byte ranges of it, against its manifest.
+
+    :param img_path: Path to the .img file.
+    :param manifest_path: Path to the manifest, defaults to the image path
+        with a .manifest.json extension added.
+    :param ranges: Byte (start, end) ranges to verify, the whole image if None.
+    :param expected_root: Trusted Merkle root to check the manifest against.
+    :param workers: Number of threads, defaults to the CPU count.
+    :return: Sorted list of chunk indexes that don't match, empty if the
+        image is correct.
+    :raises Exception: If the image size doesn't match the manifest.
+    """
+    manifest = load_manifest(manifest_path or manifest_path_for(img_path), expected_root)
+    size = os.path.getsize(img_path)
+    if size != manifest["size"]:
+        raise Exception("Image size {} does not match the manifest size {}: {}".format(
+            size, manifest["size"], img_path
+        ))
+    chunk_size = manifest["chunk_size"]
+    indexes = _chunks_in_ranges(ranges, size, chunk_size)
+    hashes = hash_chunks(img_path, indexes, chunk_size, workers)
+    bad_chunks = [i for i in indexes if hashes[i] != manifest["chunks"][i]]
+    verified_bytes = sum(min(chunk_size, size - i * chunk_size) for i in indexes)
+    print("Verified {:.1f}MB of {}, {} bad chunks".format(
+        verified_bytes / (1024 * 1024), img_path, len(bad_chunks),
+    ))
+    return bad_chunks
+
+
+def update_manifest(img_path: str, base_manifest_path: str, manifest_path: str = None,
+                    ranges: List[Tuple[int, int]] = None, workers: int = None) -> dict:
+    """Update a manifest after an image has been modified, only hashing the
+    chunks in the modified ranges.
+
+    :param img_path: Path to the modified .img file.
+    :param base_manifest_path: Manifest of the image before it was modified,
+        e.g. the manifest of the image it was copied from.
+    :param manifest_path: Path for the new manifest, defaults to the image
+        path with a .manifest.json extension added.
+    :param ranges: Byte (start, end) ranges that could have been modified.
+        Chunks after the previous image size are always hashed.
+    :return: The new manifest dictionary.
+    """
+    base = load_manifest(base_manifest_path)
+    size = os.path.getsize(img_path)
+    chunk_size = base["chunk_size"]
+    indexes = set(_chunks_in_ranges(ranges, size, chunk_size))
+    # If the size changed, the last chunk of the smaller size and any new
+    # chunks have changed too
+    if size != base["size"]:
+        indexes.update(range(min(size, base["size"]) // chunk_size, -(-size // chunk_size)))
+    hashes = hash_chunks(img_path, sorted(indexes), chunk_size, workers)
+
+    chunks = [hashes.get(i) or base["chunks"][i] for i in range(-(-size // chunk_size))]
+    manifest = dict(base, size=size, chunks=chunks, root=merkle_root(chunks))
+    save_manifest(manifest, manifest_path or manifest_path_for(img_path))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and verify chunked image manifests.")
+    parser.add_argument("command", choices=["create", "verify", "update"])
+    parser.add_argument("image")
+    parser.add_argument("--manifest", default=None, help="Manifest path, image.img.manifest.json by default")
+    parser.add_argument("--partition", type=int, action="append", default=[],
+                        help="Only verify or update this partition number, can be repeated")
+    parser.add_argument("--range", action="append", default=[],
+                        help="Only verify or update the bytes in START:END, can be repeated")
+    parser.add_argument("--root", default=None, help="Trusted Merkle root to check the manifest against")
+    args = parser.parse_args()
+
+    ranges = partition_ranges(args.image, args.partition) if args.partition else []
+    for byte_range in args.range:
+        start, end = byte_range.split(":")
+        ranges.append((int(start), int(end)))
+    ranges = ranges or None
+
+    if args.command == "create":
+        manifest = create_manifest(args.image, args.manifest)
+        print("Merkle root: {}".format(manifest["root"]))
+    elif args.command == "verify":
+        bad_chunks = verify_image(args.image, args.manifest, ranges, args.root)
+        chunk_size = load_manifest(args.manifest or manifest_path_for(args.image))["chunk_size"]
+        size = os.path.getsize(args.image)
+        for i in bad_chunks:
+            print("Chunk {} does not match, bytes {}-{}".format(
+                i, i * chunk_size, min((i + 1) * chunk_size, size)
+            ))
+        return 1 if bad_chunks else 0
+    else:
+        manifest_path = args.manifest or manifest_path_for(args.image)
+        manifest = update_manifest(args.image, manifest_path, manifest_path, ranges)
+        print("Merkle root: {}".format(manifest["root"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
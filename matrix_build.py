@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build the custom images for several OS releases concurrently.
+
+Each target is a release, tag and image variant from download_os.list_images(),
+e.g. `bullseye:2022-04-07:mu`. The tag can be `*` for all the release tags,
+and the variant can be omitted to build all variants.
+
+Images shared by several targets are only downloaded once, and the guest
+sessions run concurrently. An asyncio scheduler limits how many run at the
+same time based on the CPU cores, the RAM each QEMU guest needs and the
+free disk space. A failed target doesn't stop the others, and the status of
+each target is reported at the end.
+
+    python matrix_build.py bookworm:2023-10-10 bullseye:*:autologin-ssh
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import download_os
+import build_steps
+import image_copy
+import build_trace
+import customise_os
+import customise_os_mu
+
+
+###############################################################################
+# Configuration data start
+
+# Max number of guests running at the same time, None to calculate it from
+# the CPU cores and available RAM
+MAX_GUESTS = None
+# RAM used by each QEMU guest, including the emulator overhead
+GUEST_RAM_MB = 1024
+# Max number of images downloaded at the same time
+MAX_DOWNLOADS = 2
+# Disk space to always leave free
+DISK_RESERVE_GB = 2
+
+# Configuration data end
+###############################################################################
+
+MATRIX_SAVE_LOCATION = os.path.join(download_os.IMAGE_SAVE_LOCATION, "matrix")
+
+Target = namedtuple("Target", ["release", "tag", "variant"])
+TargetResult = namedtuple("TargetResult", ["target", "status", "seconds", "img_path", "error"])
+
+# Variant: (parent variant, or None for the original image, step name,
+# step function, step parameters)
+VARIANTS = {
+    "autologin-ssh": (
+        None, "customise_os", customise_os.run_edits,
+        dict(needs_login=True, autologin=True, ssh=True, expand_fs=False),
+    ),
+    "autologin-ssh-expanded": (
+        "autologin-ssh", "expand_fs", customise_os.run_edits,
+        dict(needs_login=False, autologin=False, ssh=False, expand_fs=True),
+    ),
+    "mu": (
+        "autologin-ssh-expanded", "customise_os_mu", customise_os_mu.run_edits,
+        dict(needs_login=False),
+    ),
+}
+# Extra disk space used by the variants that expand the image
+VARIANT_EXTRA_BYTES = {
+    "autologin-ssh-expanded": 1024 * 1024 * 1024,
+    "mu": 1024 * 1024 * 1024,
+}
+
+
+def parse_targets(specs, images):
+    """Parse `release:tag:variant` target strings into a list of Target.
+
+    The variants other targets depend on are added to the list.
+
+    :param specs: List of target strings.
+    :param images: Available images, from download_os.list_images().
+    :raises Exception: If a release, tag or variant doesn't exist.
+    """
+    targets = []
+    for spec in specs:
+        parts = spec.split(":")
+        if len(parts) not in (2, 3):
+            raise Exception("Target must be release:tag[:variant]: {}".format(spec))
+        release, tag = parts[0], parts[1]
+        if release not in images:
+            raise Exception("Unknown release: {}".format(release))
+        tags = list(images[release]) if tag == "*" else [tag]
+        for tag in tags:
+            if tag not in images[release]:
+                raise Exception("Unknown tag for {}: {}".format(release, tag))
+        variants = [parts[2]] if len(parts) == 3 else list(VARIANTS)
+        for variant in variants:
+            if variant not in VARIANTS:
+                raise Exception("Unknown variant: {}".format(variant))
+        for tag in tags:
+            for variant in variants:
+                while variant:
+                    target = Target(release, tag, variant)
+                    if target not in targets:
+                        targets.append(target)
+                    variant = VARIANTS[variant][0]
+    return targets
+
+
+def available_ram_mb() -> float:
+    """Available RAM in MB, from /proc/meminfo or the total physical RAM."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+
+
+def max_guests() -> int:
+    """Number of guests that can run at the same time in this computer."""
+    if MAX_GUESTS:
+        return MAX_GUESTS
+    return max(1, min(os.cpu_count() or 1, int(available_ram_mb() // GUEST_RAM_MB)))
+
+
+class DiskBudget:
+    """Reserve disk space for the targets before they start writing.
+
+    :param path: Path in the filesystem where the images are written.
+    :param reserve_bytes: Disk space to always leave free.
+    """
+
+    def __init__(self, path: str, reserve_bytes: int):
+        self.path = path
+        self.reserve_bytes = reserve_bytes
+        self.reserved = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> None:
+        """Wait until there is enough free space and reserve it.
+
+        :raises Exception: If there isn't enough space even when no other
+            target has reserved any.
+        """
+        async with self.condition:
+            while True:
+                free = shutil.disk_usage(self.path).free - self.reserve_bytes - self.reserved
+                if size <= free:
+                    self.reserved += size
+                    return
+                if not self.reserved:
+                    raise Exception("Not enough free disk space, {:.1f}GB needed".format(
+                        size / (1024 * 1024 * 1024)
+                    ))
+                await self.condition.wait()
+
+    async def release(self, size: int) -> None:
+        async with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+
+class MatrixBuild:
+    """Schedule the downloads and customisation of a list of targets.
+
+    :param targets: List of Target to build.
+    :param images: Available images, from download_os.list_images().
+    :param guests: Max number of guests running at the same time.
+    :param save_dir: Directory for the images, a subdirectory per release.
+    """
+
+    def __init__(self, targets, images, guests: int = None, save_dir: str = MATRIX_SAVE_LOCATION):
+        self.targets = targets
+        self.image_urls = images
+        self.guests = guests or max_guests()
+        self.save_dir = save_dir
+        self.images = {}
+        self.tasks = {}
+        self.download_locks = {}
+        self.results = {}
+
+    def _image_dir(self, release: str, tag: str) -> str:
+        return os.path.join(self.save_dir, "{}-{}".format(release, tag))
+
+    def _get_image(self, release: str, tag: str):
+        img = self.image_urls[release][tag]
+        img_dir = self._image_dir(release, tag)
+        img_path = download_os.get_image(img, save_dir=img_dir)
+        # Without the image cache the image is decompressed in the default location
+        if os.path.dirname(img_path) != img_dir:
+            os.makedirs(img_dir, exist_ok=True)
+            new_img_path = os.path.join(img_dir, os.path.basename(img_path))
+            os.replace(img_path, new_img_path)
+            img_path = new_img_path
+        base_key = download_os.image_sha256(img) if build_steps.LAYER_CACHE else None
+        build_steps.write_manifest(img_path)
+        return img_path, base_key
+
+    async def _image(self, release: str, tag: str):
+        """Download an image once, no matter how many targets need it."""
+        key = (release, tag)
+        if key not in self.images:
+            self.images[key] = asyncio.ensure_future(self._download(release, tag))
+        return await self.images[key]
+
+    async def _download(self, release: str, tag: str):
+        # Releases can have images with the same file name, which are
+        # decompressed in the same path, so don't download those together
+        file_name = os.path.basename(self.image_urls[release][tag].url)
+        lock = self.download_locks.setdefault(file_name, asyncio.Lock())
+        async with lock, self.download_slots:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, self._get_image, release, tag)
+
+    def _build_variant(self, target: Target, src_img: str, parent_key: str):
+        _, step_name, step_fn, params = VARIANTS[target.variant]
+        if step_fn is customise_os.run_edits:
+            params = dict(params, img_tag=target.tag)
+        img_path = os.path.join(
+            self._image_dir(target.release, target.tag), "{}-{}-{}.img".format(*target)
+        )
+        with build_trace.span("{}:{}:{}".format(*target), "variant"):
+            image_copy.copy_image(src_img, img_path)
+            key = build_steps.run_step(img_path, parent_key, step_name, step_fn, **params)
+            build_steps.write_manifest(img_path, src_img)
+        return img_path, key
+
+    def _target_task(self, target: Target):
+        if target not in self.tasks:
+            self.tasks[target] = asyncio.ensure_future(self._build_target(target))
+        return self.tasks[target]
+
+    async def _build_target(self, target: Target):
+        parent_variant = VARIANTS[target.variant][0]
+        if parent_variant:
+            src_img, parent_key = await self._target_task(Target(target.release, target.tag, parent_variant))
+        else:
+            src_img, parent_key = await self._image(target.release, target.tag)
+
+        disk_size = os.path.getsize(src_img) + VARIANT_EXTRA_BYTES.get(target.variant, 0)
+        await self.disk.acquire(disk_size)
+        try:
+            async with self.guest_slots:
+                start_time = time.monotonic()
+                print("! Starting target {}:{}:{}".format(*target))
+                loop = asyncio.get_event_loop()
+                img_path, key = await loop.run_in_executor(
+                    self.executor, self._build_variant, target, src_img, parent_key
+                )
+        except Exception as e:
+            print("! Target {}:{}:{} failed: {}".format(*target, e))
+            raise
+        finally:
+            await self.disk.release(disk_size)
+        self.results[target] = TargetResult(target, "ok", time.monotonic() - start_time, img_path, None)
+        print("! Finished target {}:{}:{}".format(*target))
+        return img_path, key
+
+    async def run(self) -> list:
+        """Build all the targets, returns a TargetResult for each."""
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.guest_slots = asyncio.Semaphore(self.guests)
+        self.download_slots = asyncio.Semaphore(MAX_DOWNLOADS)
+        self.disk = DiskBudget(self.save_dir, DISK_RESERVE_GB * 1024 * 1024 * 1024)
+        self.executor = ThreadPoolExecutor(max_workers=self.guests + MAX_DOWNLOADS)
+        print("Building {} targets, up to {} guests at the same time".format(len(self.targets), self.guests))
+        try:
+            tasks = [self._target_task(target) for target in self.targets]
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.executor.shutdown(wait=True)
+
+        results = []
+        for target, outcome in zip(self.targets, outcomes):
+            if target in self.results:
+                results.append(self.results[target])
+                continue
+            parent_variant = VARIANTS[target.variant][0]
+            parent = Target(target.release, target.tag, parent_variant) if parent_variant else None
+            if parent and parent not in self.results:
+                status = "skipped"
+            else:
+                status = "failed"
+            results.append(TargetResult(target, status, 0, None, "{}: {}".format(
+                type(outcome).__name__, outcome
+            )))
+        return results
+
+
+def print_results(results) -> None:
+    print("\n{:<50}  {:<8}  {:>8}  {}".format("Target", "Status", "Minutes", "Image / Error"))
+    for r in results:
+        print("{:<50}  {:<8}  {:>8.1f}  {}".format(
+            "{}:{}:{}".format(*r.target), r.status, r.seconds / 60, r.img_path or r.error,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build custom images for several OS releases.")
+    parser.add_argument("targets", nargs="+", help="Targets as release:tag[:variant], the tag can be *")
+    parser.add_argument("--guests", type=int, default=None, help="Max guests running at the same time")
+    args = parser.parse_args()
+
+    images = download_os.list_images()
+    targets = parse_targets(args.targets, images)
+    try:
+        results = asyncio.run(MatrixBuild(targets, images, args.guests).run())
+    finally:
+        build_trace.print_summary()
+        build_trace.write_chrome_trace(os.path.join(MATRIX_SAVE_LOCATION, "build-trace.json"))
+    print_results(results)
+    return 0 if all(r.status == "ok" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read the MBR partition table of a Raspberry PI OS image."""
+import sys
+import struct
+from typing import List
+from collections import namedtuple
+
+
+SECTOR_SIZE = 512
+
+# MBR partition type IDs used in Raspberry Pi OS images
+FAT32_TYPE_IDS = (0x0B, 0x0C)
+LINUX_TYPE_ID = 0x83
+
+# A partition entry, offset and size are in bytes
+Partition = namedtuple("Partition", ["number", "type_id", "offset", "size"])
+
+MBR_ENTRY = struct.Struct("<B3sB3sII")
+MBR_ENTRIES_OFFSET = 446
+MBR_SIGNATURE = b"\x55\xaa"
+
+
+def read_partitions(img_path: str) -> List[Partition]:
+    """Read the primary partitions from the MBR of an image.
+
+    :param img_path: Path to the .img file.
+    :raises Exception: If the image doesn't have an MBR partition table.
+    :return: The non-empty partitions, in partition table order.
+    """
+    with open(img_path, "rb") as f:
+        mbr = f.read(SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != MBR_SIGNATURE:
+        raise Exception("Image does not have an MBR partition table: {}".format(img_path))
+    partitions = []
+    for i in range(4):
+        _, _, type_id, _, start_sector, sectors = MBR_ENTRY.unpack_from(
+            mbr, MBR_ENTRIES_OFFSET + i * MBR_ENTRY.size
+        )
+        if type_id and sectors:
+            partitions.append(Partition(
+                i + 1, type_id, start_sector * SECTOR_SIZE, sectors * SECTOR_SIZE
+            ))
+    return partitions
+
+
+def find_partition(img_path: str, type_ids: tuple) -> Partition:
+    """Find the first partition of one of the given types.
+
+    :param img_path: Path to the .img file.
+    :param type_ids: MBR partition type IDs to look for.
+    :raises Exception: If there isn't a partition of those types.
+    :return: The partition found.
+    """
+    for partition in read_partitions(img_path):
+        if partition.type_id in type_ids:
+            return partition
+    raise Exception("Could not find a partition of type {} in {}".format(
+        "/".join("0x{:02X}".format(type_id) for type_id in type_ids), img_path
+    ))
+
+
+def boot_partition(img_path: str) -> Partition:
+    """The FAT32 boot partition of a Raspberry Pi OS image."""
+    return find_partition(img_path, FAT32_TYPE_IDS)
+
+
+def root_partition(img_path: str) -> Partition:
+    """The ext4 root filesystem partition of a Raspberry Pi OS image."""
+    return find_partition(img_path, (LINUX_TYPE_ID,))
+
+
+if __name__ == "__main__":
+    for p in read_partitions(sys.argv[1]):
+        print("{}: type 0x{:02X}, offset {}, size {:.1f}MB".format(
+            p.number, p.type_id, p.offset, p.size / (1024 * 1024)
+        ))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run a Raspberry Pi OS image directly with qemu-system-arm/aarch64.
+
+This skips the dockerpi container, and boots the kernel and device tree
+from the image boot partition on an emulated Raspberry Pi 2 or 3 board.
+Images without a 64 bit kernel for the Raspberry Pi 3 board are booted on
+the Raspberry Pi 2 board instead. The boards always have 1 GiB of RAM, as
+QEMU only accepts the RAM size of the real board.
+The QEMU performance options, like the disk cache mode and multi-threaded
+TCG, can be configured.
+
+The emulated boards need an SD card with a power of 2 size, so the image
+is extended while it runs, and truncated back to its original size after
+if the partitions still fit in it.
+
+The image can also be a qcow2 overlay, see image_copy.create_overlay(). Its
+partition table and boot partition are read from a raw copy of the start
+of its disk.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from collections import namedtuple
+
+import pexpect
+
+import fat32
+import guest_ssh
+import image_copy
+import partitions
+
+
+###############################################################################
+# Configuration data start
+
+# Emulated board, a key of QEMU_MACHINES
+QEMU_MACHINE = "raspi3b"
+# Disk cache mode, "unsafe" ignores the guest flushes, which is fine as the
+# image is only used after QEMU exits
+QEMU_DISK_CACHE = "unsafe"
+# "multi" runs a host thread per guest CPU, "single" runs all in one thread
+QEMU_TCG_THREAD = "multi"
+# Size of the TCG translation cache, None for the QEMU default
+QEMU_TCG_TB_SIZE_MB = 256
+
+# Configuration data end
+###############################################################################
+
+QemuMachine = namedtuple("QemuMachine", ["emulator", "machine", "kernel", "dtb", "memory_mb"])
+QEMU_MACHINES = {
+    "raspi2b": QemuMachine("qemu-system-arm", "raspi2b", "kernel7.img", "bcm2709-rpi-2-b.dtb", 1024),
+    "raspi3b": QemuMachine("qemu-system-aarch64", "raspi3b", "kernel8.img", "bcm2710-rpi-3-b.dtb", 1024),
+}
+# Board to use when the image doesn't have the boot files of another one,
+# e.g. 32 bit images before 2020 don't have the 64 bit kernel8.img
+QEMU_MACHINE_FALLBACKS = {
+    "raspi3b": "raspi2b",
+}
+
+KERNEL_CMDLINE = " ".join([
+    "rw", "earlyprintk", "loglevel=8", "console=ttyAMA0,115200", "dwc_otg.lpm_enable=0",
+    "dwc_otg.fiq_fsm_enable=0", "root=/dev/mmcblk0p2", "rootwait", "panic=1",
+])
+
+# Keys to exit QEMU with -serial mon:stdio
+QEMU_EXIT_KEYS = "\x01x"
+
+
+def _next_power_of_2(size: int) -> int:
+    return 1 << (size - 1).bit_length()
+
+
+def select_machine(img_path: str, machine_name: str = None) -> QemuMachine:
+    """The board to emulate, falling back to another one if the image boot
+    partition doesn't have its kernel and device tree.
+
+    :param machine_name: Board to emulate, QEMU_MACHINE if None.
+    :raises Exception: If the image doesn't have the files of any fallback board.
+    """
+    machine = QEMU_MACHINES[machine_name or QEMU_MACHINE]
+    with fat32.Fat32Filesystem(img_path) as boot_fs:
+        boot_files = boot_fs.list_root()
+    while machine.kernel not in boot_files or machine.dtb not in boot_files:
+        fallback = QEMU_MACHINE_FALLBACKS.get(machine.machine)
+        if not fallback:
+            raise Exception("Boot partition does not have {} and {} for the {} board: {}".format(
+                machine.kernel, machine.dtb, machine.machine, img_path
+            ))
+        print("Boot partition does not have {} or {}, emulating a {} board instead".format(
+            machine.kernel, machine.dtb, fallback
+        ))
+        machine = QEMU_MACHINES[fallback]
+    return machine
+
+
+def extract_boot_files(img_path: str, machine: QemuMachine, dest_dir: str):
+    """Copy the kernel and device tree of a board from the boot partition.
+
+    :return: Tuple with the kernel and DTB paths.
+    :raises Exception: If the image doesn't have the files for the board.
+    """
+    paths = []
+    with fat32.Fat32Filesystem(img_path) as boot_fs:
+        for file_name in (machine.kernel, machine.dtb):
+            path = os.path.join(dest_dir, file_name)
+            with open(path, "wb") as f:
+                f.write(boot_fs.read_file(file_name))
+            paths.append(path)
+    return paths
+
+
+def qemu_command(img_path: str, kernel_path: str, dtb_path: str, machine: QemuMachine,
+                 ssh_port: int = None, img_format: str = "raw") -> list:
+    """Build the QEMU command line to boot an image.
+
+    :param ssh_port: Host port to forward to the guest SSH port, if any.
+    :param img_format: Format of the image, "raw" or "qcow2".
+    """
+    netdev = "user,id=net0"
+    if ssh_port:
+        netdev += ",hostfwd=tcp:127.0.0.1:{}-:22".format(ssh_port)
+    accel = "tcg,thread={}".format(QEMU_TCG_THREAD)
+    if QEMU_TCG_TB_SIZE_MB:
+        accel += ",tb-size={}".format(QEMU_TCG_TB_SIZE_MB)
+    return [
+        machine.emulator,
+        "-machine", machine.machine,
+        "-m", "{}M".format(machine.memory_mb),
+        "-accel", accel,
+        "-kernel", kernel_path,
+        "-dtb", dtb_path,
+        "-append", KERNEL_CMDLINE,
+        "-drive", "file={},if=sd,format={},cache={}".format(img_path, img_format, QEMU_DISK_CACHE),
+        "-netdev", netdev,
+        "-device", "usb-net,netdev=net0",
+        "-display", "none",
+        "-serial", "mon:stdio",
+        "-no-reboot",
+    ]
+
+
+def launch_qemu_spawn(img_path: str, machine_name: str = None):
+    """Boot an image with QEMU and return a child process to control it.
+
+    :param img_path: Path to the Raspberry Pi OS image.
+    :param machine_name: Board to emulate, QEMU_MACHINE if None.
+    :return: The pexpect child process, with the console in its stdio and
+        the host port forwarded to the guest SSH port in `ssh_port`.
+    """
+    img_path = os.path.abspath(img_path)
+    if not os.path.isfile(img_path):
+        raise Exception("Provided OS file cannot be found: {}".format(img_path))
+    img_format = image_copy.image_format(img_path)
+    boot_dir = tempfile.mkdtemp(prefix="rpi-os-qemu-")
+    try:
+        boot_img_path = img_path
+        if img_format != "raw":
+            boot_img_path = os.path.join(boot_dir, "boot.img")
+            image_copy.raw_head(img_path, boot_img_path, partitions.SECTOR_SIZE)
+            boot_end = min(p.offset + p.size for p in partitions.read_partitions(boot_img_path))
+            image_copy.raw_head(img_path, boot_img_path, boot_end)
+        machine = select_machine(boot_img_path, machine_name)
+        if not shutil.which(machine.emulator):
+            raise Exception("{} not found, please install QEMU".format(machine.emulator))
+        kernel_path, dtb_path = extract_boot_files(boot_img_path, machine, boot_dir)
+    except Exception:
+        shutil.rmtree(boot_dir, ignore_errors=True)
+        raise
+
+    original_size = image_copy.image_size(img_path)
+    sd_size = _next_power_of_2(original_size)
+    if sd_size != original_size:
+        print("Extending image to {}MB for the emulated SD card".format(sd_size // (1024 * 1024)))
+        image_copy.resize_image(img_path, sd_size)
+
+    ssh_port = guest_ssh.free_port()
+    cmd = qemu_command(img_path, kernel_path, dtb_path, machine, ssh_port, img_format)
+    print("QEMU cmd: {}".format(" ".join(cmd)))
+    child = pexpect.spawn(cmd[0], cmd[1:], timeout=600, encoding="utf-8")
+    child.qemu_img_path = img_path
+    child.qemu_original_size = original_size
+    child.qemu_boot_dir = boot_dir
+    child.ssh_port = ssh_port
+    return child
+
+
+def close_qemu(child) -> None:
+    """Make sure QEMU has exited and restore the image original size.
+
+    The image is only truncated back if all the partitions fit in the
+    original size, so an expanded root filesystem is kept.
+    """
+    if child.isalive():
+        child.send(QEMU_EXIT_KEYS)
+        try:
+            child.expect(pexpect.EOF, timeout=30)
+        except pexpect.TIMEOUT:
+            pass
+    child.close(force=True)
+
+    img_path, original_size = child.qemu_img_path, child.qemu_original_size
+    try:
+        size = image_copy.image_size(img_path)
+        if size == original_size:
+            return
+        mbr_path = img_path
+        if image_copy.image_format(img_path) != "raw":
+            mbr_path = os.path.join(child.qemu_boot_dir, "mbr.img")
+            image_copy.raw_head(img_path, mbr_path, partitions.SECTOR_SIZE)
+        partitions_end = max(
+            (p.offset + p.size for p in partitions.read_partitions(mbr_path)), default=0
+        )
+        if partitions_end <= original_size:
+            image_copy.resize_image(img_path, original_size)
+        else:
+            print("Root partition was expanded, image size is now {}MB".format(size // (1024 * 1024)))
+    finally:
+        shutil.rmtree(child.qemu_boot_dir, ignore_errors=True)
+
+
+def main():
+    img_path = sys.argv[1]
+    child = launch_qemu_spawn(img_path)
+    child.logfile_read = sys.stdout
+    try:
+        child.interact()
+    finally:
+        close_qemu(child)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
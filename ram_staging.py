@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stage an image in RAM (tmpfs) while a guest boots and customises it.
+
+QEMU does a lot of small random writes to the image while the guest boots
+and installs packages, which is slow when the image is on a slow disk.
+staged_image() makes a sparse copy of the image in a tmpfs directory when
+there is enough free RAM, otherwise the image is used in place.
+
+When the staged image is no longer needed, even if the customisation
+failed, only the chunks that changed are written back to the original
+image, and they are read back from the disk to verify them. If the write
+back fails the staged image is kept, so the changes are not lost.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import manifest
+import image_copy
+import build_trace
+
+
+###############################################################################
+# Configuration data start
+
+# tmpfs directory for the staged images
+RAM_STAGING_DIR = os.environ.get("RPI_OS_RAM_STAGING_DIR", "/dev/shm")
+# Free RAM to leave for QEMU and the rest of the system
+RAM_STAGING_RESERVE_MB = 2048
+# Extra space for the data the guest writes, e.g. packages installed
+RAM_STAGING_HEADROOM_MB = 1536
+
+# Configuration data end
+###############################################################################
+
+# Size of the chunks compared to find the changes
+STAGING_CHUNK_SIZE = 1024 * 1024
+
+# RAM reserved by the images staged by this process, e.g. by matrix_build
+_reserved_bytes = 0
+_reserved_lock = threading.Lock()
+
+
+def available_ram_bytes() -> int:
+    """Available RAM from /proc/meminfo, 0 if it can't be read."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _allocated_bytes(path: str) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+def _reserve(size: int, staging_dir: str) -> bool:
+    """Reserve RAM for an image if the RAM and the tmpfs have space for it."""
+    global _reserved_bytes
+    if not os.path.isdir(staging_dir):
+        return False
+    with _reserved_lock:
+        free_ram = available_ram_bytes() - RAM_STAGING_RESERVE_MB * 1024 * 1024 - _reserved_bytes
+        free_tmpfs = shutil.disk_usage(staging_dir).free - _reserved_bytes
+        if size > min(free_ram, free_tmpfs):
+            return False
+        _reserved_bytes += size
+        return True
+
+
+def _release(size: int) -> None:
+    global _reserved_bytes
+    with _reserved_lock:
+        _reserved_bytes -= size
+
+
+def write_back(staged_path: str, img_path: str, original_hashes: dict) -> int:
+    """Write the chunks of the staged image that changed to the original image.
+
+    Changed chunks that are zeros in the staged image are not written: past
+    the end of the original image, e.g. after a resize, they are left as a
+    hole when the image is extended, and the others are deallocated with a
+    punched hole if the filesystem supports it.
+    The written chunks are read back from the disk and checked.
+
+    :param staged_path: Path to the staged copy of the image.
+    :param img_path: Path to the original image.
+    :param original_hashes: Chunk hashes of the staged image when it was created.
+    :return: Number of bytes written.
+    :raises Exception: If the data read back doesn't match.
+    """
+    staged_hashes = manifest.hash_chunks(staged_path, None, STAGING_CHUNK_SIZE)
+    dirty_chunks = sorted(i for i, h in staged_hashes.items() if original_hashes.get(i) != h)
+    size = os.path.getsize(staged_path)
+    zero_hash = hashlib.sha256(bytes(STAGING_CHUNK_SIZE)).hexdigest()
+
+    manifest.record_changes(img_path, [
+        (i * STAGING_CHUNK_SIZE, (i + 1) * STAGING_CHUNK_SIZE) for i in dirty_chunks
+    ])
+
+    written = 0
+    staged_fd = os.open(staged_path, os.O_RDONLY)
+    img_fd = os.open(img_path, os.O_RDWR)
+    try:
+        img_size = os.fstat(img_fd).st_size
+        if img_size != size:
+            os.ftruncate(img_fd, size)
+        for i in dirty_chunks:
+            offset = i * STAGING_CHUNK_SIZE
+            if staged_hashes[i] == zero_hash and \
+                    (offset >= img_size or image_copy.punch_hole(img_fd, offset, STAGING_CHUNK_SIZE)):
+                continue
+            data = os.pread(staged_fd, STAGING_CHUNK_SIZE, offset)
+            os.pwrite(img_fd, data, offset)
+            written += len(data)
+        os.fsync(img_fd)
+        # Drop the cached pages, so the check reads the data from the disk
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(img_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(staged_fd)
+        os.close(img_fd)
+
+    written_hashes = manifest.hash_chunks(img_path, dirty_chunks, STAGING_CHUNK_SIZE)
+    bad_chunks = [i for i in dirty_chunks if written_hashes[i] != staged_hashes[i]]
+    if bad_chunks or os.path.getsize(img_path) != size:
+        raise Exception("Image write back verification failed in {} chunks: {}".format(
+            len(bad_chunks), img_path
+        ))
+    return written
+
+
+@contextmanager
+def staged_image(img_path: str, headroom_mb: int = RAM_STAGING_HEADROOM_MB, staging_dir: str = None):
+    """Context manager that yields the path of the image to work with.
+
+    The path is a copy of the image in RAM if there is enough free memory
+    for its data plus the headroom, otherwise it's the original image path.
+    The changes are written back to the original image when the block ends,
+    even if it raises an exception.
+
+    :param img_path: Path to the image to customise.
+    :param headroom_mb: Space for the data that will be added to the image.
+    :param staging_dir: tmpfs directory, RAM_STAGING_DIR by default.
+    """
+    staging_dir = staging_dir or RAM_STAGING_DIR
+    needed = _allocated_bytes(img_path) + headroom_mb * 1024 * 1024
+    if not _reserve(needed, staging_dir):
+        print("Not enough free RAM to stage the image, using it from the disk")
+        yield img_path
+        return
+
+    stage_dir = tempfile.mkdtemp(prefix="rpi-os-stage-", dir=staging_dir)
+    staged_path = os.path.join(stage_dir, os.path.basename(img_path))
+    keep_staged = False
+    try:
+        with build_trace.span("stage image in RAM", "staging") as trace_args:
+            trace_args["bytes"] = image_copy.sparse_copy(img_path, staged_path)
+            original_hashes = manifest.hash_chunks(staged_path, None, STAGING_CHUNK_SIZE)
+        print("Image staged in RAM: {}".format(staged_path))
+        try:
+            yield staged_path
+        finally:
+            with build_trace.span("write back staged image", "staging") as trace_args:
+                try:
+                    trace_args["bytes"] = write_back(staged_path, img_path, original_hashes)
+                except Exception:
+                    keep_staged = True
+                    print("! Could not write back the image, the staged copy is kept in: {}".format(
+                        staged_path
+                    ))
+                    raise
+            print("Wrote back {:.1f}MB of changes to {}".format(trace_args["bytes"] / (1024 * 1024), img_path))
+    finally:
+        if not keep_staged:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        _release(needed)
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build the custom image variants described in a recipe file.
+
+A recipe (TOML, YAML or JSON, see recipes/default.toml) lists the variants
+as lists of steps, and each step has an action and optional `since` and
+`until` image dates. The planner turns the recipe into a tree of stages:
+
+- Variants that start with the same steps share the images of those steps.
+- Edits that can be done offline run before the image is booted.
+- Each stage boots the image at most once, and runs the guest steps in
+  the recipe order. Adjacent apt steps are installed in a single
+  transaction, after an `apt-get update` that is skipped if it already ran
+  in the same stage and no run or files step since could have changed the
+  apt sources. A parent stage might be restored from a layer cached long
+  ago, so its package lists are never reused.
+- Steps that need a reboot to take effect, like expanding the filesystem,
+  end a stage.
+
+Each stage is cached as a layer with build_cache.
+
+    python recipe_plan.py recipes/default.toml --dry-run
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+from datetime import datetime
+from collections import OrderedDict
+
+import pexpect
+
+import apt_cache
+import ext4_edit
+import build_trace
+import download_os
+import manifest
+import image_copy
+import build_steps
+import customise_os
+import customise_os_mu
+
+
+ACTIONS = ("userconf", "autologin", "ssh", "apt", "run", "files", "expand_fs")
+# Actions that only need to be applied once in a variant
+IDEMPOTENT_ACTIONS = ("userconf", "autologin", "ssh")
+# Actions that need a reboot before the next steps
+BARRIER_ACTIONS = ("expand_fs",)
+
+# Rough durations in seconds, to estimate the cost of a plan
+COST_SECONDS = {
+    "copy": 15,
+    "offline_edit": 2,
+    "resize": 2,
+    "boot": 180,
+    "login": 30,
+    "shutdown": 20,
+    "apt_update": 90,
+    "apt_install": 30,
+    "apt_package": 20,
+    "command": 5,
+    "files": 5,
+    "expand_fs": 20,
+}
+
+
+def load_recipe(recipe_path: str) -> dict:
+    """Load and validate a recipe file.
+
+    :param recipe_path: Path to a .toml, .yaml/.yml or .json recipe.
+    :return: Dictionary with the "variants" as {name: [step names]} and the
+        "steps" as {name: step dictionary}.
+    :raises Exception: If the recipe is not valid.
+    """
+    if recipe_path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(recipe_path, "rb") as f:
+            data = tomllib.load(f)
+    elif recipe_path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception("PyYAML is needed for YAML recipes, install it with `pip install pyyaml`")
+        with open(recipe_path) as f:
+            data = yaml.safe_load(f)
+    else:
+        with open(recipe_path) as f:
+            data = json.load(f)
+
+    steps = data.get("step", {})
+    for name, step in steps.items():
+        if step.get("action") not in ACTIONS:
+            raise Exception("Step '{}' has an unknown action: {}".format(name, step.get("action")))
+        if step["action"] == "apt" and not step.get("packages"):
+            raise Exception("Step '{}' does not have any packages".format(name))
+        if step["action"] == "run" and not step.get("commands"):
+            raise Exception("Step '{}' does not have any commands".format(name))
+        if step["action"] == "files":
+            if not step.get("files"):
+                raise Exception("Step '{}' does not have any files".format(name))
+            # Local paths are relative to the recipe file
+            recipe_dir = os.path.dirname(os.path.abspath(recipe_path))
+            step["files"] = {
+                guest_path: os.path.join(recipe_dir, local_path)
+                for guest_path, local_path in step["files"].items()
+            }
+            for guest_path, local_path in step["files"].items():
+                if not guest_path.startswith("/") or not os.path.isfile(local_path):
+                    raise Exception("Step '{}' file {} should be an absolute guest path to an existing "
+                                    "local file: {}".format(name, guest_path, local_path))
+        for gate in ("since", "until"):
+            if gate in step:
+                step[gate] = _parse_date(step[gate], "Step '{}' {}".format(name, gate))
+    variants = OrderedDict()
+    for variant in data.get("variant", []):
+        if variant.get("name") in variants or not variant.get("name"):
+            raise Exception("Variants need a unique name: {}".format(variant.get("name")))
+        for step_name in variant.get("steps", []):
+            if step_name not in steps:
+                raise Exception("Variant '{}' has an unknown step: {}".format(variant["name"], step_name))
+        variants[variant["name"]] = list(variant.get("steps", []))
+    if not variants:
+        raise Exception("Recipe does not have any variants: {}".format(recipe_path))
+    return {"variants": variants, "steps": steps}
+
+
+def _parse_date(value, description: str):
+    # TOML and YAML can already parse unquoted dates
+    if hasattr(value, "year"):
+        return datetime(value.year, value.month, value.day)
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise Exception("{} is not a YYYY-MM-DD date: {}".format(description, value))
+
+
+def step_applies(step: dict, img_tag: str) -> bool:
+    """Check the step date gates against the image tag.
+
+    Like the checks in customise_os, an image tag that is not a date is
+    considered newer than any release.
+    """
+    try:
+        img_date = datetime.strptime(img_tag, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return "until" not in step
+    if "since" in step and img_date < step["since"]:
+        return False
+    if "until" in step and img_date > step["until"]:
+        return False
+    return True
+
+
+class PlanNode:
+    """A stage of the plan, the steps applied to the image of its parent.
+
+    :param steps: Names of the steps in this stage.
+    :param parent: Parent PlanNode, None for the downloaded image.
+    """
+
+    def __init__(self, steps=(), parent=None):
+        self.steps = list(steps)
+        self.parent = parent
+        self.children = []
+        self.variants = []
+        self.stage = None
+
+    def walk(self):
+        """Yield this node and all its descendants, parents first."""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def _build_tree(variants: dict, steps: dict) -> PlanNode:
+    """Group the variants steps into a tree of stages sharing common prefixes."""
+    trie = {"children": OrderedDict(), "variants": []}
+    for name, step_names in variants.items():
+        node = trie
+        for step_name in step_names:
+            node = node["children"].setdefault(step_name, {"children": OrderedDict(), "variants": []})
+        node["variants"].append(name)
+
+    def add_children(trie_node, plan_node):
+        for step_name, child in trie_node["children"].items():
+            chain = [step_name]
+            # Extend the stage until a variant ends, variants branch, or a
+            # step needs a reboot
+            while not child["variants"] and len(child["children"]) == 1 and \
+                    steps[chain[-1]]["action"] not in BARRIER_ACTIONS:
+                step_name, child = next(iter(child["children"].items()))
+                chain.append(step_name)
+            node = PlanNode(chain, plan_node)
+            node.variants = child["variants"]
+            plan_node.children.append(node)
+            add_children(child, node)
+
+    root = PlanNode()
+    root.variants = trie["variants"]
+    add_children(trie, root)
+    return root
+
+
+def _compile_stage(node: PlanNode, steps: dict, img_tag: str, state: dict) -> dict:
+    """Turn the steps of a stage into offline edits and a single guest session.
+
+    :param state: What the parent stages have applied, updated in place.
+    :return: The stage parameters for run_stage().
+    """
+    offline, guest, resize_mb = [], [], 0
+    apt_packages, optional_packages = [], []
+    # Only within this guest session, the parent package lists might be old
+    apt_updated = False
+
+    def add_apt_ops():
+        nonlocal apt_updated
+        # Adjacent apt steps are installed in a single transaction, optional
+        # packages are installed one by one as they might not exist
+        if not apt_packages and not optional_packages:
+            return
+        if not apt_updated:
+            guest.append({"op": "apt_update"})
+            apt_updated = True
+        if apt_packages:
+            guest.append({"op": "apt_install", "packages": list(apt_packages), "optional": False})
+        for package in optional_packages:
+            guest.append({"op": "apt_install", "packages": [package], "optional": True})
+        del apt_packages[:], optional_packages[:]
+
+    def add_guest_op(op):
+        nonlocal apt_updated
+        # Keep the recipe order, the steps might depend on the packages
+        add_apt_ops()
+        guest.append(op)
+        # Commands and files might change the apt sources
+        if op["op"] in ("run", "files"):
+            apt_updated = False
+
+    for step_name in node.steps:
+        step = steps[step_name]
+        action = step["action"]
+        if action in IDEMPOTENT_ACTIONS and action in state["applied"]:
+            continue
+        state["applied"].add(action)
+        if action == "userconf":
+            offline.append({"op": "userconf"})
+        elif action == "autologin":
+            if customise_os.OFFLINE_EDITS:
+                offline.append({"op": "autologin"})
+            else:
+                add_guest_op({"op": "autologin"})
+        elif action == "ssh":
+            if customise_os.OFFLINE_EDITS and customise_os.ssh_offline_capable(img_tag):
+                offline.append({"op": "ssh"})
+            else:
+                add_guest_op({"op": "ssh"})
+        elif action == "apt":
+            packages = optional_packages if step.get("optional") else apt_packages
+            for package in step["packages"]:
+                if package not in state["packages"]:
+                    state["packages"].add(package)
+                    packages.append(package)
+        elif action == "run":
+            add_guest_op({
+                "op": "run",
+                "commands": list(step["commands"]),
+                "check": step.get("check", True),
+                "timeout": step.get("timeout", 600),
+                "parallel": step.get("parallel", False),
+            })
+        elif action == "files":
+            add_guest_op({
+                "op": "files",
+                "files": dict(step["files"]),
+                # So the cached layers are rebuilt when the files change
+                "sha256": {path: _file_sha256(path) for path in step["files"].values()},
+                "sudo": step.get("sudo", True),
+            })
+        elif action == "expand_fs":
+            resize_mb += step.get("size_mb", 1024)
+            add_guest_op({"op": "expand_fs"})
+    add_apt_ops()
+
+    autologin_on_boot = state["autologin"] or {"op": "autologin"} in offline
+    state["autologin"] = state["autologin"] or "autologin" in state["applied"]
+    return {
+        "img_tag": img_tag,
+        "offline": offline,
+        "resize_mb": resize_mb,
+        "guest": guest,
+        "needs_login": not autologin_on_boot,
+    }
+
+
+def plan_recipe(recipe: dict, img_tag: str) -> PlanNode:
+    """Plan the stages to build all the variants of a recipe for an image.
+
+    :param recipe: Recipe from load_recipe().
+    :param img_tag: The date of the image in YYYY-MM-DD format.
+    :return: The root PlanNode, for the downloaded image.
+    """
+    steps = recipe["steps"]
+    variants = OrderedDict(
+        (name, [s for s in step_names if step_applies(steps[s], img_tag)])
+        for name, step_names in recipe["variants"].items()
+    )
+    root = _build_tree(variants, steps)
+
+    def compile_children(node, state):
+        for child in node.children:
+            child_state = {
+                "applied": set(state["applied"]),
+                "packages": set(state["packages"]),
+                "autologin": state["autologin"],
+            }
+            child.stage = _compile_stage(child, steps, img_tag, child_state)
+            compile_children(child, child_state)
+
+    compile_children(root, {"applied": set(), "packages": set(), "autologin": False})
+    return root
+
+
+def stage_cost(stage: dict) -> float:
+    """Estimated seconds to run a stage, including copying the parent image."""
+    cost = COST_SECONDS["copy"] + len(stage["offline"]) * COST_SECONDS["offline_edit"]
+    if stage["resize_mb"]:
+        cost += COST_SECONDS["resize"]
+    if stage["guest"]:
+        cost += COST_SECONDS["boot"] + COST_SECONDS["shutdown"]
+        if stage["needs_login"]:
+            cost += COST_SECONDS["login"]
+    for op in stage["guest"]:
+        if op["op"] == "apt_install":
+            cost += COST_SECONDS["apt_install"] + len(op["packages"]) * COST_SECONDS["apt_package"]
+        elif op["op"] == "run":
+            cost += len(op["commands"]) * COST_SECONDS["command"]
+        else:
+            cost += COST_SECONDS.get(op["op"], COST_SECONDS["command"])
+    return cost
+
+
+def plan_cost(root: PlanNode) -> float:
+    return sum(stage_cost(node.stage) for node in root.walk() if node.stage)
+
+
+def _file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _describe_op(op: dict) -> str:
+    if op["op"] == "apt_update":
+        return "apt-get update"
+    if op["op"] == "apt_install":
+        return "apt-get install {}{}".format(" ".join(op["packages"]), " (optional)" if op["optional"] else "")
+    if op["op"] == "run":
+        return ("; " if not op["parallel"] else " & ").join(op["commands"])
+    if op["op"] == "files":
+        return "copy {}".format(", ".join(op["files"]))
+    return op["op"]
+
+
+def print_plan(recipe: dict, img_tag: str, file=sys.stdout) -> None:
+    """Print the plan stages with their estimated cost."""
+    root = plan_recipe(recipe, img_tag)
+    print("Plan for image {}, {} variants:".format(img_tag, len(recipe["variants"])), file=file)
+    for variant in root.variants:
+        print("- {}: the downloaded image".format(variant), file=file)
+
+    def print_node(node, depth):
+        indent = "  " * depth
+        stage = node.stage
+        print("{}- {}{}  (~{:.1f} min)".format(
+            indent, ", ".join(node.steps),
+            " -> " + ", ".join(node.variants) if node.variants else "",
+            stage_cost(stage) / 60,
+        ), file=file)
+        if stage["offline"]:
+            print("{}    offline: {}".format(indent, ", ".join(op["op"] for op in stage["offline"])), file=file)
+        if stage["resize_mb"]:
+            print("{}    resize: +{}MB".format(indent, stage["resize_mb"]), file=file)
+        if stage["guest"]:
+            print("{}    boot{}".format(indent, " and login" if stage["needs_login"] else " with autologin"), file=file)
+        for op in stage["guest"]:
+            print("{}    guest: {}".format(indent, _describe_op(op)), file=file)
+        for child in node.children:
+            print_node(child, depth + 1)
+
+    for child in root.children:
+        print_node(child, 0)
+
+    # Cost of building each variant on its own, for comparison
+    unshared_cost = sum(
+        plan_cost(plan_recipe({"variants": {name: steps}, "steps": recipe["steps"]}, img_tag))
+        for name, steps in recipe["variants"].items()
+    )
+    print("Estimated {:.1f} min, {:.1f} min building each variant on its own".format(
+        plan_cost(root) / 60, unshared_cost / 60,
+    ), file=file)
+
+
+def _ssh_commands(img_tag: str) -> list:
+    """Guest commands to enable SSH, same methods as customise_os.enable_ssh."""
+    try:
+        img_date = datetime.strptime(img_tag, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        img_date = None
+    if img_date and img_date < datetime(year=2022, month=9, day=26):
+        return ["sudo systemctl enable ssh"]
+    return ["sudo raspi-config nonint do_ssh 0"]
+
+
+def _run_guest_op(child, op: dict, img_tag: str) -> None:
+    if op["op"] == "apt_update":
+        customise_os.run_guest_commands(child, ["sudo apt-get update -qq"], timeout=30*60)
+    elif op["op"] == "apt_install":
+        customise_os.run_guest_commands(
+            child, ["sudo apt-get install -y {}".format(" ".join(op["packages"]))],
+            timeout=60*60, check=not op["optional"],
+        )
+    elif op["op"] == "autologin":
+        customise_os.enable_autologin(child)
+    elif op["op"] == "ssh":
+        customise_os.run_guest_commands(child, _ssh_commands(img_tag))
+        customise_os.start_ssh_transport(child)
+    elif op["op"] == "run":
+        if op["parallel"]:
+            customise_os.run_guest_commands_parallel(child, op["commands"], timeout=op["timeout"], check=op["check"])
+        else:
+            customise_os.run_guest_commands(child, op["commands"], timeout=op["timeout"], check=op["check"])
+    elif op["op"] == "files":
+        # The local paths are streamed to the guest and keep their mode
+        customise_os.write_guest_files(child, dict(op["files"]), sudo=op["sudo"])
+    elif op["op"] == "expand_fs":
+        customise_os.expand_root_fs(child, img_tag)
+    else:
+        raise Exception("Unknown guest operation: {}".format(op["op"]))
+
+
+def run_stage(img_path, img_tag=None, offline=(), resize_mb=0, guest=(), needs_login=True):
+    """Apply a planned stage to an image.
+
+    The offline edits are applied first, then the image is booted once to
+    run all the guest operations.
+    """
+    print("Running recipe stage on {}".format(img_path))
+    offline_ops = [op["op"] for op in offline]
+    if "userconf" in offline_ops:
+        with build_trace.span("set username and password", "offline"):
+            customise_os.set_username_password(img_path)
+    if "autologin" in offline_ops or "ssh" in offline_ops:
+        with build_trace.span("offline edits", "offline"), ext4_edit.Ext4Editor(img_path) as editor:
+            if "autologin" in offline_ops:
+                customise_os.enable_autologin_offline(editor)
+            if "ssh" in offline_ops:
+                customise_os.enable_ssh_offline(editor)
+    if resize_mb:
+        print("Expanding {} image +{}MB:".format(img_path, resize_mb))
+        with build_trace.span("qemu-img resize", "offline"):
+            print(pexpect.run("qemu-img resize {} +{}M".format(img_path, resize_mb)))
+    if not guest:
+        return
+
+    uses_apt = any(op["op"].startswith("apt_") for op in guest)
+    with customise_os.staged_image(img_path) as work_img_path:
+        storage = "disk" if work_img_path == img_path else "ram"
+        apt_proxy, apt_proxy_url = None, None
+        try:
+            if uses_apt and customise_os_mu.APT_CACHE:
+                apt_proxy, apt_proxy_url = customise_os_mu.start_apt_proxy(img_path)
+            with customise_os.guest_session(work_img_path, img_tag, needs_login, storage) as child:
+                if apt_proxy_url:
+                    customise_os.run_guest_commands(
+                        child, apt_cache.guest_proxy_commands(apt_proxy_url, apt_proxy.mirror_hosts)
+                    )
+                for op in guest:
+                    with build_trace.span(op["op"], "guest", storage=storage):
+                        _run_guest_op(child, op, img_tag)
+                if apt_proxy_url:
+                    customise_os.run_guest_commands(child, apt_cache.guest_remove_proxy_commands())
+        finally:
+            if apt_proxy:
+                apt_proxy.stop()
+
+
+def build_recipe(recipe_path: str, release: str = download_os.DEFAULT_IMG_RELEASE,
+                 img_tag: str = download_os.DEFAULT_IMG_TAG):
+    """Download an image and build all the variants of a recipe.
+
+    :return: Tuple with the downloaded image path and the list of variant
+        image paths.
+    """
+    recipe = load_recipe(recipe_path)
+    img = download_os.resolve_image(release, img_tag)
+    with build_trace.span("get image", "download"):
+        img_path = download_os.get_image(img)
+    build_steps.write_manifest(img_path)
+    base_key = download_os.image_sha256(img) if build_steps.LAYER_CACHE else None
+    root = plan_recipe(recipe, img_tag)
+
+    variant_imgs = []
+    for variant in root.variants:
+        variant_img = img_path.replace(".img", "-{}.img".format(variant))
+        image_copy.copy_image(img_path, variant_img)
+        variant_imgs.append(variant_img)
+
+    def build_node(node, parent_img, parent_key, stage_number):
+        names = node.variants or ["stage{}".format(stage_number)]
+        node_img = img_path.replace(".img", "-{}.img".format(names[0]))
+        with build_trace.span("stage {}".format(", ".join(node.steps)), "variant"):
+            image_copy.copy_image(parent_img, node_img)
+            key = build_steps.run_step(node_img, parent_key, "recipe_stage", run_stage, **node.stage)
+        # Intermediate stages get a manifest too, so their children only
+        # hash the chunks they change
+        build_steps.write_manifest(node_img, parent_img)
+        for variant in node.variants:
+            variant_img = img_path.replace(".img", "-{}.img".format(variant))
+            if variant != names[0]:
+                image_copy.copy_image(node_img, variant_img)
+                manifest.track_changes(variant_img)
+                build_steps.write_manifest(variant_img, node_img)
+            variant_imgs.append(variant_img)
+        for i, child in enumerate(node.children):
+            build_node(child, node_img, key, "{}.{}".format(stage_number, i + 1))
+        # Intermediate stages are only needed to build their children
+        if not node.variants:
+            os.remove(node_img)
+            if os.path.exists(manifest.manifest_path_for(node_img)):
+                os.remove(manifest.manifest_path_for(node_img))
+
+    for i, child in enumerate(root.children):
+        build_node(child, img_path, base_key, i + 1)
+    return img_path, variant_imgs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the image variants described in a recipe.")
+    parser.add_argument("recipe", help="Recipe file, .toml, .yaml or .json")
+    parser.add_argument("--release", default=download_os.DEFAULT_IMG_RELEASE)
+    parser.add_argument("--tag", default=download_os.DEFAULT_IMG_TAG, help="Image date tag")
+    parser.add_argument("--dry-run", action="store_true", help="Print the plan without building it")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        print_plan(load_recipe(args.recipe), args.tag)
+        return 0
+    try:
+        build_recipe(args.recipe, args.release, args.tag)
+    finally:
+        build_trace.print_summary()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Discover the Raspberry Pi OS Lite releases from the downloads index pages.
+
+The index pages are stored in a local catalog file. The top level index of
+each image type is revalidated with ETag/If-Modified-Since on every lookup,
+so a warm lookup costs a single conditional request, while the pages of
+each dated release folder never change and are only fetched once.
+The published SHA256 hashes and image sizes are stored as well.
+
+If an index page can't be reached the stored copy is used, so lookups keep
+working offline once the catalog has been populated.
+"""
+import os
+import re
+import sys
+import json
+import threading
+from typing import Dict, Optional
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+import image_cache
+
+
+###############################################################################
+# Configuration data start
+
+CATALOG_BASE_URL = os.environ.get("RPI_OS_CATALOG_URL", "https://downloads.raspberrypi.org/")
+CATALOG_PATH = os.path.join(image_cache.CACHE_DIR, "catalog.json")
+
+# Configuration data end
+###############################################################################
+
+# Image type folders, the suffix added to their release names and whether
+# the folder is archived and doesn't get new releases
+IndexRoot = namedtuple("IndexRoot", ["path", "release_suffix", "archived"])
+INDEX_ROOTS = (
+    IndexRoot("raspios_lite_armhf/images/", "", False),
+    IndexRoot("raspios_oldstable_lite_armhf/images/", "-legacy", False),
+    IndexRoot("raspbian_lite/images/", "", True),
+)
+
+# Same format as download_os.ImageURL
+ImageURL = namedtuple("ImageURL", ["url", "sha256_url"])
+
+LINK_RE = re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+RELEASE_DIR_RE = re.compile(r"^[a-z_]+-(\d{4}-\d{2}-\d{2})$")
+IMAGE_FILE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}-(?:raspios|raspbian)-([a-z]+)-.*\.(?:img\.xz|zip)$")
+
+# Parallel requests to fetch new release folder pages
+FETCH_WORKERS = 8
+
+_catalog_lock = threading.Lock()
+
+
+def _load(catalog_path: str) -> dict:
+    try:
+        with open(catalog_path) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        catalog = {}
+    for section in ("pages", "sha256", "sizes"):
+        catalog.setdefault(section, {})
+    return catalog
+
+
+def _save(catalog: dict, catalog_path: str) -> None:
+    os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(catalog_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, catalog_path)
+
+
+def _fetch_page(session: requests.Session, url: str, stored: Optional[dict], revalidate: bool) -> dict:
+    """Fetch an index page, or revalidate the stored copy.
+
+    :return: The page entry with the links and the validators.
+    :raises Exception: If the page can't be fetched and there is no stored copy.
+    """
+    if stored and not revalidate:
+        return stored
+    headers = {}
+    if stored and stored.get("etag"):
+        headers["If-None-Match"] = stored["etag"]
+    if stored and stored.get("last_modified"):
+        headers["If-Modified-Since"] = stored["last_modified"]
+    try:
+        response = session.get(url, headers=headers, timeout=30)
+    except requests.exceptions.RequestException as e:
+        if stored:
+            print("Could not revalidate {}, using the stored index: {}".format(url, e))
+            return stored
+        raise Exception("Could not reach the index page {}: {}".format(url, e))
+    if response.status_code == 304 and stored:
+        return stored
+    if response.status_code != 200:
+        if stored:
+            return stored
+        raise Exception("Could not reach the index page, error code {}: {}".format(
+            response.status_code, url
+        ))
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "links": sorted(set(LINK_RE.findall(response.text))),
+    }
+
+
+def _roots_for(release: Optional[str]):
+    """Index roots that can contain a release, or all of them for None."""
+    if release is None:
+        return INDEX_ROOTS
+    legacy = release.endswith("-legacy")
+    return [root for root in INDEX_ROOTS if (root.release_suffix == "-legacy") == legacy]
+
+
+def list_images(release: Optional[str] = None, session: Optional[requests.Session] = None,
+                base_url: str = CATALOG_BASE_URL, catalog_path: str = CATALOG_PATH) -> Dict[str, Dict[str, ImageURL]]:
+    """Find the available images, revalidating the index pages.
+
+    :param release: Only revalidate the pages that can contain this release.
+    :param session: requests Session to reuse the connections.
+    :param base_url: URL of the downloads server, or a local mirror.
+    :param catalog_path: Path to the local catalog file.
+    :return: Dictionary of {release: {tag: ImageURL}}, tags sorted by date.
+    """
+    session = session or requests.Session()
+    with _catalog_lock:
+        catalog = _load(catalog_path)
+        pages = catalog["pages"]
+        images = {}
+        for root in _roots_for(release):
+            root_url = urljoin(base_url, root.path)
+            pages[root_url] = _fetch_page(session, root_url, pages.get(root_url), not root.archived)
+            release_dirs = {}
+            for link in pages[root_url]["links"]:
+                match = RELEASE_DIR_RE.match(link.rstrip("/").split("/")[-1])
+                if match and link.endswith("/"):
+                    release_dirs[urljoin(root_url, link)] = match.group(1)
+
+            # Pages of new release folders, fetched once as they don't change
+            new_dirs = [url for url in release_dirs if url not in pages]
+            if new_dirs:
+                with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                    fetched = executor.map(lambda url: _fetch_page(session, url, None, False), new_dirs)
+                    for url, page in zip(new_dirs, fetched):
+                        pages[url] = page
+
+            for dir_url, tag in release_dirs.items():
+                for link in pages[dir_url]["links"]:
+                    file_name = link.split("/")[-1]
+                    match = IMAGE_FILE_RE.match(file_name)
+                    if not match:
+                        continue
+                    image_release = match.group(1) + root.release_suffix
+                    image_url = urljoin(dir_url, file_name)
+                    images.setdefault(image_release, {})[tag] = ImageURL(image_url, image_url + ".sha256")
+        _save(catalog, catalog_path)
+    return {rel: dict(sorted(tags.items())) for rel, tags in images.items()}
+
+
+def latest_image(release: str, session: Optional[requests.Session] = None,
+                 base_url: str = CATALOG_BASE_URL, catalog_path: str = CATALOG_PATH):
+    """Find the newest image of a release.
+
+    :return: Tuple with the tag and the ImageURL.
+    :raises Exception: If the release is not in the catalog.
+    """
+    tags = list_images(release, session, base_url, catalog_path).get(release)
+    if not tags:
+        raise Exception("Release not found in the catalog: {}".format(release))
+    tag = max(tags)
+    return tag, tags[tag]
+
+
+def published_sha256(sha256_url: str, session: Optional[requests.Session] = None,
+                     catalog_path: str = CATALOG_PATH) -> str:
+    """The published SHA256 hash of an image, fetched once and then stored.
+
+    :param sha256_url: URL to the .sha256 file, in `sha256sum` format.
+    :return: The lowercase hex SHA256 hash.
+    """
+    with _catalog_lock:
+        stored = _load(catalog_path)["sha256"].get(sha256_url)
+    if stored:
+        return stored
+    response = (session or requests.Session()).get(sha256_url, timeout=30)
+    if response.status_code != 200:
+        raise Exception("Could not reach the SHA256 file URL, error code {}: {}".format(
+            response.status_code, sha256_url
+        ))
+    sha256 = response.text.split()[0].lower()
+    with _catalog_lock:
+        catalog = _load(catalog_path)
+        catalog["sha256"][sha256_url] = sha256
+        _save(catalog, catalog_path)
+    return sha256
+
+
+def image_size(url: str, session: Optional[requests.Session] = None,
+               catalog_path: str = CATALOG_PATH) -> Optional[int]:
+    """Size of the compressed image file, fetched once and then stored."""
+    with _catalog_lock:
+        stored = _load(catalog_path)["sizes"].get(url)
+    if stored:
+        return stored
+    response = (session or requests.Session()).head(url, allow_redirects=True, timeout=30)
+    try:
+        size = int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+    if response.status_code != 200:
+        return None
+    with _catalog_lock:
+        catalog = _load(catalog_path)
+        catalog["sizes"][url] = size
+        _save(catalog, catalog_path)
+    return size
+
+
+def main():
+    release = sys.argv[1] if len(sys.argv) > 1 else None
+    session = requests.Session()
+    if release:
+        tag, img = latest_image(release, session)
+        print("Latest {}: {}\n\t{}\n\tSHA256: {}\n\tSize: {:.1f}MB".format(
+            release, tag, img.url, published_sha256(img.sha256_url, session),
+            (image_size(img.url, session) or 0) / (1024 * 1024),
+        ))
+    else:
+        for rel, tags in sorted(list_images(session=session).items()):
+            print("{}: {}".format(rel, ", ".join(tags)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,37 +3,165 @@
 """
 Download and run a Raspberry PI OS image with Docker and QEMU to customise it.
 """
-import shutil
+import os
 
 import download_os
+import image_copy
+import build_steps
 import customise_os
 import customise_os_mu
+import export_image
+import bmap
+import delta
+import recipe_plan
+import build_trace
+
+
+###############################################################################
+# Configuration data start
+
+# Compress the custom images for release, e.g. ["zip"] or ["xz", "zip"]
+EXPORT_FORMATS = []
+
+# Create a .bmap file for each custom image, to flash only the used blocks
+EXPORT_BMAP = False
+
+# Create a patch from the stock image to each custom image, with only the
+# changed blocks, to rebuild them with `delta.py apply`
+EXPORT_DELTAS = False
+
+# Build the variants described in a recipe file instead, e.g. "recipes/default.toml"
+RECIPE_FILE = None
+
+# Create the variants that are only customised in the guest as qcow2
+# overlays on their parent image, instead of copies, and flatten them into
+# .img files for the export. Saves the full copies in filesystems without
+# reflinks, like ext4. Needs the QEMU launcher (RPI_OS_LAUNCHER=qemu), and
+# the overlays are not cached and don't use RAM staging or the apt cache.
+QCOW2_OVERLAYS = False
+
+# Chrome trace JSON file with the time spent in each build phase
+TRACE_FILE = os.path.join(download_os.IMAGE_SAVE_LOCATION, "build-trace.json")
+
+# Configuration data end
+###############################################################################
 
 
 def main():
+    try:
+        if RECIPE_FILE:
+            img_path, custom_imgs = recipe_plan.build_recipe(RECIPE_FILE)
+        else:
+            img_path, custom_imgs = build_images()
+            custom_imgs = flatten_overlays(custom_imgs)
+        export_images(img_path, custom_imgs)
+    finally:
+        build_trace.print_summary()
+        if TRACE_FILE:
+            if not os.path.exists(os.path.dirname(TRACE_FILE)):
+                os.makedirs(os.path.dirname(TRACE_FILE))
+            build_trace.write_chrome_trace(TRACE_FILE)
+
+
+def create_variant(src_img, variant_img, overlay=False):
+    """Create the image of a variant from its parent image.
+
+    :param overlay: Create a qcow2 overlay if QCOW2_OVERLAYS is enabled,
+        only for variants that are customised in the guest.
+    :return: The path to the variant image, with the .qcow2 extension for
+        overlays.
+    """
+    if overlay and QCOW2_OVERLAYS:
+        variant_img = variant_img.replace(".img", ".qcow2")
+        image_copy.create_overlay(src_img, variant_img)
+    else:
+        image_copy.copy_image(src_img, variant_img)
+    return variant_img
+
+
+def flatten_overlays(custom_imgs):
+    """Flatten the qcow2 overlays into .img files, and delete the overlays.
+
+    :return: The paths to the .img files of the custom images.
+    """
+    img_paths = []
+    for custom_img in custom_imgs:
+        if image_copy.image_format(custom_img) == "raw":
+            img_paths.append(custom_img)
+            continue
+        img_path = custom_img.replace(".qcow2", ".img")
+        image_copy.flatten_overlay(custom_img, img_path)
+        build_steps.write_manifest(img_path)
+        img_paths.append(img_path)
+    # Only when all are flattened, as each overlay is the base of the next
+    for custom_img, img_path in zip(custom_imgs, img_paths):
+        if custom_img != img_path:
+            os.remove(custom_img)
+    return img_paths
+
+
+def build_images():
+    if QCOW2_OVERLAYS and customise_os.LAUNCHER != "qemu":
+        raise Exception("qcow2 overlays need the QEMU launcher, set RPI_OS_LAUNCHER=qemu")
     # Download and unzip OS image
-    compressed_path = download_os.download_compressed_image()
-    img_path = download_os.decompress_image(compressed_path)
+    img = download_os.resolve_image()
+    with build_trace.span("get image", "download"):
+        img_path = download_os.get_image(img)
+    build_steps.write_manifest(img_path)
     img_tag = download_os.DEFAULT_IMG_TAG
+    base_key = download_os.image_sha256(img) if build_steps.LAYER_CACHE else None
 
-    # Create a copy of the original image and configure it autologin + ssh
+    # Create a copy of the original image and configure it autologin + ssh,
+    # always a copy as the userconf file is written offline
     autologin_ssh_img = img_path.replace(".img", "-autologin-ssh.img")
-    shutil.copyfile(img_path, autologin_ssh_img)
-    customise_os.run_edits(
-        autologin_ssh_img, img_tag=img_tag, needs_login=True, autologin=True, ssh=True, expand_fs=False
-    )
+    with build_trace.span("image autologin-ssh", "variant"):
+        autologin_ssh_img = create_variant(img_path, autologin_ssh_img)
+        autologin_ssh_key = build_steps.run_step(
+            autologin_ssh_img, base_key, "customise_os", customise_os.run_edits,
+            img_tag=img_tag, needs_login=True, autologin=True, ssh=True, expand_fs=False,
+        )
+        build_steps.write_manifest(autologin_ssh_img, img_path)
 
-    # Copy original image and configure it autologin + ssh + expanded filesystem
+    # Copy autologin + ssh image and expand its filesystem
     autologin_ssh_fs_img = img_path.replace(".img", "-autologin-ssh-expanded.img")
-    shutil.copyfile(img_path, autologin_ssh_fs_img)
-    customise_os.run_edits(
-       autologin_ssh_fs_img, img_tag=img_tag, needs_login=True, autologin=True, ssh=True, expand_fs=True
-    )
+    with build_trace.span("image autologin-ssh-expanded", "variant"):
+        autologin_ssh_fs_img = create_variant(autologin_ssh_img, autologin_ssh_fs_img, overlay=True)
+        expanded_key = build_steps.run_step(
+            autologin_ssh_fs_img, autologin_ssh_key, "expand_fs", customise_os.run_edits,
+            img_tag=img_tag, needs_login=False, autologin=False, ssh=False, expand_fs=True,
+        )
+        build_steps.write_manifest(autologin_ssh_fs_img, autologin_ssh_img)
 
     # Copy expanded image (last one created) and install Mu dependencies
     mu_img = img_path.replace(".img", "-mu.img")
-    shutil.copyfile(autologin_ssh_fs_img, mu_img)
-    customise_os_mu.run_edits(mu_img, needs_login=False)
+    with build_trace.span("image mu", "variant"):
+        mu_img = create_variant(autologin_ssh_fs_img, mu_img, overlay=True)
+        build_steps.run_step(mu_img, expanded_key, "customise_os_mu", customise_os_mu.run_edits, needs_login=False)
+        build_steps.write_manifest(mu_img, autologin_ssh_fs_img)
+
+    return img_path, [autologin_ssh_img, autologin_ssh_fs_img, mu_img]
+
+
+def export_images(img_path, custom_imgs):
+    """Create the block maps, patches and compressed files of the custom images."""
+    if EXPORT_BMAP:
+        for custom_img in custom_imgs:
+            with build_trace.span("block map", "export") as trace_args:
+                bmap.create_bmap(custom_img)
+                trace_args["bytes"] = os.path.getsize(custom_img)
+
+    if EXPORT_DELTAS:
+        for custom_img in custom_imgs:
+            with build_trace.span("delta", "export") as trace_args:
+                patch_path = delta.create_delta(img_path, custom_img)
+                trace_args["bytes"] = os.path.getsize(custom_img)
+                trace_args["patch_bytes"] = os.path.getsize(patch_path)
+
+    for export_format in EXPORT_FORMATS:
+        for custom_img in custom_imgs:
+            with build_trace.span("export {}".format(export_format), "export") as trace_args:
+                export_image.export_image(custom_img, export_format)
+                trace_args["bytes"] = os.path.getsize(custom_img)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""SHA-512 crypt password hashing, the `$6$` format used in /etc/shadow.
+
+Equivalent to `openssl passwd -6`, implemented with hashlib so it doesn't
+depend on the `crypt` module (removed in Python 3.13) or external commands.
+https://www.akkadia.org/drepper/SHA-crypt.txt
+"""
+import sys
+import hashlib
+import secrets
+
+
+ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+ROUNDS_DEFAULT = 5000
+SALT_MAX_LEN = 16
+
+# Order in which the final digest bytes are encoded, in groups of 3
+ENCODE_ORDER = (
+    (0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4),
+    (47, 5, 26), (6, 27, 48), (28, 49, 7), (50, 8, 29), (9, 30, 51),
+    (31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13), (56, 14, 35),
+    (15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19),
+    (62, 20, 41),
+)
+
+
+def _b64_from_24bit(b2: int, b1: int, b0: int, n: int) -> str:
+    w = (b2 << 16) | (b1 << 8) | b0
+    chars = []
+    for _ in range(n):
+        chars.append(ITOA64[w & 0x3F])
+        w >>= 6
+    return "".join(chars)
+
+
+def _repeat_to_len(data: bytes, length: int) -> bytes:
+    return (data * (length // len(data) + 1))[:length]
+
+
+def sha512_crypt(password: str, salt: str = None, rounds: int = ROUNDS_DEFAULT) -> str:
+    """Hash a password with SHA-512 crypt.
+
+    :param password: Password to hash.
+    :param salt: Up to 16 characters salt, a random one is used if None.
+    :param rounds: Number of hashing rounds.
+    :return: The hashed password, e.g. `$6$salt$hash`.
+    """
+    if salt is None:
+        salt = "".join(secrets.choice(ITOA64) for _ in range(SALT_MAX_LEN))
+    p = password.encode("utf-8")
+    s = salt.encode("utf-8")[:SALT_MAX_LEN]
+
+    digest_b = hashlib.sha512(p + s + p).digest()
+    hash_a = hashlib.sha512(p + s)
+    hash_a.update(_repeat_to_len(digest_b, len(p)) if p else b"")
+    i = len(p)
+    while i > 0:
+        hash_a.update(digest_b if i & 1 else p)
+        i >>= 1
+    digest_a = hash_a.digest()
+
+    digest_dp = hashlib.sha512(p * len(p)).digest()
+    seq_p = _repeat_to_len(digest_dp, len(p)) if p else b""
+    digest_ds = hashlib.sha512(s * (16 + digest_a[0])).digest()
+    seq_s = _repeat_to_len(digest_ds, len(s)) if s else b""
+
+    digest_c = digest_a
+    for r in range(rounds):
+        hash_c = hashlib.sha512()
+        hash_c.update(seq_p if r & 1 else digest_c)
+        if r % 3:
+            hash_c.update(seq_s)
+        if r % 7:
+            hash_c.update(seq_p)
+        hash_c.update(digest_c if r & 1 else seq_p)
+        digest_c = hash_c.digest()
+
+    encoded = "".join(
+        _b64_from_24bit(digest_c[a], digest_c[b], digest_c[c], 4) for a, b, c in ENCODE_ORDER
+    )
+    encoded += _b64_from_24bit(0, 0, digest_c[63], 2)
+
+    rounds_str = "" if rounds == ROUNDS_DEFAULT else "rounds={}$".format(rounds)
+    return "$6${}{}${}".format(rounds_str, s.decode("utf-8"), encoded)
+
+
+if __name__ == "__main__":
+    print(sha512_crypt(sys.argv[1]))
@@ -0,0 +1,221 @@
+import os
+import sys
+import time
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep the tests away from the user image cache
+os.environ["RPI_OS_IMAGE_CACHE"] = tempfile.mkdtemp(prefix="rpi-os-test-cache-")
+
+import benchmark  # noqa: E402
+import download_os  # noqa: E402
+import export_image  # noqa: E402
+import partitions  # noqa: E402
+
+
+@pytest.fixture
+def save_dir(tmp_path, monkeypatch):
+    """Download the images to a temporary directory, without the cache."""
+    path = tmp_path / "rpiosimage"
+    monkeypatch.setattr(download_os, "IMAGE_SAVE_LOCATION", str(path))
+    monkeypatch.setattr(download_os, "IMAGE_CACHE", False)
+    # A new session per test, so it's not shared between test servers
+    monkeypatch.setattr(download_os, "_session", None)
+    return path
+
+
+@pytest.fixture
+def source_image(tmp_path):
+    """Synthetic 8MB sparse image with its .xz and .zip archives, and their
+    .sha256 files, in a directory to serve."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    img_path = str(source_dir / "test.img")
+    benchmark.create_image(img_path, size_mb=8)
+    for export_format in ("xz", "zip"):
+        export_image.export_image(img_path, export_format)
+    return img_path
+
+
+@pytest.fixture
+def image_server(source_image):
+    """Start a local image server, with the options of benchmark.ImageServer."""
+    servers = []
+
+    def start(**kwargs):
+        server = benchmark.ImageServer(os.path.dirname(source_image), **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+class FilesHandler(BaseHTTPRequestHandler):
+    """Serve the files of a FilesServer, with ETags, recording the requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._send(send_body=True)
+
+    def do_HEAD(self):
+        self._send(send_body=False)
+
+    def _send(self, send_body):
+        self.server.requests.append((self.command, self.path))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hashlib.sha256(content).hexdigest()[:16])
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content)
+
+
+class FilesServer(ThreadingHTTPServer):
+    """Local HTTP server for a dictionary of {path: content}, which can be
+    changed while it runs, e.g. a stand-in for a repository or index pages."""
+
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), FilesHandler)
+        self.files = files
+        self.requests = []
+        self.base_url = "http://127.0.0.1:{}/".format(self.server_port)
+        self.stopped = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.shutdown()
+            self.server_close()
+
+
+@pytest.fixture
+def files_server():
+    """Start a FilesServer for a dictionary of files."""
+    servers = []
+
+    def start(files):
+        servers.append(FilesServer(files))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _mkfs_fat32(f, offset, size, label=b"BOOT"):
+    """Format a FAT32 filesystem, like mkfs.vfat, with 512 byte clusters."""
+    sector_size, reserved_sectors, num_fats = 512, 32, 2
+    total_sectors = size // sector_size
+    clusters = (total_sectors - reserved_sectors) * sector_size // (sector_size + num_fats * 4)
+    fat_sectors = -(-(clusters + 2) * 4 // sector_size)
+    boot_sector = bytearray(sector_size)
+    boot_sector[0:11] = b"\xeb\x58\x90mkfs.fat"
+    struct.pack_into(
+        "<HBHBHHBHHHIIIHHIHH", boot_sector, 0x0B,
+        sector_size, 1, reserved_sectors, num_fats, 0, 0, 0xF8, 0, 32, 64,
+        offset // sector_size, total_sectors, fat_sectors, 0, 0, 2, 1, 6,
+    )
+    struct.pack_into("<BBBI11s8s", boot_sector, 0x40, 0x80, 0, 0x29, int(time.time()) & 0xFFFFFFFF,
+                     label.ljust(11), b"FAT32   ")
+    boot_sector[510:512] = partitions.MBR_SIGNATURE
+    fsinfo = bytearray(sector_size)
+    struct.pack_into("<I", fsinfo, 0, 0x41615252)
+    struct.pack_into("<IIII", fsinfo, 484, 0x61417272, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+    fsinfo[510:512] = partitions.MBR_SIGNATURE
+    for first_sector in (0, 6):
+        f.seek(offset + first_sector * sector_size)
+        f.write(boot_sector + fsinfo)
+    # Media descriptor, end of chain marker and the root directory cluster
+    fat_start = struct.pack("<III", 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF)
+    for fat_num in range(num_fats):
+        f.seek(offset + (reserved_sectors + fat_num * fat_sectors) * sector_size)
+        f.write(fat_start)
+
+
+def create_os_image(img_path, root_dir=None, root_size_mb=16, mkfs_args=()):
+    """Create an image with an MBR, a FAT32 boot partition and an ext4 root
+    partition, with the contents of root_dir if given."""
+    if not shutil.which("mkfs.ext4") or not shutil.which("debugfs"):
+        pytest.skip("mkfs.ext4 and debugfs from e2fsprogs are needed")
+    mb = 1024 * 1024
+    boot_offset, boot_size, root_offset, root_size = 4 * mb, 40 * mb, 44 * mb, root_size_mb * mb
+    with open(img_path, "wb") as f:
+        f.truncate(root_offset + root_size)
+        mbr = bytearray(partitions.SECTOR_SIZE)
+        for i, (type_id, offset, size) in enumerate((
+            (0x0C, boot_offset, boot_size), (partitions.LINUX_TYPE_ID, root_offset, root_size),
+        )):
+            partitions.MBR_ENTRY.pack_into(
+                mbr, partitions.MBR_ENTRIES_OFFSET + i * partitions.MBR_ENTRY.size,
+                0, bytes(3), type_id, bytes(3), offset // partitions.SECTOR_SIZE, size // partitions.SECTOR_SIZE,
+            )
+        mbr[510:512] = partitions.MBR_SIGNATURE
+        f.write(mbr)
+        _mkfs_fat32(f, boot_offset, boot_size)
+    subprocess.run(
+        ["mkfs.ext4", "-q", "-F", "-E", "offset={}".format(root_offset)] + list(mkfs_args) +
+        (["-d", str(root_dir)] if root_dir else []) + [img_path, "{}k".format(root_size // 1024)],
+        check=True,
+    )
+    return img_path
+
+
+@pytest.fixture
+def os_image(tmp_path):
+    """Synthetic Raspberry Pi OS image, with a FAT32 boot partition and an
+    ext4 root partition with a few systemd directories and apt sources."""
+    root_dir = tmp_path / "rootfs"
+    (root_dir / "etc" / "systemd" / "system" / "getty.target.wants").mkdir(parents=True)
+    (root_dir / "lib" / "systemd" / "system").mkdir(parents=True)
+    (root_dir / "lib" / "systemd" / "system" / "ssh.service").write_text("[Unit]\n")
+    (root_dir / "etc" / "apt" / "sources.list.d").mkdir(parents=True)
+    (root_dir / "etc" / "apt" / "sources.list").write_text(
+        "deb http://raspbian.raspberrypi.com/raspbian/ bookworm main contrib non-free rpi\n"
+        "# deb-src http://raspbian.raspberrypi.com/raspbian/ bookworm main contrib non-free rpi\n"
+        "#deb http://commented.example.com/debian/ bookworm main\n"
+    )
+    (root_dir / "etc" / "apt" / "sources.list.d" / "raspi.list").write_text(
+        "deb [arch=armhf] http://archive.raspberrypi.com:80/debian/ bookworm main\n"
+    )
+    (root_dir / "etc" / "apt" / "sources.list.d" / "local.sources").write_text(
+        "Types: deb\nURIs: http://127.0.0.1:8080/debian\nSuites: stable\nComponents: main\n"
+    )
+    return create_os_image(str(tmp_path / "os.img"), root_dir)
+
+
+def debugfs(img_path, command):
+    """Output of a read only debugfs command on the image root partition."""
+    device = "{}?offset={}".format(img_path, partitions.root_partition(img_path).offset)
+    return subprocess.run(
+        ["debugfs", "-R", command, device],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+    ).stdout
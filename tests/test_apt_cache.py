@@ -0,0 +1,109 @@
+import time
+
+import pytest
+import requests
+
+import apt_cache
+
+
+@pytest.fixture
+def repository(files_server):
+    """Stand-in apt repository."""
+    server = files_server({
+        "/debian/dists/stable/InRelease": b"release 1",
+        "/debian/dists/stable/main/binary-armhf/Packages": b"packages 1",
+        "/debian/pool/main/f/foo/foo_1.0_armhf.deb": b"deb" * 1000,
+    })
+    server.base_url += "debian"
+    return server
+
+
+@pytest.fixture
+def proxy(repository, tmp_path):
+    proxy = apt_cache.AptCacheProxy(
+        ["127.0.0.1:{}".format(repository.server_port)], cache_dir=str(tmp_path / "apt"),
+    )
+    proxy.start()
+    yield proxy
+    proxy.stop()
+
+
+def _get(proxy, url, method="GET"):
+    return requests.request(
+        method, url, proxies={"http": "http://127.0.0.1:{}".format(proxy.server_port)}, timeout=10,
+    )
+
+
+def test_packages_are_cached(repository, proxy):
+    url = repository.base_url + "/pool/main/f/foo/foo_1.0_armhf.deb"
+    for _ in range(2):
+        response = _get(proxy, url)
+        assert response.status_code == 200 and response.content == b"deb" * 1000
+    assert repository.requests == [("GET", "/debian/pool/main/f/foo/foo_1.0_armhf.deb")]
+    assert proxy.stats["hits"] == 1 and proxy.stats["misses"] == 1
+
+
+def test_only_mirror_hosts_are_proxied(repository, proxy):
+    for url in (
+        "http://127.0.0.1:{}/debian/dists/stable/InRelease".format(proxy.server_port),
+        "http://localhost:{}/debian/dists/stable/InRelease".format(repository.server_port),
+        "http://169.254.169.254/latest/meta-data/",
+    ):
+        assert _get(proxy, url).status_code == 403
+    assert repository.requests == []
+    assert proxy.stats["denied"] == 3
+
+
+def test_head_is_forwarded_as_head(repository, proxy):
+    url = repository.base_url + "/pool/main/f/foo/foo_1.0_armhf.deb"
+    response = _get(proxy, url, "HEAD")
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == "3000"
+    assert repository.requests == [("HEAD", "/debian/pool/main/f/foo/foo_1.0_armhf.deb")]
+    assert proxy.stats["bytes_downloaded"] == 0
+    assert _get(proxy, repository.base_url + "/pool/missing.deb", "HEAD").status_code == 404
+
+
+def test_suite_indexes_expire_together(repository, proxy):
+    proxy.index_max_age = 1
+    release_url = repository.base_url + "/dists/stable/InRelease"
+    packages_url = repository.base_url + "/dists/stable/main/binary-armhf/Packages"
+    assert _get(proxy, release_url).content == b"release 1"
+    time.sleep(0.6)
+    assert _get(proxy, packages_url).content == b"packages 1"
+    repository.files["/debian/dists/stable/InRelease"] = b"release 2"
+    repository.files["/debian/dists/stable/main/binary-armhf/Packages"] = b"packages 2"
+    # Both indexes are still served from the cache
+    assert _get(proxy, release_url).content == b"release 1"
+    assert _get(proxy, packages_url).content == b"packages 1"
+
+    # Once the Release file expires the Packages file, cached later, is
+    # stale too, so it matches the new Release file
+    time.sleep(0.6)
+    assert _get(proxy, release_url).content == b"release 2"
+    assert _get(proxy, packages_url).content == b"packages 2"
+    assert [path for _, path in repository.requests].count("/debian/dists/stable/main/binary-armhf/Packages") == 2
+
+
+def test_stale_indexes_are_served_offline(repository, proxy):
+    proxy.index_max_age = 0
+    release_url = repository.base_url + "/dists/stable/InRelease"
+    assert _get(proxy, release_url).content == b"release 1"
+    repository.stop()
+    assert _get(proxy, release_url).content == b"release 1"
+    assert proxy.stats["stale"] == 1
+
+
+def test_mirror_hosts(os_image):
+    assert apt_cache.mirror_hosts(os_image) == [
+        "raspbian.raspberrypi.com", "archive.raspberrypi.com", "127.0.0.1:8080",
+    ]
+
+
+def test_guest_proxy_commands():
+    commands = apt_cache.guest_proxy_commands("http://10.0.2.2:3142", ["deb.debian.org", "127.0.0.1:8080"])
+    assert commands == [
+        "printf 'Acquire::http::Proxy::deb.debian.org \"http://10.0.2.2:3142\";\\n"
+        "Acquire::http::Proxy::127.0.0.1 \"http://10.0.2.2:3142\";\\n' "
+        "| sudo tee {}".format(apt_cache.GUEST_APT_PROXY_CONF)
+    ]
@@ -0,0 +1,54 @@
+import struct
+
+import pytest
+
+import bmap
+import partitions
+from conftest import create_os_image, debugfs, read_file
+
+
+@pytest.mark.parametrize("root_size_mb, block_size", [(64, 1024), (512, 4096)])
+def test_ext4_free_blocks_match_the_superblock(tmp_path, root_size_mb, block_size):
+    img_path = create_os_image(str(tmp_path / "os.img"), None, root_size_mb, ["-b", str(block_size)])
+    assert "Block not init" in debugfs(img_path, "stats")
+    partition = partitions.root_partition(img_path)
+    with open(img_path, "rb") as f:
+        f.seek(partition.offset + bmap.EXT4_SUPERBLOCK_OFFSET)
+        free_blocks, = struct.unpack_from("<I", f.read(1024), 0x0C)
+
+    regions = bmap._ext4_free_regions(img_path, partition)
+    assert sum(end - start for start, end in regions) == free_blocks * block_size
+    assert all(partition.offset <= start < end <= partition.offset + partition.size for start, end in regions)
+
+
+def test_create_and_flash(os_image, tmp_path):
+    bmap_path = bmap.create_bmap(os_image)
+    image_size, block_size, ranges = bmap.read_bmap(bmap_path)
+    mapped_blocks = sum(last - first + 1 for first, last, _ in ranges)
+    assert image_size == len(read_file(os_image))
+    assert mapped_blocks < image_size // block_size // 10
+
+    flashed_path = str(tmp_path / "flashed.img")
+    assert bmap.flash(os_image, flashed_path) == mapped_blocks * block_size
+    assert debugfs(flashed_path, "cat /etc/apt/sources.list") == debugfs(os_image, "cat /etc/apt/sources.list")
+    assert read_file(flashed_path)[:4 * 1024 * 1024] == read_file(os_image)[:4 * 1024 * 1024]
+
+
+@pytest.mark.parametrize("device, mounted, is_mounted", [
+    ("/dev/sda", "/dev/sda", True),
+    ("/dev/sda", "/dev/sda2", True),
+    ("/dev/sda", "/dev/sdab1", False),
+    ("/dev/sda", "/dev/sdb1", False),
+    ("/dev/mmcblk0", "/dev/mmcblk0p2", True),
+    ("/dev/mmcblk0", "/dev/mmcblk01", False),
+    ("/dev/loop1", "/dev/loop12", False),
+    ("/dev/loop1", "/dev/loop1p1", True),
+])
+def test_check_not_mounted(tmp_path, device, mounted, is_mounted):
+    mounts_path = tmp_path / "mounts"
+    mounts_path.write_text("proc /proc proc rw 0 0\n{} /mnt ext4 rw 0 0\n".format(mounted))
+    if is_mounted:
+        with pytest.raises(Exception, match="is mounted"):
+            bmap._check_not_mounted(device, str(mounts_path))
+    else:
+        bmap._check_not_mounted(device, str(mounts_path))
@@ -0,0 +1,39 @@
+import build_cache
+import customise_os
+import customise_os_mu
+from conftest import read_file
+
+
+def test_layer_key_depends_on_config(monkeypatch):
+    key = build_cache.layer_key("base", "customise_os", {"ssh": True}, customise_os.run_edits)
+    assert key == build_cache.layer_key("base", "customise_os", {"ssh": True}, customise_os.run_edits)
+    monkeypatch.setattr(customise_os, "LAUNCHER", "qemu")
+    assert key != build_cache.layer_key("base", "customise_os", {"ssh": True}, customise_os.run_edits)
+
+
+def test_source_hash_includes_local_imports():
+    found = {}
+    build_cache._local_modules(customise_os_mu, found)
+    assert {"customise_os_mu.py", "customise_os.py", "apt_cache.py", "ext4_edit.py", "fat32.py",
+            "sha512_crypt.py", "qemu_launcher.py", "guest_ssh.py", "ram_staging.py"} <= set(found)
+    assert "pexpect" not in " ".join(found)
+
+
+def test_run_step_reuses_the_cached_layer(tmp_path):
+    calls = []
+
+    def step(img_path, text):
+        calls.append(img_path)
+        with open(img_path, "a") as f:
+            f.write(text)
+
+    cache_dir = str(tmp_path / "layers")
+    keys = []
+    for name in ("first.img", "second.img"):
+        img_path = str(tmp_path / name)
+        with open(img_path, "w") as f:
+            f.write("base")
+        keys.append(build_cache.run_step(img_path, "base", "append", {"text": "-step"}, step, cache_dir))
+        assert read_file(img_path) == b"base-step"
+    assert keys[0] == keys[1]
+    assert len(calls) == 1
@@ -0,0 +1,97 @@
+import io
+import json
+import time
+
+import pytest
+
+import build_trace
+
+
+@pytest.fixture(autouse=True)
+def reset_trace():
+    build_trace.reset()
+    yield
+    build_trace.reset()
+
+
+def test_nested_spans():
+    with build_trace.span("build", "variant"):
+        with build_trace.span("copy image", "copy") as trace_args:
+            time.sleep(0.05)
+            trace_args["bytes"] = 1024 * 1024
+        with build_trace.span("copy image", "copy", bytes=3 * 1024 * 1024):
+            pass
+        # Like the guest command timings, recorded after they finished
+        build_trace.add_span("guest command", time.perf_counter() - 0.01, 0.01, "guest", exit_code=0)
+    with pytest.raises(ValueError):
+        with build_trace.span("failing"):
+            raise ValueError()
+
+    rows = build_trace.summary()
+    assert [(r["name"], r["depth"], r["count"], r["bytes"]) for r in rows] == [
+        ("build", 0, 1, 0),
+        ("copy image", 1, 2, 4 * 1024 * 1024),
+        ("guest command", 1, 1, 0),
+        ("failing", 0, 1, 0),
+    ]
+    build, copy, guest, _ = rows
+    assert copy["seconds"] >= 0.05
+    assert build["seconds"] >= copy["seconds"]
+    assert guest["seconds"] == pytest.approx(0.01)
+
+    out = io.StringIO()
+    build_trace.print_summary(out)
+    lines = out.getvalue().strip().splitlines()
+    assert lines[0].split() == ["Phase", "Count", "Seconds", "MB", "MB/s"]
+    assert lines[1].startswith("build ")
+    assert lines[2].startswith("  copy image ")
+    copy_row = lines[2].split()
+    assert (copy_row[2], copy_row[4]) == ("2", "4.0")
+
+
+def test_chrome_trace(tmp_path):
+    with build_trace.span("download", "download", url="https://example.com/os.img.xz"):
+        time.sleep(0.01)
+    with pytest.raises(KeyError):
+        with build_trace.span("decompress", "download"):
+            raise KeyError()
+
+    trace_path = str(tmp_path / "trace.json")
+    build_trace.write_chrome_trace(trace_path)
+    with open(trace_path) as f:
+        trace = json.load(f)
+    assert trace["displayTimeUnit"] == "ms"
+    download, decompress = trace["traceEvents"]
+    assert set(download) == {"name", "cat", "ph", "ts", "dur", "pid", "tid", "args"}
+    assert (download["name"], download["cat"], download["ph"]) == ("download", "download", "X")
+    assert download["args"] == {"url": "https://example.com/os.img.xz"}
+    # Microseconds from the trace start
+    assert 10 * 1000 <= download["dur"] < 10 * 1000 * 1000
+    assert decompress["ts"] >= download["ts"] + download["dur"]
+    assert decompress["args"] == {"error": "KeyError"}
+    assert decompress["tid"] == download["tid"]
+
+
+def test_console_ring_buffer_keeps_the_last_characters():
+    buffer = build_trace.ConsoleRingBuffer(max_size=10)
+    for line in ["boot 1\n", "boot 2\n", "", "login: "]:
+        buffer.write(line)
+    assert buffer.getvalue() == " 2\nlogin: "
+    # Whole chunks are dropped while the rest still has max_size characters
+    assert buffer.dropped == 7
+
+    out = io.StringIO()
+    buffer.dump(out)
+    assert out.getvalue() == (
+        "\n! Last 10 characters of the console output (11 dropped):\n"
+        " 2\nlogin: \n"
+        "! End of console output\n"
+    )
+
+
+def test_console_ring_buffer_with_a_large_chunk():
+    buffer = build_trace.ConsoleRingBuffer(max_size=4)
+    buffer.write("abc")
+    buffer.write("0123456789")
+    assert buffer.getvalue() == "6789"
+    assert buffer.dropped == 3
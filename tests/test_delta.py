@@ -0,0 +1,29 @@
+import os
+
+import delta
+from conftest import read_file
+
+
+def _write_blocks(path, size, blocks):
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset, data in blocks.items():
+            f.seek(offset)
+            f.write(data)
+
+
+def test_apply_writes_only_blocks_with_data(tmp_path):
+    base_path, target_path, out_path = (str(tmp_path / name) for name in ("base.img", "custom.img", "out.img"))
+    size = 3 * delta.DELTA_CHUNK_SIZE + 1024
+    _write_blocks(base_path, size, {0: b"boot" * 1024, delta.DELTA_CHUNK_SIZE: b"base" * 1024})
+    # The second block of the first chunk changes, one block of the second
+    # chunk is cleared and the image ends with a partial chunk
+    _write_blocks(target_path, size, {
+        0: b"boot" * 1024, 4096: b"edit" * 1024, delta.DELTA_CHUNK_SIZE: bytes(4096),
+        3 * delta.DELTA_CHUNK_SIZE: b"tail" * 256,
+    })
+
+    patch_path = delta.create_delta(base_path, target_path)
+    delta.apply_delta(base_path, patch_path, out_path)
+    assert read_file(out_path) == read_file(target_path)
+    assert os.stat(out_path).st_blocks * 512 <= 3 * 4096
@@ -0,0 +1,45 @@
+"""Fused download, verify and decompress pipeline (DOWNLOAD_PIPELINE)."""
+import os
+
+import pytest
+
+import download_os
+
+from conftest import read_file
+
+
+@pytest.mark.parametrize("archive", ["test.img.xz", "test.zip"])
+def test_pipeline_decompresses_image(save_dir, source_image, image_server, archive):
+    server = image_server()
+    img_path = download_os.download_decompress_image(server.image_url(archive))
+
+    assert read_file(img_path) == read_file(source_image)
+    # The zero blocks are not written
+    assert os.stat(img_path).st_blocks * 512 < os.path.getsize(img_path)
+    # The archive is never saved to disk
+    assert os.listdir(str(save_dir)) == ["test.img"]
+
+
+def test_pipeline_rejects_hash_mismatch(save_dir, image_server):
+    server = image_server()
+    with pytest.raises(Exception, match="SHA256 hash does not match"):
+        download_os.download_decompress_image(server.image_url("test.img.xz"), "0" * 64)
+    assert os.listdir(str(save_dir)) == []
+
+
+def test_pipeline_rejects_truncated_archive(save_dir, source_image, image_server):
+    archive_path = source_image + ".xz"
+    with open(archive_path, "r+b") as f:
+        f.truncate(os.path.getsize(archive_path) // 2)
+    server = image_server()
+    with pytest.raises(Exception, match="ended unexpectedly"):
+        download_os.download_decompress_image(server.image_url("test.img.xz"), "0" * 64)
+    assert os.listdir(str(save_dir)) == []
+
+
+def test_get_image_uses_pipeline(save_dir, source_image, image_server, monkeypatch):
+    monkeypatch.setattr(download_os, "DOWNLOAD_PIPELINE", True)
+    server = image_server()
+    img_path = download_os.get_image(server.image_url("test.img.xz"))
+    assert read_file(img_path) == read_file(source_image)
+    assert not os.path.exists(os.path.join(str(save_dir), "test.img.xz"))
@@ -0,0 +1,78 @@
+"""Segmented downloads with HTTP Range requests, resume and fallback."""
+import os
+import hashlib
+
+import pytest
+
+import download_os
+
+from conftest import read_file
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_os, "DOWNLOAD_RETRY_BACKOFF", 0)
+    # Save the state often, so the small test files are saved mid-segment
+    monkeypatch.setattr(download_os, "DOWNLOAD_STATE_SAVE_SIZE", 64 * 1024)
+    monkeypatch.setattr(download_os, "DOWNLOAD_RANGE_CHUNK_SIZE", 64 * 1024)
+
+
+def archive_sha256(source_image):
+    return hashlib.sha256(read_file(source_image + ".xz")).hexdigest()
+
+
+def test_segmented_download(save_dir, source_image, image_server):
+    server = image_server()
+    path = download_os.download_compressed_image(server.image_url("test.img.xz"))
+    assert read_file(path) == read_file(source_image + ".xz")
+    assert sorted(os.listdir(str(save_dir))) == ["test.img.xz"]
+
+
+def test_segments_hash_in_order(tmp_path, source_image, image_server):
+    server = image_server()
+    size = os.path.getsize(source_image + ".xz")
+    out_path = str(tmp_path / "out.part")
+    downloaded, sha256 = download_os.download_segments(
+        server.image_url("test.img.xz").url, out_path, size, segments_num=7,
+    )
+    assert downloaded == size
+    assert sha256 == archive_sha256(source_image)
+    assert not os.path.exists(out_path + ".state")
+
+
+def test_dropped_connections_are_retried(save_dir, source_image, image_server):
+    server = image_server(drops=6, drop_after=100 * 1024)
+    path = download_os.download_compressed_image(server.image_url("test.img.xz"))
+    assert read_file(path) == read_file(source_image + ".xz")
+    assert server.drops <= 0
+
+
+def test_interrupted_download_resumes(tmp_path, source_image, image_server, monkeypatch):
+    size = os.path.getsize(source_image + ".xz")
+    out_path = str(tmp_path / "out.part")
+    monkeypatch.setattr(download_os, "DOWNLOAD_RETRIES", 0)
+    server = image_server(drops=100, drop_after=200 * 1024)
+    with pytest.raises(Exception):
+        download_os.download_segments(server.image_url("test.img.xz").url, out_path, size, segments_num=2)
+    assert os.path.exists(out_path + ".state")
+
+    server.drops = 0
+    downloaded, sha256 = download_os.download_segments(
+        server.image_url("test.img.xz").url, out_path, size, segments_num=2,
+    )
+    assert 0 < downloaded < size
+    assert sha256 == archive_sha256(source_image)
+    assert read_file(out_path) == read_file(source_image + ".xz")
+
+
+def test_no_range_support_uses_single_stream(save_dir, source_image, image_server):
+    server = image_server(ranges=False)
+    path = download_os.download_compressed_image(server.image_url("test.img.xz"))
+    assert read_file(path) == read_file(source_image + ".xz")
+
+
+def test_download_rejects_hash_mismatch(save_dir, image_server):
+    server = image_server()
+    with pytest.raises(Exception, match="SHA256 hash does not match"):
+        download_os.download_compressed_image(server.image_url("test.img.xz"), "0" * 64)
+    assert os.listdir(str(save_dir)) == []
@@ -0,0 +1,75 @@
+import os
+import lzma
+import zlib
+import hashlib
+import zipfile
+
+import pytest
+
+import export_image
+from conftest import read_file
+
+
+BLOCK_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def sparse_image(tmp_path, monkeypatch):
+    """A sparse image with data blocks, hole blocks, a block that is half
+    data and half hole, and a partial last block."""
+    monkeypatch.setattr(export_image, "XZ_BLOCK_SIZE", BLOCK_SIZE)
+    monkeypatch.setattr(export_image, "ZIP_BLOCK_SIZE", BLOCK_SIZE)
+    img_path = str(tmp_path / "os.img")
+    with open(img_path, "wb") as f:
+        f.write(os.urandom(BLOCK_SIZE))
+        f.seek(3 * BLOCK_SIZE)
+        f.write(b"compressible " * 1000)
+        f.seek(6 * BLOCK_SIZE + BLOCK_SIZE // 2)
+        f.write(os.urandom(BLOCK_SIZE // 2))
+        f.seek(8 * BLOCK_SIZE)
+        f.write(os.urandom(1000))
+    return img_path
+
+
+def _check_sha256_file(out_path):
+    digest, name = read_file(out_path + ".sha256").decode("utf-8").split()
+    assert name == os.path.basename(out_path)
+    assert digest == hashlib.sha256(read_file(out_path)).hexdigest()
+
+
+def test_export_xz(sparse_image):
+    out_path = export_image.export_image(sparse_image, "xz", workers=2)
+    assert out_path == sparse_image + ".xz"
+    with lzma.open(out_path) as f:
+        assert f.read() == read_file(sparse_image)
+    _check_sha256_file(out_path)
+
+
+def test_export_zip(sparse_image, tmp_path):
+    out_path = export_image.export_image(sparse_image, "zip", workers=2)
+    assert out_path == str(tmp_path / "os.zip")
+    with zipfile.ZipFile(out_path) as zf:
+        assert zf.namelist() == ["os.img"]
+        assert zf.testzip() is None
+        assert zf.read("os.img") == read_file(sparse_image)
+    _check_sha256_file(out_path)
+
+
+@pytest.mark.parametrize("fmt", ["xz", "zip"])
+def test_export_empty_image(tmp_path, fmt):
+    img_path = str(tmp_path / "empty.img")
+    open(img_path, "wb").close()
+    out_path = export_image.export_image(img_path, fmt, workers=1)
+    if fmt == "xz":
+        with lzma.open(out_path) as f:
+            assert f.read() == b""
+    else:
+        with zipfile.ZipFile(out_path) as zf:
+            assert zf.read("empty.img") == b""
+
+
+def test_crc32_combine():
+    data1, data2 = os.urandom(1000), os.urandom(4097)
+    combined = export_image.crc32_combine(zlib.crc32(data1), zlib.crc32(data2), len(data2))
+    assert combined == zlib.crc32(data1 + data2)
+    assert export_image.crc32_combine(zlib.crc32(data1), zlib.crc32(b""), 0) == zlib.crc32(data1)
@@ -0,0 +1,43 @@
+import fat32
+
+
+def _add_long_name_entry(boot_fs, long_name, short_name):
+    """Write the long file name entry of short_name in the first root
+    directory slot, like other tools do for lowercase names."""
+    checksum = 0
+    for byte in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    name = (long_name + "\x00").encode("utf-16-le").ljust(26, b"\xff")
+    entry = bytes([0x41]) + name[:10] + bytes([fat32.ATTR_LFN, 0, checksum]) + name[10:22] + bytes(2) + name[22:]
+    boot_fs.f.seek(boot_fs._cluster_offset(boot_fs.root_cluster))
+    boot_fs.f.write(entry)
+
+
+def test_write_and_replace_file(os_image):
+    with fat32.Fat32Filesystem(os_image) as boot_fs:
+        boot_fs.write_file("ssh", b"")
+        boot_fs.write_file("userconf", b"a" * 2000)
+        boot_fs.write_file("userconf", b"pi:password\n")
+    with fat32.Fat32Filesystem(os_image) as boot_fs:
+        assert sorted(boot_fs.list_root()) == ["ssh", "userconf"]
+        assert boot_fs.read_file("ssh") == b""
+        assert boot_fs.read_file("USERCONF") == b"pi:password\n"
+        # The clusters of the replaced content were freed
+        used_clusters = sum(1 for entry in boot_fs.fat[2:] if entry & fat32.FAT_ENTRY_MASK)
+        assert used_clusters == 2
+
+
+def test_replace_file_with_long_name(os_image):
+    with fat32.Fat32Filesystem(os_image) as boot_fs:
+        _add_long_name_entry(boot_fs, "config.txt", b"CONFIG  TXT")
+        boot_fs.write_file("CONFIG.TXT", b"old")
+        entry = boot_fs.list_root()["config.txt"]
+        assert entry.name == "config.txt" and len(entry.lfn_offsets) == 1
+
+        boot_fs.write_file("config.txt", b"new")
+        boot_fs.f.seek(entry.lfn_offsets[0])
+        assert boot_fs.f.read(1)[0] == fat32.DELETED_ENTRY
+        entries = boot_fs.list_root()
+        assert list(entries) == ["config.txt"]
+        assert entries["config.txt"].lfn_offsets == ()
+        assert boot_fs.read_file("config.txt") == b"new"
@@ -0,0 +1,97 @@
+import pexpect
+import pytest
+
+import benchmark
+import customise_os
+
+
+@pytest.fixture
+def guest():
+    """The benchmark fake guest, logged in to its bash shell."""
+    child = benchmark.spawn_fake_guest(boot_seconds=0, boot_lines=0)
+    try:
+        customise_os.login(child)
+        yield child
+        child.sendline("sudo shutdown now")
+        child.expect(pexpect.EOF, timeout=10)
+    finally:
+        child.close()
+
+
+def test_console_commands_output(guest):
+    results = customise_os.run_guest_commands(guest, [
+        "true",
+        "printf 'one\\ntwo\\r\\nthree\\n'",
+        "echo {}:end:0:0:0".format("not-the-token"),
+    ])
+    assert results == [
+        customise_os.CommandResult("true", 0, ""),
+        customise_os.CommandResult("printf 'one\\ntwo\\r\\nthree\\n'", 0, "one\ntwo\nthree"),
+        customise_os.CommandResult("echo not-the-token:end:0:0:0", 0, "not-the-token:end:0:0:0"),
+    ]
+
+
+def test_console_commands_stop_at_the_first_failure(guest, tmp_path):
+    commands = [
+        "echo first",
+        "sh -c 'echo failing; exit 3'",
+        "touch {}".format(tmp_path / "never"),
+    ]
+    results = customise_os.run_guest_commands(guest, commands, check=False)
+    assert [(r.exit_code, r.output) for r in results] == [(0, "first"), (3, "failing")]
+    assert not (tmp_path / "never").exists()
+
+    with pytest.raises(Exception, match="Guest command failed with exit code 3: sh -c"):
+        customise_os.run_guest_commands(guest, commands)
+    assert not (tmp_path / "never").exists()
+    # The shell is still usable after a failure
+    assert customise_os.run_guest_commands(guest, ["echo ok"])[0].output == "ok"
+
+
+def test_check_results_reports_missing_commands():
+    results = [customise_os.CommandResult("echo one", 0, "one")]
+    with pytest.raises(Exception, match="Only 1 of 2 guest commands ran."):
+        customise_os._check_results(["echo one", "echo two"], results)
+
+
+def _login_steps(deadline=customise_os.LOGIN_DEADLINE, **guest_args):
+    child = benchmark.spawn_fake_guest(**dict({"boot_seconds": 0, "boot_lines": 0}, **guest_args))
+    try:
+        timings = customise_os.login(child, deadline=deadline)
+        assert customise_os.run_guest_commands(child, ["whoami"])[0].exit_code == 0
+        return [step for step, _ in timings]
+    finally:
+        child.close()
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(customise_os, "LOGIN_RETRY_BACKOFF", 0.1)
+    monkeypatch.setattr(customise_os, "FIRST_BOOT_MSG_TIMEOUT", 1)
+
+
+@pytest.mark.parametrize("first_boot_msg, steps", [
+    ("before", ["first boot done", "login prompt", "login attempt 1 ok"]),
+    ("after", ["login prompt", "first boot done", "login attempt 1 ok"]),
+    # Tries to login anyway after FIRST_BOOT_MSG_TIMEOUT
+    ("never", ["login prompt", "login attempt 1 ok"]),
+])
+def test_login_waits_for_the_first_boot(fast_retries, first_boot_msg, steps):
+    assert _login_steps(first_boot_msg=first_boot_msg) == steps
+
+
+def test_login_retries_when_incorrect(fast_retries):
+    assert _login_steps(failed_logins=1) == [
+        "first boot done", "login prompt", "login attempt 1 incorrect", "login attempt 2 ok",
+    ]
+
+
+@pytest.mark.parametrize("guest_args", [
+    # The login prompt doesn't show up in time
+    {"boot_seconds": 10, "boot_lines": 10},
+    # The user is never created
+    {"failed_logins": 1000},
+])
+def test_login_deadline(fast_retries, guest_args):
+    with pytest.raises(Exception, match="Could not login within 2 seconds."):
+        _login_steps(deadline=2, **guest_args)
@@ -0,0 +1,120 @@
+import os
+import time
+import getpass
+import shutil
+import socket
+import subprocess
+
+import pexpect
+import pytest
+
+import customise_os
+import guest_ssh
+
+
+SSHD = shutil.which("sshd") or next(
+    (path for path in ("/usr/sbin/sshd", "/usr/local/sbin/sshd") if os.path.isfile(path)), None
+)
+
+
+@pytest.fixture
+def sshd(tmp_path):
+    """A local sshd for the current user, which authorizes the keys in its
+    authorized_keys file."""
+    if SSHD is None:
+        pytest.skip("sshd is not installed")
+    host_key = str(tmp_path / "host_key")
+    subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", host_key], check=True)
+    authorized_keys = tmp_path / "authorized_keys"
+    authorized_keys.write_text("")
+    port = guest_ssh.free_port()
+    config = tmp_path / "sshd_config"
+    config.write_text("\n".join([
+        "Port {}".format(port),
+        "ListenAddress 127.0.0.1",
+        "HostKey {}".format(host_key),
+        "PidFile {}".format(tmp_path / "sshd.pid"),
+        "AuthorizedKeysFile {}".format(authorized_keys),
+        "PasswordAuthentication no",
+        "KbdInteractiveAuthentication no",
+        "UsePAM no",
+        "StrictModes no",
+        "",
+    ]))
+    proc = subprocess.Popen([SSHD, "-D", "-e", "-f", str(config)], stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with socket.socket() as s:
+                if s.connect_ex(("127.0.0.1", port)) == 0:
+                    break
+            time.sleep(0.1)
+        yield port, authorized_keys
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture
+def ssh(sshd):
+    port, authorized_keys = sshd
+    ssh = guest_ssh.GuestSsh(port, getpass.getuser())
+    authorized_keys.write_text(ssh.public_key + "\n")
+    assert ssh.connect(timeout=10)
+    yield ssh
+    ssh.close()
+
+
+def test_run_commands(ssh):
+    results = ssh.run_commands(["echo one", "false", "echo three"])
+    assert [(r.exit_code, r.output) for r in results] == [(0, "one"), (1, "")]
+    results = ssh.run_commands(["sleep 1 && echo {}".format(i) for i in range(4)], parallel=True)
+    assert [r.output for r in results] == ["0", "1", "2", "3"]
+
+
+def test_put_files_keeps_the_mode(ssh, tmp_path):
+    script = tmp_path / "script.sh"
+    script.write_text("#!/bin/sh\necho hello\n")
+    script.chmod(0o750)
+    guest_dir = tmp_path / "guest"
+    ssh.put_files({
+        str(guest_dir / "bin" / "script.sh"): str(script),
+        str(guest_dir / "etc" / "config"): b"key=value\n",
+    })
+    assert (guest_dir / "etc" / "config").read_bytes() == b"key=value\n"
+    assert os.stat(str(guest_dir / "bin" / "script.sh")).st_mode & 0o7777 == 0o750
+    assert ssh.run(str(guest_dir / "bin" / "script.sh")).output == "hello"
+
+
+def test_close_guest_removes_the_key(ssh, sshd, monkeypatch):
+    _, authorized_keys = sshd
+    authorized_keys.write_text("ssh-ed25519 AAAA other-key\n" + ssh.public_key + "\n")
+    # The guest user home is the local one, so point the command to the test file
+    monkeypatch.setattr(customise_os, "_remove_ssh_key_command", lambda s: "sed -i '/ {}$/d' {}".format(
+        s.key_comment, authorized_keys
+    ))
+    monkeypatch.setattr(customise_os.qemu_launcher, "close_qemu", lambda child: None)
+    child = pexpect.spawn("true")
+    child.guest_ssh = ssh
+    customise_os.close_guest(child, None)
+    assert authorized_keys.read_text() == "ssh-ed25519 AAAA other-key\n"
+    assert child.guest_ssh is None
+
+
+def test_launch_guest_retries_when_the_port_is_taken(tmp_path, monkeypatch):
+    outputs = ["Error: port is already allocated", "Booting Linux on physical CPU 0x0"]
+    launched, closed = [], []
+
+    def launch(img_path):
+        child = pexpect.spawn("echo '{}'".format(outputs[len(launched)]))
+        child.ssh_port = 2222 + len(launched)
+        launched.append(child)
+        return child, "rpi-os-test"
+
+    monkeypatch.setattr(customise_os, "LAUNCHER", "docker")
+    monkeypatch.setattr(customise_os, "launch_docker_spawn", launch)
+    monkeypatch.setattr(customise_os, "close_container", lambda child, name: closed.append(child))
+    child, docker_container_name = customise_os.launch_guest(str(tmp_path / "os.img"))
+    assert child is launched[1] and child.ssh_port == 2223
+    assert closed == [launched[0]]
+    assert docker_container_name == "rpi-os-test"
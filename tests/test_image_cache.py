@@ -0,0 +1,37 @@
+"""Local cache of verified images."""
+import os
+
+import download_os
+import image_cache
+
+from conftest import read_file
+
+
+def test_cache_hit_does_not_need_the_network(save_dir, source_image, image_server, monkeypatch):
+    monkeypatch.setattr(download_os, "IMAGE_CACHE", True)
+    server = image_server()
+    img = server.image_url("test.img.xz")
+    first_path = download_os.get_image(img)
+    assert image_cache.lookup_url(img.url) == download_os.fetch_sha256(img.sha256_url)
+
+    server.stop()
+    os.remove(first_path)
+    second_path = download_os.get_image(img)
+    assert read_file(second_path) == read_file(source_image)
+    assert download_os.image_sha256(img) == image_cache.lookup_url(img.url)
+
+
+def test_lru_eviction(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for name in ("a", "b", "c"):
+        img_path = str(tmp_path / "{}.img".format(name))
+        with open(img_path, "wb") as f:
+            f.write(os.urandom(64 * 1024))
+        image_cache.store(name * 64, None, img_path, cache_dir, url="http://host/{}.img.xz".format(name))
+    # Use "a", so "b" is the least recently used
+    assert image_cache.lookup("a" * 64, cache_dir)
+    image_cache.evict(max_size_gb=100 * 1024 / 1024 ** 3, cache_dir=cache_dir, keep="c" * 64)
+
+    assert image_cache.lookup("b" * 64, cache_dir) is None
+    assert image_cache.lookup_url("http://host/b.img.xz", cache_dir) is None
+    assert image_cache.lookup("c" * 64, cache_dir)
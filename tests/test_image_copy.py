@@ -0,0 +1,36 @@
+import os
+import shutil
+
+import pytest
+
+import image_copy
+import partitions
+from conftest import read_file
+
+
+pytestmark = pytest.mark.skipif(not shutil.which("qemu-img"), reason="qemu-img is not installed")
+
+
+def test_overlay_round_trip(os_image, tmp_path):
+    base = read_file(os_image)
+    overlay_path = str(tmp_path / "variant.qcow2")
+    image_copy.create_overlay(os_image, overlay_path)
+    assert image_copy.image_format(overlay_path) == "qcow2"
+    assert image_copy.image_format(os_image) == "raw"
+    assert image_copy.image_size(overlay_path) == len(base)
+
+    # Like the emulated SD card, extended to the next power of 2 and back
+    image_copy.resize_image(overlay_path, 2 * len(base))
+    assert image_copy.image_size(overlay_path) == 2 * len(base)
+    image_copy.resize_image(overlay_path, len(base))
+
+    head_path = str(tmp_path / "head.img")
+    image_copy.raw_head(overlay_path, head_path, partitions.SECTOR_SIZE)
+    assert partitions.read_partitions(head_path) == partitions.read_partitions(os_image)
+
+    flat_path = str(tmp_path / "variant.img")
+    image_copy.flatten_overlay(overlay_path, flat_path)
+    assert read_file(flat_path) == base
+    # The base image is not modified
+    assert read_file(os_image) == base
+    assert os.path.getsize(flat_path) == len(base)
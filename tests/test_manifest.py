@@ -0,0 +1,75 @@
+import shutil
+
+import pytest
+
+import customise_os
+import ext4_edit
+import manifest
+import ram_staging
+from conftest import create_os_image
+
+
+CHUNK_SIZE = 4096
+
+
+@pytest.fixture
+def base_image(os_image):
+    manifest.create_manifest(os_image, chunk_size=CHUNK_SIZE)
+    return os_image
+
+
+def _copy(base_image, tmp_path):
+    img_path = str(tmp_path / "copy.img")
+    shutil.copyfile(base_image, img_path)
+    manifest.track_changes(img_path)
+    return img_path
+
+
+def test_offline_edits_update_the_manifest(tmp_path):
+    # debugfs only writes an undo file if the image extends past twice the
+    # root partition offset
+    base_image = create_os_image(str(tmp_path / "os.img"), None, root_size_mb=48)
+    manifest.create_manifest(base_image, chunk_size=CHUNK_SIZE)
+    img_path = _copy(base_image, tmp_path)
+    customise_os.write_boot_file(img_path, "ssh")
+    with ext4_edit.Ext4Editor(img_path) as editor:
+        editor.mkdir("/etc")
+        editor.write_file("/etc/hostname", "raspberrypi\n" * 1000)
+        editor.symlink("/etc/localtime", "/usr/share/zoneinfo/UTC")
+
+    changed_ranges = manifest.tracked_changes(img_path)
+    updated = manifest.update_manifest(img_path, manifest.manifest_path_for(base_image), ranges=changed_ranges)
+    created = manifest.create_manifest(img_path, str(tmp_path / "created.json"), chunk_size=CHUNK_SIZE)
+    assert updated == created
+    # Only a few blocks of each partition were written
+    assert len(manifest._chunks_in_ranges(changed_ranges, created["size"], CHUNK_SIZE)) < 50
+    assert manifest.tracked_changes(img_path) is None
+
+
+def test_guest_changes_are_unknown(os_image, tmp_path):
+    img_path = _copy(os_image, tmp_path)
+    customise_os.write_boot_file(img_path, "ssh")
+    manifest.record_changes(img_path, None)
+    customise_os.write_boot_file(img_path, "userconf", b"pi:x\n")
+    assert manifest.tracked_changes(img_path) is None
+
+
+def test_write_back_records_the_dirty_chunks(base_image, tmp_path):
+    img_path = _copy(base_image, tmp_path)
+    staged_path = str(tmp_path / "staged.img")
+    shutil.copyfile(img_path, staged_path)
+    original_hashes = manifest.hash_chunks(staged_path, None, ram_staging.STAGING_CHUNK_SIZE)
+    with open(staged_path, "r+b") as f:
+        f.seek(5 * 1024 * 1024 + 100)
+        f.write(b"changed")
+    ram_staging.write_back(staged_path, img_path, original_hashes)
+    assert manifest.tracked_changes(img_path) == [(5 * 1024 * 1024, 6 * 1024 * 1024)]
+
+
+def test_verify_counts_the_last_partial_chunk(tmp_path, capsys):
+    img_path = str(tmp_path / "small.img")
+    with open(img_path, "wb") as f:
+        f.write(b"x" * (manifest.MANIFEST_CHUNK_SIZE + 1024 * 1024))
+    manifest.create_manifest(img_path)
+    assert manifest.verify_image(img_path) == []
+    assert "Verified 5.0MB" in capsys.readouterr().out
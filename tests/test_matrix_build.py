@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import download_os
+import matrix_build
+from matrix_build import Target
+
+
+def _image(release, tag):
+    url = "https://example.com/{0}/{1}/{0}-{1}.img.xz".format(release, tag)
+    return download_os.ImageURL(url, url + ".sha256")
+
+
+IMAGES = {
+    "bookworm": {"2023-10-10": _image("bookworm", "2023-10-10")},
+    "bullseye": {
+        "2023-05-03": _image("bullseye", "2023-05-03"),
+        "2023-02-22": _image("bullseye", "2023-02-22"),
+    },
+}
+
+
+def test_parse_targets_expands_the_tags():
+    assert matrix_build.parse_targets(["bullseye:*:autologin-ssh"], IMAGES) == [
+        Target("bullseye", "2023-05-03", "autologin-ssh"),
+        Target("bullseye", "2023-02-22", "autologin-ssh"),
+    ]
+
+
+def test_parse_targets_adds_the_parent_variants():
+    assert matrix_build.parse_targets(["bookworm:2023-10-10:mu", "bookworm:2023-10-10:autologin-ssh"], IMAGES) == [
+        Target("bookworm", "2023-10-10", "mu"),
+        Target("bookworm", "2023-10-10", "autologin-ssh-expanded"),
+        Target("bookworm", "2023-10-10", "autologin-ssh"),
+    ]
+    # All the variants when it's omitted
+    assert len(matrix_build.parse_targets(["bookworm:2023-10-10"], IMAGES)) == len(matrix_build.VARIANTS)
+
+
+@pytest.mark.parametrize("spec, error", [
+    ("bookworm", "Target must be release:tag"),
+    ("buster:2023-05-03", "Unknown release: buster"),
+    ("bullseye:2023-10-10", "Unknown tag for bullseye: 2023-10-10"),
+    ("bullseye:*:desktop", "Unknown variant: desktop"),
+])
+def test_parse_targets_errors(spec, error):
+    with pytest.raises(Exception, match=error):
+        matrix_build.parse_targets([spec], IMAGES)
+
+
+def test_failed_parent_skips_its_children(tmp_path, monkeypatch):
+    targets = matrix_build.parse_targets(["bookworm:*:mu", "bullseye:2023-05-03:autologin-ssh"], IMAGES)
+    build = matrix_build.MatrixBuild(targets, IMAGES, guests=2, save_dir=str(tmp_path))
+    built = []
+
+    def get_image(release, tag):
+        img_path = tmp_path / "{}-{}.img".format(release, tag)
+        img_path.write_bytes(b"image")
+        return str(img_path), "base-key"
+
+    def build_variant(target, src_img, parent_key):
+        if target.variant == "autologin-ssh-expanded":
+            raise Exception("expand failed")
+        built.append(target)
+        img_path = tmp_path / "{}-{}-{}.img".format(*target)
+        img_path.write_bytes(b"variant")
+        return str(img_path), "{}-key".format(target.variant)
+
+    monkeypatch.setattr(build, "_get_image", get_image)
+    monkeypatch.setattr(build, "_build_variant", build_variant)
+    results = asyncio.run(build.run())
+
+    assert [(r.target, r.status) for r in results] == [
+        (Target("bookworm", "2023-10-10", "mu"), "skipped"),
+        (Target("bookworm", "2023-10-10", "autologin-ssh-expanded"), "failed"),
+        (Target("bookworm", "2023-10-10", "autologin-ssh"), "ok"),
+        (Target("bullseye", "2023-05-03", "autologin-ssh"), "ok"),
+    ]
+    assert results[1].error == "Exception: expand failed"
+    assert results[2].img_path == str(tmp_path / "bookworm-2023-10-10-autologin-ssh.img")
+    assert sorted(built) == [
+        Target("bookworm", "2023-10-10", "autologin-ssh"),
+        Target("bullseye", "2023-05-03", "autologin-ssh"),
+    ]
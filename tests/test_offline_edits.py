@@ -0,0 +1,55 @@
+import pytest
+
+import customise_os
+import fat32
+from conftest import debugfs
+
+
+@pytest.fixture(autouse=True)
+def offline_edits(monkeypatch):
+    monkeypatch.setattr(customise_os, "OFFLINE_EDITS", True)
+
+
+def test_autologin_ssh_offline(os_image):
+    customise_os.run_edits(os_image, img_tag="2023-05-03", autologin=True, ssh=True, expand_fs=False)
+
+    with fat32.Fat32Filesystem(os_image) as boot_fs:
+        userconf = boot_fs.read_file("userconf").decode("utf-8")
+    assert userconf.startswith("{}:$6$".format(customise_os.RPI_OS_USERNAME))
+
+    assert debugfs(os_image, "cat /etc/systemd/system/getty@tty1.service.d/autologin.conf") == \
+        customise_os.TTY_SERVICE_AUTOLOGIN_CONF
+    assert debugfs(os_image, "cat /etc/systemd/system/serial-getty@ttyAMA0.service.d/autologin.conf") == \
+        customise_os.SERIAL_TTY_SERVICE_AUTOLOGIN_CONF
+    stat = debugfs(os_image, "stat /etc/systemd/system/getty@tty1.service.d/autologin.conf")
+    assert "User:     0   Group:     0" in stat and "Mode:  0644" in stat
+    for link, target in (
+        ("/etc/systemd/system/getty.target.wants/getty@tty1.service", "/lib/systemd/system/getty@.service"),
+        ("/etc/systemd/system/multi-user.target.wants/ssh.service", "/lib/systemd/system/ssh.service"),
+        ("/etc/systemd/system/sshd.service", "/lib/systemd/system/ssh.service"),
+    ):
+        assert 'Fast link dest: "{}"'.format(target) in debugfs(os_image, "stat {}".format(link))
+
+
+def test_offline_edits_are_idempotent(os_image):
+    for _ in range(2):
+        customise_os.run_edits(os_image, img_tag="2023-05-03", autologin=True, ssh=True, expand_fs=False)
+
+    listing = debugfs(os_image, "ls -l /etc/systemd/system/getty.target.wants")
+    assert listing.count("getty@tty1.service") == 1
+    assert debugfs(os_image, "cat /etc/systemd/system/getty@tty1.service.d/autologin.conf") == \
+        customise_os.TTY_SERVICE_AUTOLOGIN_CONF
+    with fat32.Fat32Filesystem(os_image) as boot_fs:
+        assert list(boot_fs.list_root()) == ["userconf"]
+
+
+@pytest.mark.parametrize("img_tag, capable", [
+    ("2022-04-04", True),
+    ("2022-09-26", False),
+    ("2023-02-21", False),
+    ("2023-05-03", True),
+    (None, False),
+    ("bookworm", False),
+])
+def test_ssh_offline_capable(img_tag, capable):
+    assert customise_os.ssh_offline_capable(img_tag) == capable
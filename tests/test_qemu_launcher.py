@@ -0,0 +1,52 @@
+import pytest
+
+import fat32
+import qemu_launcher
+
+
+@pytest.fixture(autouse=True)
+def machines(monkeypatch):
+    # The real device tree names are not 8.3 names, which fat32 can't write
+    monkeypatch.setattr(qemu_launcher, "QEMU_MACHINES", {
+        "raspi2b": qemu_launcher.QEMU_MACHINES["raspi2b"]._replace(dtb="rpi2.dtb"),
+        "raspi3b": qemu_launcher.QEMU_MACHINES["raspi3b"]._replace(dtb="rpi3.dtb"),
+    })
+
+
+def _write_boot_files(img_path, *file_names):
+    with fat32.Fat32Filesystem(img_path) as boot_fs:
+        for file_name in file_names:
+            boot_fs.write_file(file_name, b"boot file")
+
+
+def test_select_machine(os_image):
+    _write_boot_files(os_image, "kernel7.img", "rpi2.dtb", "kernel8.img", "rpi3.dtb")
+    assert qemu_launcher.select_machine(os_image, "raspi3b").machine == "raspi3b"
+    assert qemu_launcher.select_machine(os_image, "raspi2b").machine == "raspi2b"
+
+
+def test_select_machine_without_64_bit_kernel(os_image):
+    _write_boot_files(os_image, "kernel7.img", "rpi2.dtb", "rpi3.dtb")
+    machine = qemu_launcher.select_machine(os_image, "raspi3b")
+    assert (machine.machine, machine.emulator, machine.kernel) == ("raspi2b", "qemu-system-arm", "kernel7.img")
+
+
+def test_select_machine_without_boot_files(os_image):
+    _write_boot_files(os_image, "kernel8.img", "rpi3.dtb")
+    with pytest.raises(Exception, match="kernel7.img and rpi2.dtb for the raspi2b board"):
+        qemu_launcher.select_machine(os_image, "raspi2b")
+
+
+def test_qemu_command_uses_the_board_ram():
+    for machine in qemu_launcher.QEMU_MACHINES.values():
+        cmd = qemu_launcher.qemu_command("os.img", "kernel", "dtb", machine, 2222)
+        assert cmd[cmd.index("-m") + 1] == "1024M"
+        assert "user,id=net0,hostfwd=tcp:127.0.0.1:2222-:22" in cmd
+
+
+def test_qemu_command_drive_format():
+    machine = qemu_launcher.QEMU_MACHINES["raspi3b"]
+    cmd = qemu_launcher.qemu_command("os.img", "kernel", "dtb", machine)
+    assert cmd[cmd.index("-drive") + 1].startswith("file=os.img,if=sd,format=raw,")
+    cmd = qemu_launcher.qemu_command("os.qcow2", "kernel", "dtb", machine, img_format="qcow2")
+    assert cmd[cmd.index("-drive") + 1].startswith("file=os.qcow2,if=sd,format=qcow2,")
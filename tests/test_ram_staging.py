@@ -0,0 +1,34 @@
+import os
+
+import manifest
+import ram_staging
+from conftest import read_file
+
+
+CHUNK = ram_staging.STAGING_CHUNK_SIZE
+
+
+def _allocated(path):
+    return os.stat(path).st_blocks * 512
+
+
+def test_write_back_keeps_zero_chunks_sparse(tmp_path):
+    img_path, staged_path = str(tmp_path / "os.img"), str(tmp_path / "staged.img")
+    with open(img_path, "wb") as f:
+        f.write(os.urandom(4 * CHUNK))
+    with open(staged_path, "wb") as f:
+        f.write(read_file(img_path))
+    original_hashes = manifest.hash_chunks(staged_path, None, CHUNK)
+
+    # The guest changes a chunk and clears another, and the image is
+    # resized like with `qemu-img resize`
+    with open(staged_path, "r+b") as f:
+        f.seek(CHUNK)
+        f.write(b"changed")
+        f.seek(2 * CHUNK)
+        f.write(bytes(CHUNK))
+        f.truncate(12 * CHUNK)
+    assert ram_staging.write_back(staged_path, img_path, original_hashes) == CHUNK
+
+    assert read_file(img_path) == read_file(staged_path)
+    assert _allocated(img_path) <= 3 * CHUNK
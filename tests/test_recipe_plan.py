@@ -0,0 +1,69 @@
+import json
+import sys
+
+import recipe_plan
+
+
+def _plan(tmp_path, steps, variants):
+    recipe_path = tmp_path / "recipe.json"
+    recipe_path.write_text(json.dumps({
+        "variant": [{"name": name, "steps": variant_steps} for name, variant_steps in variants.items()],
+        "step": steps,
+    }))
+    (tmp_path / "sources.list").write_text("deb http://deb.example.com/debian stable main\n")
+    return recipe_plan.plan_recipe(recipe_plan.load_recipe(str(recipe_path)), "2023-05-03")
+
+
+def _guest_ops(node):
+    return [recipe_plan._describe_op(op) for op in node.stage["guest"]]
+
+
+def test_guest_steps_keep_the_recipe_order(tmp_path):
+    root = _plan(tmp_path, {
+        "tools": {"action": "apt", "packages": ["git"]},
+        "more-tools": {"action": "apt", "packages": ["curl", "git"]},
+        "clone": {"action": "run", "commands": ["git clone https://example.com/repo"]},
+        "sources": {"action": "files", "files": {"/etc/apt/sources.list.d/example.list": "sources.list"}},
+        "example": {"action": "apt", "packages": ["example"]},
+        "chart": {"action": "apt", "packages": ["qtchart"], "optional": True},
+    }, {"dev": ["tools", "more-tools", "clone", "sources", "example", "chart"]})
+    assert _guest_ops(root.children[0]) == [
+        "apt-get update",
+        "apt-get install git curl",
+        "git clone https://example.com/repo",
+        "copy /etc/apt/sources.list.d/example.list",
+        # The sources might have changed, so the indexes are updated again
+        "apt-get update",
+        "apt-get install example",
+        "apt-get install qtchart (optional)",
+    ]
+
+
+def test_child_stage_updates_after_a_run_step(tmp_path):
+    root = _plan(tmp_path, {
+        "tools": {"action": "apt", "packages": ["git"]},
+        "add-repo": {"action": "run", "commands": ["echo deb http://example.com/ stable main | sudo tee x.list"]},
+        "example": {"action": "apt", "packages": ["example"]},
+        "chart": {"action": "apt", "packages": ["qtchart"]},
+    }, {"base": ["tools", "add-repo"], "example": ["tools", "add-repo", "example"],
+        "chart": ["tools", "chart"]})
+    base, chart = root.children[0].children
+    assert _guest_ops(base.children[0]) == ["apt-get update", "apt-get install example"]
+    assert _guest_ops(chart) == ["apt-get update", "apt-get install qtchart"]
+
+
+def test_each_stage_updates_the_package_lists(tmp_path):
+    # The parent stage might be restored from a layer cached long ago
+    root = _plan(tmp_path, {
+        "tools": {"action": "apt", "packages": ["git"]},
+        "expand": {"action": "expand_fs"},
+        "chart": {"action": "apt", "packages": ["qtchart", "git"]},
+    }, {"base": ["tools", "expand"], "chart": ["tools", "expand", "chart"]})
+    parent = root.children[0]
+    assert _guest_ops(parent) == ["apt-get update", "apt-get install git", "expand_fs"]
+    assert _guest_ops(parent.children[0]) == ["apt-get update", "apt-get install qtchart"]
+
+
+def test_build_modules_do_not_import_run_all():
+    import matrix_build  # noqa: F401
+    assert "run_all" not in sys.modules
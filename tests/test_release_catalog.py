@@ -0,0 +1,117 @@
+import pytest
+import requests
+
+import release_catalog
+
+
+def _index_page(*links):
+    """Index page like the Apache ones of the downloads server."""
+    return "<html><body>\n{}\n</body></html>\n".format("\n".join(
+        '<a href="{0}">{0}</a>'.format(link) for link in ("?C=N;O=D", "/") + links
+    )).encode("utf-8")
+
+
+LITE = "/raspios_lite_armhf/images/"
+OLDSTABLE = "/raspios_oldstable_lite_armhf/images/"
+RASPBIAN = "/raspbian_lite/images/"
+
+
+@pytest.fixture
+def mirror(files_server):
+    """Local mirror of the downloads server index pages."""
+    return files_server({
+        LITE: _index_page("raspios_lite_armhf-2023-05-03/", "raspios_lite_armhf-2023-10-10/"),
+        LITE + "raspios_lite_armhf-2023-05-03/": _index_page(
+            "2023-05-03-raspios-bullseye-armhf-lite.img.xz",
+            "2023-05-03-raspios-bullseye-armhf-lite.img.xz.sha256",
+            "2023-05-03-raspios-bullseye-armhf-lite.img.xz.sig",
+        ),
+        LITE + "raspios_lite_armhf-2023-10-10/": _index_page(
+            "2023-10-10-raspios-bookworm-armhf-lite.img.xz",
+            "2023-10-10-raspios-bookworm-armhf-lite.img.xz.sha256",
+        ),
+        LITE + "raspios_lite_armhf-2023-10-10/2023-10-10-raspios-bookworm-armhf-lite.img.xz.sha256":
+            b"B1E5F0B2ACB8AB7C9C0BD5F0B1F6F7B8A1E2D3C4B5A69788F9E0D1C2B3A49586  "
+            b"2023-10-10-raspios-bookworm-armhf-lite.img.xz\n",
+        LITE + "raspios_lite_armhf-2023-10-10/2023-10-10-raspios-bookworm-armhf-lite.img.xz": b"x" * 1234,
+        OLDSTABLE: _index_page("raspios_oldstable_lite_armhf-2023-10-10/"),
+        OLDSTABLE + "raspios_oldstable_lite_armhf-2023-10-10/": _index_page(
+            "2023-10-10-raspios-bullseye-armhf-lite.img.xz",
+        ),
+        RASPBIAN: _index_page("raspbian_lite-2020-02-14/", "archive/"),
+        RASPBIAN + "raspbian_lite-2020-02-14/": _index_page("2020-02-13-raspbian-buster-lite.zip"),
+    })
+
+
+@pytest.fixture
+def catalog(mirror, tmp_path):
+    """Keyword arguments for the release_catalog functions to use the mirror."""
+    return {"session": requests.Session(), "base_url": mirror.base_url,
+            "catalog_path": str(tmp_path / "catalog.json")}
+
+
+def test_list_images(mirror, catalog):
+    images = release_catalog.list_images(**catalog)
+    assert {release: list(tags) for release, tags in images.items()} == {
+        "bullseye": ["2023-05-03"],
+        "bookworm": ["2023-10-10"],
+        "bullseye-legacy": ["2023-10-10"],
+        "buster": ["2020-02-14"],
+    }
+    url = mirror.base_url + "raspios_lite_armhf/images/raspios_lite_armhf-2023-10-10/" \
+        "2023-10-10-raspios-bookworm-armhf-lite.img.xz"
+    assert images["bookworm"]["2023-10-10"] == release_catalog.ImageURL(url, url + ".sha256")
+    assert len(mirror.requests) == 7
+
+
+def test_warm_lookup_revalidates_the_top_level_indexes(mirror, catalog):
+    release_catalog.list_images(**catalog)
+    mirror.requests.clear()
+    images = release_catalog.list_images(**catalog)
+    assert "bookworm" in images
+    # Archived images are not revalidated, and the release folders never change
+    assert sorted(mirror.requests) == [("GET", LITE), ("GET", OLDSTABLE)]
+
+    mirror.requests.clear()
+    release_catalog.list_images("bookworm", **catalog)
+    assert mirror.requests == [("GET", LITE)]
+
+
+def test_new_release_folder_is_fetched_once(mirror, catalog):
+    release_catalog.list_images(**catalog)
+    mirror.files[LITE] = _index_page(
+        "raspios_lite_armhf-2023-05-03/", "raspios_lite_armhf-2023-10-10/", "raspios_lite_armhf-2023-12-05/",
+    )
+    mirror.files[LITE + "raspios_lite_armhf-2023-12-05/"] = _index_page(
+        "2023-12-05-raspios-bookworm-armhf-lite.img.xz",
+    )
+    mirror.requests.clear()
+    tag, img = release_catalog.latest_image("bookworm", **catalog)
+    assert tag == "2023-12-05"
+    assert img.url.endswith("/raspios_lite_armhf-2023-12-05/2023-12-05-raspios-bookworm-armhf-lite.img.xz")
+    assert mirror.requests == [("GET", LITE), ("GET", LITE + "raspios_lite_armhf-2023-12-05/")]
+
+
+def test_offline_lookup_uses_the_catalog(mirror, catalog):
+    images = release_catalog.list_images(**catalog)
+    mirror.stop()
+    assert release_catalog.list_images(**catalog) == images
+    with pytest.raises(Exception, match="Release not found"):
+        release_catalog.latest_image("trixie", **catalog)
+
+
+def test_unreachable_index_without_catalog(mirror, catalog):
+    mirror.stop()
+    with pytest.raises(Exception, match="Could not reach the index page"):
+        release_catalog.list_images(**catalog)
+
+
+def test_sha256_and_size_are_fetched_once(mirror, catalog):
+    img = release_catalog.list_images(**catalog)["bookworm"]["2023-10-10"]
+    mirror.requests.clear()
+    del catalog["base_url"]
+    for _ in range(2):
+        assert release_catalog.published_sha256(img.sha256_url, **catalog) == \
+            "b1e5f0b2acb8ab7c9c0bd5f0b1f6f7b8a1e2d3c4b5a69788f9e0d1c2b3a49586"
+        assert release_catalog.image_size(img.url, **catalog) == 1234
+    assert [method for method, _ in mirror.requests] == ["GET", "HEAD"]
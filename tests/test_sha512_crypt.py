@@ -0,0 +1,34 @@
+import re
+
+import pytest
+
+import sha512_crypt
+
+
+# From `openssl passwd -6 -salt [rounds=N$]salt password`, the first two are
+# also in https://www.akkadia.org/drepper/SHA-crypt.txt
+@pytest.mark.parametrize("password, salt, rounds, expected", [
+    ("Hello world!", "saltstring", 5000,
+     "$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJuesI68u4OTLiBFdcbYEdFCoEOfaS35inz1"),
+    # The salt is truncated to 16 characters
+    ("Hello world!", "saltstringsaltstring", 10000,
+     "$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHbbMCVNSnCM/UrjmM0Dp8vOuZeHBy/"
+     "YTBmSK6H9qs/y3RnOaw5v."),
+    ("we have a short salt string but not a short password", "short", 77777,
+     "$6$rounds=77777$short$WuQyW2YR.hBNpjjRhpYD/ifIw05xdfeEyQoMxIXbkvr0gge1a1x3yRULJ5CCaUeOxFmtlcGZelFl5CxtgfiAc0"),
+    # Longer than a SHA-512 digest
+    ("x" * 70, "abc", 5000,
+     "$6$abc$ebr9PN1mImulDaxRsxuTpBd5r8nx00.c1FyJ3rAPY1IujyzkHA5rs.HijnsbTpJ/8JLea4Td.ytLd2zfs6jJu0"),
+    ("raspberry", "xyz", 5000,
+     "$6$xyz$Ehaa6Z1cWhFitJ6x7uy.lOhdIEkPvaHpj0dbaLIa10Jd3RWwywSycD.eBFAeYgoUU.sJhWG4/ir2yOTEMMmYY0"),
+])
+def test_known_answers(password, salt, rounds, expected):
+    assert sha512_crypt.sha512_crypt(password, salt, rounds) == expected
+
+
+def test_random_salt():
+    hashed = sha512_crypt.sha512_crypt("raspberry")
+    match = re.match(r"^\$6\$([./0-9A-Za-z]{16})\$[./0-9A-Za-z]{86}$", hashed)
+    assert match
+    assert sha512_crypt.sha512_crypt("raspberry", match.group(1)) == hashed
+    assert sha512_crypt.sha512_crypt("raspberry") != hashed